@@ -12,10 +12,16 @@ from omegaconf import OmegaConf
 
 from OmniMod.common.registry import registry
 
-from OmniMod.datasets.builders import *
-from OmniMod.models import *
-from OmniMod.processors import *
-from OmniMod.tasks import *
+# the packages only record where their builders, models, processors, tasks and runners are
+# defined, a module is imported on the first registry lookup of one of its classes
+import OmniMod.datasets.builders
+import OmniMod.models
+import OmniMod.processors
+import OmniMod.runners
+import OmniMod.tasks
+
+registry.register_lazy("lr_scheduler_name_mapping", "linear_warmup_step_lr", "OmniMod.common.optims")
+registry.register_lazy("lr_scheduler_name_mapping", "linear_warmup_cosine_lr", "OmniMod.common.optims")
 
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import atexit
+import inspect
+import logging
+import resource
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch.nn.modules.module import _IncompatibleKeys
+
+
+def is_safetensors(path):
+    return path.endswith(".safetensors")
+
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / (1 << 20)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+def iter_checkpoint(path):
+    """
+    Yield the (key, tensor) pairs of the model weights in a checkpoint. A safetensors file is
+    memory-mapped and read one tensor at a time; a .pth file has to be unpickled as a whole
+    (memory-mapped on PyTorch versions whose torch.load supports it).
+    """
+    if is_safetensors(path):
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                yield key, f.get_tensor(key)
+        return
+    kwargs = {"mmap": True} if "mmap" in inspect.signature(torch.load).parameters else {}
+    checkpoint = torch.load(path, map_location="cpu", **kwargs)
+    state_dict = checkpoint["model"] if "model" in checkpoint else checkpoint
+    for key in list(state_dict.keys()):
+        yield key, state_dict.pop(key)
+
+
+def checkpoint_metadata(path):
+    """Epoch and config of a checkpoint written by convert_checkpoint, {} for other files."""
+    if not is_safetensors(path):
+        return {}
+    with safe_open(path, framework="pt", device="cpu") as f:
+        metadata = f.metadata() or {}
+    return {key: json.loads(value) for key, value in metadata.items()}
+
+
+def assign_tensor(model, name, value, device=None):
+    """
+    Replace the parameter or buffer name of model by value, moved to device and cast to the dtype
+    of the tensor it replaces; no copy is made when they already match. Used to fill tensors
+    created on the meta device, which cannot be copied into.
+    """
+    prefix, _, attr = name.rpartition(".")
+    owner = model.get_submodule(prefix) if prefix else model
+    old = getattr(owner, attr)
+    value = value.to(device=device or value.device, dtype=old.dtype)
+    if attr in owner._parameters:
+        owner._parameters[attr] = nn.Parameter(value, requires_grad=old.requires_grad)
+    else:
+        owner._buffers[attr] = value
+
+
+@torch.no_grad()
+def load_weights(model, path, key_map=None, strict=False, device=None):
+    """
+    Copy the weights of a checkpoint (.safetensors or .pth) straight into the parameters and
+    buffers of model, without building a second state dict. Tensors still on the meta device are
+    replaced by the checkpoint's, on device. key_map maps checkpoint keys to model keys, for
+    checkpoints saved with older names. Returns the missing and unexpected keys like
+    load_state_dict, and logs the load time and how much the host memory peak grew.
+    """
+    start, rss_before = time.time(), rss_mb()
+    targets = model.state_dict(keep_vars=True)
+    key_map = key_map or {}
+    loaded, unexpected, num_bytes = set(), [], 0
+    for key, tensor in iter_checkpoint(path):
+        name = key_map.get(key, key)
+        target = targets.get(name)
+        if target is None:
+            unexpected.append(key)
+            continue
+        if target.shape != tensor.shape:
+            raise RuntimeError("size mismatch for {}: copying a param with shape {} from checkpoint, "
+                               "the shape in current model is {}.".format(name, tensor.shape, target.shape))
+        if target.is_meta:
+            assign_tensor(model, name, tensor, device=device)
+        else:
+            target.copy_(tensor)
+        loaded.add(name)
+        num_bytes += tensor.numel() * tensor.element_size()
+
+    missing = [name for name in targets if name not in loaded]
+    if strict and (missing or unexpected):
+        raise RuntimeError("Error(s) in loading {}: missing keys {}, unexpected keys {}".format(
+            path, missing, unexpected))
+    logging.info("Loaded {} tensors ({:.1f} MB) from {} in {:.2f}s, peak host memory +{:.1f} MB".format(
+        len(loaded), num_bytes / (1 << 20), path, time.time() - start, max(peak_rss_mb() - rss_before, 0.0)))
+    return _IncompatibleKeys(missing, unexpected)
+
+
+def save_weights(state_dict, path, metadata=None):
+    """Write a state dict to a safetensors file, metadata values are stored as JSON."""
+    tensors, storages = {}, set()
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        # safetensors refuses tensors sharing memory, e.g. tied embeddings
+        storage = tensor.untyped_storage().data_ptr()
+        tensor = tensor.clone() if storage in storages else tensor
+        storages.add(storage)
+        tensors[key] = tensor.contiguous()
+    metadata = {key: json.dumps(value) for key, value in (metadata or {}).items()}
+    save_file(tensors, path, metadata=metadata)
+
+
+def write_atomic(obj, path, save_fn=torch.save):
+    """save_fn(obj, path) through a temporary file renamed into place, so readers never see a partial file."""
+    tmp_path = "{}.tmp".format(path)
+    try:
+        save_fn(obj, tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def convert_checkpoint(src, dst=None):
+    """
+    Write the model weights of a .pth checkpoint to a safetensors file (dst defaults to src with
+    the .safetensors extension), with its epoch and config as metadata. The optimizer and scaler
+    states are dropped, resuming training still needs the .pth file.
+    """
+    dst = dst or os.path.splitext(src)[0] + ".safetensors"
+    checkpoint = torch.load(src, map_location="cpu")
+    state_dict = checkpoint["model"] if "model" in checkpoint else checkpoint
+    metadata = {key: checkpoint[key] for key in ["epoch", "config"] if key in checkpoint}
+    save_weights(state_dict, dst, metadata=metadata)
+    return dst
+
+
+def snapshot_to_host(obj):
+    """
+    Copy every tensor of a (nested dict/list/tuple) checkpoint object to host memory, so that
+    training can go on changing the originals while the copy is written. CUDA tensors are copied
+    into pinned memory asynchronously, with a single synchronize at the end.
+    """
+    has_cuda = []
+
+    def copy(value):
+        if torch.is_tensor(value):
+            value = value.detach()
+            if value.is_cuda:
+                has_cuda.append(True)
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                return host.copy_(value, non_blocking=True)
+            return value.clone()
+        if isinstance(value, dict):
+            return type(value)((key, copy(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(item) for item in value)
+        return value
+
+    snapshot = copy(obj)
+    if has_cuda:
+        torch.cuda.synchronize()
+    return snapshot
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints in a background thread. save() snapshots the checkpoint to host memory and
+    returns, each file is written next to its destination and renamed into place once complete,
+    so a reader never sees a partial checkpoint. Only one save is in flight: save() first waits
+    for the previous one, and wait() (also run at exit) waits for the last. The time save()
+    blocked the caller and the duration of each write are logged.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        atexit.register(self.wait)
+
+    def _write(self, files, callback):
+        start = time.time()
+        for obj, path, save_fn in files:
+            write_atomic(obj, path, save_fn)
+        logging.info("Checkpoint {} written in background in {:.1f}s".format(
+            ", ".join(path for _, path, _ in files), time.time() - start))
+        if callback is not None:
+            callback()
+
+    def save(self, files, callback=None):
+        """
+        files: (obj, path, save_fn) to write in order, callback runs once they are all on disk
+        (e.g. to remove older checkpoints).
+        """
+        start = time.time()
+        self.wait()
+        files = [(snapshot_to_host(obj), path, save_fn) for obj, path, save_fn in files]
+        self.pending = self.executor.submit(self._write, files, callback)
+        logging.info("Checkpoint snapshot taken, training stalled {:.2f}s".format(time.time() - start))
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()  # re-raises an error of the write
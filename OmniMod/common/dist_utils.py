@@ -11,7 +11,6 @@ import os
 
 import torch
 import torch.distributed as dist
-import timm.models.hub as timm_hub
 
 
 def setup_for_distributed(is_master):
@@ -122,6 +121,8 @@ def download_cached_file(url, check_hash=True, progress=False):
     Download a file from a URL and cache it locally. If the file already exists, it is not downloaded again.
     If distributed, only the main process downloads the file, and the other processes wait for the file to be downloaded.
     """
+    # timm pulls in much of its model zoo, only import it when a file is actually needed
+    import timm.models.hub as timm_hub
 
     def get_cached_file_path():
         # a hack to sync the file path across processes
@@ -6,6 +6,9 @@
 """
 
 
+import importlib
+
+
 class Registry:
     mapping = {
         "builder_name_mapping": {},
@@ -17,6 +20,38 @@ class Registry:
         "state": {},
         "paths": {},
     }
+    # name -> module path of the classes not imported yet, per *_name_mapping
+    lazy_mapping = {
+        "builder_name_mapping": {},
+        "task_name_mapping": {},
+        "processor_name_mapping": {},
+        "model_name_mapping": {},
+        "lr_scheduler_name_mapping": {},
+        "runner_name_mapping": {},
+    }
+
+    @classmethod
+    def register_lazy(cls, mapping_name, name, module_path):
+        r"""Record that the class registered as 'name' in 'mapping_name' is defined in 'module_path'.
+        The module is only imported, and the class registered by its decorator, on the first lookup.
+
+        Usage:
+
+            from OmniMod.common.registry import registry
+
+            registry.register_lazy("model_name_mapping", "OmniMod", "OmniMod.models.OmniMod")
+        """
+        cls.lazy_mapping[mapping_name][name] = module_path
+
+    @classmethod
+    def _get_class(cls, mapping_name, name):
+        if name not in cls.mapping[mapping_name] and name in cls.lazy_mapping[mapping_name]:
+            importlib.import_module(cls.lazy_mapping[mapping_name][name])
+        return cls.mapping[mapping_name].get(name, None)
+
+    @classmethod
+    def _list(cls, mapping_name):
+        return sorted(set(cls.mapping[mapping_name]) | set(cls.lazy_mapping[mapping_name]))
 
     @classmethod
     def register_builder(cls, name):
@@ -230,51 +265,51 @@ class Registry:
 
     @classmethod
     def get_builder_class(cls, name):
-        return cls.mapping["builder_name_mapping"].get(name, None)
+        return cls._get_class("builder_name_mapping", name)
 
     @classmethod
     def get_model_class(cls, name):
-        return cls.mapping["model_name_mapping"].get(name, None)
+        return cls._get_class("model_name_mapping", name)
 
     @classmethod
     def get_task_class(cls, name):
-        return cls.mapping["task_name_mapping"].get(name, None)
+        return cls._get_class("task_name_mapping", name)
 
     @classmethod
     def get_processor_class(cls, name):
-        return cls.mapping["processor_name_mapping"].get(name, None)
+        return cls._get_class("processor_name_mapping", name)
 
     @classmethod
     def get_lr_scheduler_class(cls, name):
-        return cls.mapping["lr_scheduler_name_mapping"].get(name, None)
+        return cls._get_class("lr_scheduler_name_mapping", name)
 
     @classmethod
     def get_runner_class(cls, name):
-        return cls.mapping["runner_name_mapping"].get(name, None)
+        return cls._get_class("runner_name_mapping", name)
 
     @classmethod
     def list_runners(cls):
-        return sorted(cls.mapping["runner_name_mapping"].keys())
+        return cls._list("runner_name_mapping")
 
     @classmethod
     def list_models(cls):
-        return sorted(cls.mapping["model_name_mapping"].keys())
+        return cls._list("model_name_mapping")
 
     @classmethod
     def list_tasks(cls):
-        return sorted(cls.mapping["task_name_mapping"].keys())
+        return cls._list("task_name_mapping")
 
     @classmethod
     def list_processors(cls):
-        return sorted(cls.mapping["processor_name_mapping"].keys())
+        return cls._list("processor_name_mapping")
 
     @classmethod
     def list_lr_schedulers(cls):
-        return sorted(cls.mapping["lr_scheduler_name_mapping"].keys())
+        return cls._list("lr_scheduler_name_mapping")
 
     @classmethod
     def list_datasets(cls):
-        return sorted(cls.mapping["builder_name_mapping"].keys())
+        return cls._list("builder_name_mapping")
 
     @classmethod
     def get_path(cls, name):
@@ -1,11 +1,13 @@
 import argparse
 import time
 from threading import Thread
+from queue import Queue
 from PIL import Image
 
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizer
 from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers.generation.streamers import BaseStreamer
 
 import dataclasses
 from enum import auto, Enum
@@ -107,6 +109,192 @@ class StoppingCriteriaSub(StoppingCriteria):
         return False
 
 
+def stop_string_token_ids(tokenizer, stop_string, contexts=("", " ", "\n", ".", "a")):
+    """
+    Token id sequences a stop string can be generated as. Sentencepiece and BPE tokenizers
+    split a string differently depending on what precedes it, so it is encoded after a few
+    typical contexts and the context tokens are stripped again.
+    """
+    variants = []
+    for context in contexts:
+        context_ids = tokenizer(context, add_special_tokens=False).input_ids if context else []
+        ids = tokenizer(context + stop_string, add_special_tokens=False).input_ids
+        if ids[:len(context_ids)] != context_ids:
+            # the stop string merged with the context, this variant cannot be matched on tokens
+            continue
+        ids = ids[len(context_ids):]
+        if ids and ids not in variants:
+            variants.append(ids)
+    return variants
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Per-sequence stopping criteria for batched generation.
+
+    A sequence is finished once it produces one of stop_ids or ends with one of the token
+    sequences in stop_sequences. Instead of a single bool, a bool tensor [B] is returned so that
+    generate keeps decoding the other sequences, and everything stays on the device: no host
+    sync is added to the decoding loop. The step at which each sequence finished is kept to
+    count the generated and the wasted (padding) tokens afterwards, see stats.
+    """
+
+    def __init__(self, stop_ids, stop_sequences=()):
+        super().__init__()
+        self.stop_ids = list(stop_ids)
+        self.stop_sequences = [list(ids) for ids in stop_sequences if len(ids) > 0]
+        self._device = None
+        self._stop_ids = None
+        self._stop_sequences = None
+
+        self.finished = None
+        self.finished_at = None
+        self.length = 0
+
+    def _to_device(self, device):
+        if self._device != device:
+            self._stop_ids = torch.tensor(self.stop_ids, dtype=torch.long, device=device)
+            self._stop_sequences = [torch.tensor(ids, dtype=torch.long, device=device) for ids in self.stop_sequences]
+            self._device = device
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor = None, **kwargs):
+        self._to_device(input_ids.device)
+        done = torch.isin(input_ids[:, -1], self._stop_ids)
+        for ids in self._stop_sequences:
+            if input_ids.shape[1] >= len(ids):
+                done |= (input_ids[:, -len(ids):] == ids).all(dim=-1)
+
+        if self.finished is None:
+            self.finished = torch.zeros_like(done)
+            self.finished_at = torch.full_like(input_ids[:, -1], -1)
+        self.finished_at = torch.where(done & ~self.finished, input_ids.shape[1], self.finished_at)
+        self.finished = self.finished | done
+        self.length = input_ids.shape[1]
+        return self.finished.clone()
+
+    def stats(self):
+        """Token counts of the finished generate call, this is the only host sync."""
+        if self.finished is None:
+            return {"sequences": 0, "generated": 0, "wasted": 0, "truncated": 0}
+        lengths = torch.where(self.finished, self.finished_at, torch.full_like(self.finished_at, self.length))
+        generated = int(lengths.sum())
+        return {
+            "sequences": len(lengths),
+            "generated": generated,
+            "wasted": len(lengths) * self.length - generated,
+            "truncated": int((~self.finished).sum()),
+        }
+
+
+class BatchTextIteratorStreamer(BaseStreamer):
+    """
+    Streamer for batched generation from inputs_embeds. TextIteratorStreamer only handles a
+    single sequence, this one keeps the tokens of every sequence in the batch and, after each
+    decoding step, queues a list with the new text of each sequence (empty when nothing new).
+
+    The text is post-processed the same way as the final answer, so the pieces of a sequence
+    join to the answer generate would return. Trailing whitespace and a trailing partial stop
+    string are held back until the next step shows whether they belong to the answer.
+
+    An error of the generation is raised to the consumer when it reaches the end of the stream.
+    cancel() asks the generation to stop, through a CancelCriteria watching the streamer, e.g.
+    when the consumer goes away.
+    """
+
+    def __init__(self, tokenizer, batch_size, postprocess, stop_strings=(), timeout=None):
+        self.tokenizer = tokenizer
+        self.postprocess = postprocess
+        self.stop_strings = stop_strings
+        self.timeout = timeout
+
+        self.token_ids = [[] for _ in range(batch_size)]
+        self.emitted = [""] * batch_size
+        self.finished = [False] * batch_size
+
+        self.text_queue = Queue()
+        self.stop_signal = None
+        self.next_tokens_are_prompt = True
+        self.ended = False
+        self.error = None
+        self.cancelled = False
+
+    def _hold_back(self, text):
+        text = text.rstrip()
+        for stop in self.stop_strings:
+            for k in range(len(stop) - 1, 0, -1):
+                if text.endswith(stop[:k]):
+                    return text[:-k].rstrip()
+        return text
+
+    def _delta(self, idx, final=False):
+        text = self.tokenizer.decode(self.token_ids[idx], skip_special_tokens=True)
+        answer = self.postprocess(text)
+        if not final:
+            answer = self._hold_back(answer)
+        if not answer.startswith(self.emitted[idx]):
+            # the model produced a stop string that re-anchors the answer, nothing sensible to append
+            return ""
+        delta = answer[len(self.emitted[idx]):]
+        self.emitted[idx] = answer
+        return delta
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            # the first call carries the prompt ids, which are empty when generating from inputs_embeds
+            self.next_tokens_are_prompt = False
+            return
+
+        if value.dim() > 1:
+            value = value[:, -1]
+        deltas = []
+        for idx, token in enumerate(value.tolist()):
+            if self.finished[idx] or (len(self.token_ids[idx]) == 0 and token == 0):
+                deltas.append("")
+                continue
+            if token == self.tokenizer.eos_token_id:
+                self.finished[idx] = True
+            self.token_ids[idx].append(token)
+            deltas.append(self._delta(idx))
+        if any(deltas):
+            self.text_queue.put(deltas, timeout=self.timeout)
+
+    def end(self, error=None):
+        # generate calls end() when it finishes, the generation thread calls it again in any case
+        if self.ended:
+            return
+        self.ended = True
+        self.error = error
+        if error is None:
+            deltas = [self._delta(idx, final=True) for idx in range(len(self.token_ids))]
+            if any(deltas):
+                self.text_queue.put(deltas, timeout=self.timeout)
+        self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value == self.stop_signal:
+            if self.error is not None:
+                raise self.error
+            raise StopIteration()
+        return value
+
+
+class CancelCriteria(StoppingCriteria):
+    """Stops every sequence once the streamer it watches is cancelled."""
+
+    def __init__(self, streamer):
+        self.streamer = streamer
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor = None, **kwargs):
+        return torch.full((input_ids.shape[0],), self.streamer.cancelled, dtype=torch.bool, device=input_ids.device)
+
+
 CONV_VISION_Vicuna0 = Conversation(
     system="Give the following image: <Img>ImageContent</Img>. "
            "You will be able to see the image once I provide it to you. Please answer my questions.",
@@ -5,12 +5,8 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
-from OmniMod.datasets.builders.base_dataset_builder import load_dataset_config
-from OmniMod.datasets.builders.image_text_pair_builder import (
-    CCSBUBuilder,
-    LaionBuilder,
-    CCSBUAlignBuilder
-)
+import importlib
+
 from OmniMod.common.registry import registry
 
 __all__ = [
@@ -19,6 +15,50 @@ __all__ = [
     "CCSBUAlignBuilder"
 ]
 
+# the builders import their datasets (decord, webdataset, ...), they are imported on first use
+for _name in [
+    "audio_train",
+    "vindrcxr_train",
+    "multitask_conversation",
+    "unnatural_instruction",
+    "llava_detail",
+    "llava_reason",
+    "llava_conversation",
+    "refcoco",
+    "refcocop",
+    "refcocog",
+    "invrefcoco",
+    "invrefcocop",
+    "invrefcocog",
+    "refvg",
+    "textcaps_caption",
+    "coco_vqa",
+    "ok_vqa",
+    "aok_vqa",
+    "gqa",
+    "flickr_grounded_caption",
+    "flickr_CaptionToPhrase",
+    "flickr_ObjectToPhrase",
+    "ocrvqa",
+    "cc_sbu",
+    "laion",
+    "coco_caption",
+    "cc_sbu_align",
+]:
+    registry.register_lazy("builder_name_mapping", _name, "OmniMod.datasets.builders.image_text_pair_builder")
+
+
+def __getattr__(name):
+    if name == "load_dataset_config":
+        from OmniMod.datasets.builders.base_dataset_builder import load_dataset_config
+
+        return load_dataset_config
+    if name in __all__:
+        value = getattr(importlib.import_module("OmniMod.datasets.builders.image_text_pair_builder"), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
     """
@@ -29,6 +69,8 @@ def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
     >>> print([len(dataset[split]) for split in splits])
 
     """
+    from OmniMod.datasets.builders.base_dataset_builder import load_dataset_config
+
     if cfg_path is None:
         cfg = None
     else:
@@ -59,14 +101,16 @@ def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
 
 
 class DatasetZoo:
-    def __init__(self) -> None:
-        self.dataset_zoo = {
-            k: list(v.DATASET_CONFIG_DICT.keys())
-            for k, v in sorted(registry.mapping["builder_name_mapping"].items())
+    @property
+    def dataset_zoo(self):
+        # imports every registered builder
+        return {
+            k: list(registry.get_builder_class(k).DATASET_CONFIG_DICT.keys())
+            for k in registry.list_datasets()
         }
 
     def get_names(self):
-        return list(self.dataset_zoo.keys())
+        return registry.list_datasets()
 
 
 dataset_zoo = DatasetZoo()
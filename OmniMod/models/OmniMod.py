@@ -1,18 +1,47 @@
 import logging
 import random
 import os
+import time
 
 import torch
 from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
+from peft import PeftModel
 
+from OmniMod.common.checkpoint import load_weights, peak_rss_mb
 from OmniMod.common.registry import registry
 from OmniMod.models.base_model import disabled_train
 from OmniMod.models.OmniMod_base import OmniModBase
+from OmniMod.models.embedding_cache import EmbeddingCache
+from OmniMod.models.token_merging import merge_tokens
+from OmniMod.models.compile_utils import compile_bucketed, enable_compile_cache
+from OmniMod.models.cpu_inference import bf16_supported, default_num_threads, quantize_linear_layers, run_in_dtype
+from OmniMod.models.meta_init import init_empty, materialize
 
 IMG_DIM_VIT_LLAMA = 5632 # 1408 * 4
 
+
+def stage3_key_map(model):
+    """Checkpoint keys of checkpoint_stage3 (llama_model.*, llama_proj.*) -> keys of model."""
+    key_map = {}
+    for name, _ in model.named_parameters():
+        legacy_name = name.replace("language_model", "llama_model").replace("default.", "")
+        if legacy_name != name:
+            key_map[legacy_name] = name
+    # llama_proj is the last linear layer of language_proj
+    if isinstance(model.language_proj, nn.Sequential):
+        prefix = "language_proj.{}.".format(len(model.language_proj) - 1)
+    else:
+        prefix = "language_proj."
+    key_map["llama_proj.weight"] = prefix + "weight"
+    key_map["llama_proj.bias"] = prefix + "bias"
+    return key_map
+
+def cache_namespace(**options):
+    """Namespace of an embedding cache: every option the cached embeddings depend on, in a stable order."""
+    return "|".join("{}={}".format(key, options[key]) for key in sorted(options))
+
 @registry.register_model("OmniMod")
 class OmniMod(OmniModBase):
     """
@@ -47,6 +76,8 @@ class OmniMod(OmniModBase):
             max_context_len=3800,
             low_resource=False,  # use 8 bit and put vit in cpu
             device_8bit=0,  # the device of 8bit model should be set when loading and cannot be changed anymore.
+            meta_init=False,
+            device=None,
     ):
         super().__init__(
             vision_model=vision_model,
@@ -69,28 +100,32 @@ class OmniMod(OmniModBase):
             lora_target_modules=lora_target_modules,
             lora_alpha=lora_alpha,
             lora_dropout=lora_dropout,
+            meta_init=meta_init,
+            device=device,
         )
 
         img_f_dim = self.visual_encoder.num_features * self.num_concat
-        if vision_model == "eva_clip_g" and "llama" in language_model: 
-            self.language_proj = nn.Linear(
-                img_f_dim, self.language_model.config.hidden_size
-            )
-        else:
-            self.language_proj = nn.Sequential(
-                nn.Linear(img_f_dim, IMG_DIM_VIT_LLAMA),
+        # created on the meta device with meta_init, from_config loads or materializes them
+        with init_empty(meta_init):
+            if vision_model == "eva_clip_g" and "llama" in language_model: 
+                self.language_proj = nn.Linear(
+                    img_f_dim, self.language_model.config.hidden_size
+                )
+            else:
+                self.language_proj = nn.Sequential(
+                    nn.Linear(img_f_dim, IMG_DIM_VIT_LLAMA),
+                    nn.GELU(),
+                    nn.Linear(IMG_DIM_VIT_LLAMA, self.language_model.config.hidden_size)
+                )
+            '''Original layer: 1 Linear layer'''
+            # self.audio_language_proj = nn.Linear(self.audio_encoder.d_model, self.language_model.config.hidden_size)
+
+            '''Testing: 2 Linear layers'''
+            self.audio_language_proj = nn.Sequential(
+                nn.Linear(self.audio_encoder.d_model, IMG_DIM_VIT_LLAMA),
                 nn.GELU(),
                 nn.Linear(IMG_DIM_VIT_LLAMA, self.language_model.config.hidden_size)
             )
-        '''Original layer: 1 Linear layer'''
-        # self.audio_language_proj = nn.Linear(self.audio_encoder.d_model, self.language_model.config.hidden_size)
-
-        '''Testing: 2 Linear layers'''
-        self.audio_language_proj = nn.Sequential(
-            nn.Linear(self.audio_encoder.d_model, IMG_DIM_VIT_LLAMA),
-            nn.GELU(),
-            nn.Linear(IMG_DIM_VIT_LLAMA, self.language_model.config.hidden_size)
-        )
 
         '''Transformer adapter '''
         # transformer_encoder_layer = nn.TransformerEncoderLayer(
@@ -107,37 +142,171 @@ class OmniMod(OmniModBase):
 
         self.chat_template = chat_template
 
+        # visual token merging, see enable_token_merging
+        self.img_token_budget = 0
+        self.token_merge_counters = {}
+
+        # torch.compile of the encoders and projectors, see enable_compile
+        self.compile_buckets = None
+        self.compile_img_size = None
+
         if use_grad_checkpoint_llm:
             self.language_model.gradient_checkpointing_enable()
 
-    def encode_img(self, image):
-        device = image.device
+    def enable_img_cache(self, namespace, max_mb=1024, disk_dir=None):
+        self.img_cache = EmbeddingCache(namespace=namespace, max_bytes=int(max_mb * (1 << 20)), disk_dir=disk_dir)
+
+    def enable_token_merging(self, img_token_budget):
+        """
+        Merge the patch tokens of each image by similarity until the language model gets at most
+        img_token_budget tokens per image (after the num_concat reshape). No training is needed,
+        the merged tokens are weighted averages of the patches they replace.
+        """
+        self.img_token_budget = img_token_budget
+        self.token_merge_counters = {}
+
+    def token_merge_stats(self):
+        counters = self.token_merge_counters
+        if not counters.get("images"):
+            return {}
+        return {"token_merge": {
+            "images": counters["images"],
+            "tokens_per_image_before": round(counters["tokens_before"] / counters["images"], 1),
+            "tokens_per_image_after": round(counters["tokens_after"] / counters["images"], 1),
+            "context_reduction": round(1 - counters["tokens_after"] / counters["tokens_before"], 4),
+        }}
+
+    def enable_vit_sdpa(self):
+        """Use F.scaled_dot_product_attention in the EVA ViT blocks, see VisionTransformer.set_sdpa."""
+        if not hasattr(self.visual_encoder, "set_sdpa"):
+            logging.warning("vit_sdpa is only supported by the eva_clip_g vision encoder, ignored")
+            return
+        self.visual_encoder.set_sdpa(True)
+
+    def enable_cpu_inference(self, int8=True, encoder_dtype="auto", num_threads=None):
+        """
+        Prepare the model for inference nodes without a GPU. Everything runs in float32 (autocast and
+        fp16 kernels are GPU only), LoRA weights are merged into the language model, and with int8
+        the linear layers of the language model, language_proj and audio_language_proj are
+        quantized dynamically. The frozen vision encoder runs in bf16 when the CPU has bf16 kernels
+        (encoder_dtype "auto"), Whisper tiny is too small to gain from it and stays in float32.
+        """
+        torch.set_num_threads(num_threads or default_num_threads())
+        self.float()
+        if self.draft_model is not None:
+            # not a submodule, self.float() does not reach it
+            self.set_draft_model(self.draft_model.float())
+
+        if isinstance(self.language_model, PeftModel):
+            self.language_model = self.language_model.merge_and_unload()
+        if encoder_dtype == "auto":
+            encoder_dtype = "bf16" if bf16_supported() else "fp32"
+        if encoder_dtype == "bf16":
+            run_in_dtype(self.visual_encoder, torch.bfloat16)
 
+        if int8:
+            self.language_model = quantize_linear_layers(self.language_model)
+            self.language_proj = quantize_linear_layers(self.language_proj)
+            self.audio_language_proj = quantize_linear_layers(self.audio_language_proj)
+            if self.draft_model is not None:
+                self.set_draft_model(quantize_linear_layers(self.draft_model))
+        logging.info("CPU inference: int8={}, vision encoder in {}, {} threads".format(
+            int8, encoder_dtype, torch.get_num_threads()))
+        return self.eval()
+
+    def enable_compile(self, buckets=(1, 2, 4, 8, 16), img_size=224, mode=None, cache_dir=None,
+                       modules=("vision", "audio", "projector")):
+        """
+        Compile the vision encoder, Whisper and/or the two projectors with torch.compile. Batches
+        are padded up to one of buckets, so every module is compiled once per bucket; call
+        warmup_compiled once the model is on its device to compile them all before serving.
+        """
+        enable_compile_cache(cache_dir)
+        self.compile_buckets = sorted(buckets)
+        self.compile_img_size = img_size
+        if "vision" in modules:
+            compile_bucketed(self.visual_encoder, self.compile_buckets, mode=mode)
+        if "audio" in modules:
+            compile_bucketed(self.audio_encoder, self.compile_buckets, mode=mode)
+        if "projector" in modules:
+            compile_bucketed(self.language_proj, self.compile_buckets, mode=mode)
+            # the number of audio tokens varies with variable length and long audio
+            compile_bucketed(self.audio_language_proj, self.compile_buckets, mode=mode, dynamic=None)
+
+    @torch.no_grad()
+    def warmup_compiled(self):
+        """Run every bucket once through the compiled modules, returns the seconds it took."""
+        start = time.time()
+        for bucket in self.compile_buckets:
+            images = torch.zeros([bucket, 3, self.compile_img_size, self.compile_img_size], device=self.device)
+            audios = torch.zeros([bucket, 80, self.audio_encoder.window_frames], device=self.device)
+            self._encode_img(images)
+            self._encode_audio(audios)
+        self.token_merge_counters = {}
+        elapsed = time.time() - start
+        logging.info("torch.compile warm-up of buckets {} took {:.1f}s".format(self.compile_buckets, elapsed))
+        return elapsed
+
+    def encode_img(self, image):
         if len(image.shape) > 4:
             image = image.reshape(-1, *image.shape[-3:])
 
+        if self.use_cache_for(self.img_cache):
+            return self.cached_encode(self.img_cache, image, self._encode_img)
+        return self._encode_img(image)
+
+    def _encode_img(self, image):
+        device = image.device
+
         with self.maybe_autocast():
             image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
             # image_embeds = image_embeds[:, 1:, :]
+            if self.img_token_budget:
+                image_embeds = self._merge_img_tokens(image_embeds)
             bs, pn, hs = image_embeds.shape
             image_embeds = image_embeds.view(bs, int(pn / self.num_concat), int(hs * self.num_concat))
 
             inputs_language = self.language_proj(image_embeds)
             atts_language = torch.ones(inputs_language.size()[:-1], dtype=torch.long).to(image.device)
         return inputs_language, atts_language
+
+    def _merge_img_tokens(self, image_embeds):
+        bs, pn, hs = image_embeds.shape
+        num_tokens = min(self.img_token_budget * self.num_concat, pn)
+        counters = self.token_merge_counters
+        counters["images"] = counters.get("images", 0) + bs
+        counters["tokens_before"] = counters.get("tokens_before", 0) + bs * pn // self.num_concat
+        counters["tokens_after"] = counters.get("tokens_after", 0) + bs * num_tokens // self.num_concat
+        return merge_tokens(image_embeds, num_tokens)
     
+    def enable_audio_cache(self, namespace, max_entries=4096, max_mb=1024, eviction="lru", disk_dir=None):
+        self.audio_cache = EmbeddingCache(namespace=namespace, max_bytes=int(max_mb * (1 << 20)),
+                                          max_entries=max_entries, eviction=eviction, disk_dir=disk_dir)
+
     def encode_audio(self, audio):
+        if self.use_cache_for(self.audio_cache):
+            # keyed on the log-mel features, so the same question wav hits regardless of the image
+            return self.cached_encode(self.audio_cache, audio, self._encode_audio)
+        return self._encode_audio(audio)
+
+    def _encode_audio(self, audio):
         device = audio.device
 
         with self.maybe_autocast():
-            audio_embeds = self.audio_encoder(audio).to(device)
+            # token_lens is None unless the questions have different numbers of audio tokens
+            audio_embeds, token_lens = self.audio_encoder.encode(audio)
+            audio_embeds = audio_embeds.to(device)
 
             inputs_audio = self.audio_language_proj(audio_embeds)
+            if token_lens is not None:
+                positions = torch.arange(inputs_audio.shape[1], device=device)
+                atts_audio = (positions[None] < token_lens.to(device)[:, None]).long()
+                return inputs_audio * atts_audio[..., None], atts_audio
             atts_audio = torch.ones(inputs_audio.size()[:-1], dtype=torch.long).to(audio.device)
         return inputs_audio, atts_audio
 
     @classmethod
-    def from_config(cls, cfg):
+    def from_config(cls, cfg, device=None):
         vision_model = cfg.get("vision_model", "eva_clip_g")
         audio_model = cfg.get("audio_model", "whisper")
         img_size = cfg.get("image_size")
@@ -162,6 +331,41 @@ class OmniMod(OmniModBase):
         use_grad_checkpoint_llm = cfg.get("use_grad_checkpoint_llm", False)
         max_context_len = cfg.get("max_context_len", 3800)
 
+        img_cache_mb = cfg.get("img_cache_mb", 0)  # 0 disables the image embedding cache
+        img_cache_dir = cfg.get("img_cache_dir", None)
+        audio_cache_size = cfg.get("audio_cache_size", 0)  # max cached questions, 0 disables the audio cache
+        audio_cache_mb = cfg.get("audio_cache_mb", 1024)
+        audio_cache_eviction = cfg.get("audio_cache_eviction", "lru")
+        audio_cache_dir = cfg.get("audio_cache_dir", None)
+        audio_variable_length = cfg.get("audio_variable_length", False)  # encode the real frames instead of 30 s
+        audio_bucket_frames = cfg.get("audio_bucket_frames", 200)  # mel frames, 100 per second
+        # audio longer than 30 s (max_duration of the whisper_processor) is encoded in overlapping windows
+        audio_window_overlap = cfg.get("audio_window_overlap", 200)  # mel frames
+        audio_window_batch_size = cfg.get("audio_window_batch_size", 4)
+        max_audio_tokens = cfg.get("max_audio_tokens", 1024)
+        # cpu_int8: dynamic int8 quantization for CPU-only nodes, cpu_fp32: its float32 baseline
+        inference_profile = cfg.get("inference_profile", "")
+        cpu_encoder_dtype = cfg.get("cpu_encoder_dtype", "auto")  # auto: bf16 when the CPU supports it
+        cpu_threads = cfg.get("cpu_threads", 0)  # 0: all the cores this process may use
+        if inference_profile.startswith("cpu"):
+            assert not low_resource, "low_resource needs bitsandbytes and a GPU, it cannot be used with a CPU profile"
+            precision = "fp32"
+        compile_encoders = cfg.get("compile_encoders", False)  # torch.compile the encoders and projectors
+        compile_buckets = cfg.get("compile_buckets", [1, 2, 4, 8, 16])  # batch sizes that get compiled
+        compile_mode = cfg.get("compile_mode", None)
+        compile_modules = cfg.get("compile_modules", ["vision", "audio", "projector"])
+        compile_cache_dir = cfg.get("compile_cache_dir", None)
+        concurrent_encoders = cfg.get("concurrent_encoders", False)  # run the image and audio encoders together
+        vit_sdpa = cfg.get("vit_sdpa", False)  # fused attention in the EVA ViT
+        img_token_budget = cfg.get("img_token_budget", 0)  # max visual tokens per image, 0 disables token merging
+        segment_cache_size = cfg.get("segment_cache_size", 0)  # cached prompt segments, 0 disables the cache
+        segment_cache_mb = cfg.get("segment_cache_mb", 64)
+        share_prefix = cfg.get("share_prefix", False)
+        draft_model = cfg.get("draft_model", "")  # small LLM with the same vocabulary, enables speculative decoding
+        num_draft_tokens = cfg.get("num_draft_tokens", 4)
+        # build on the meta device, each weight is then created on device from its checkpoint
+        meta_init = cfg.get("meta_init", False)
+
         model = cls(
             vision_model=vision_model,
             audio_model=audio_model,
@@ -182,27 +386,67 @@ class OmniMod(OmniModBase):
             chat_template=chat_template,
             use_grad_checkpoint_llm=use_grad_checkpoint_llm,
             max_context_len=max_context_len,
+            meta_init=meta_init,
+            device=device if meta_init else None,
         )
+        model.share_prefix = share_prefix
+        if vit_sdpa:
+            model.enable_vit_sdpa()
+        if img_token_budget > 0:
+            model.enable_token_merging(img_token_budget)
+        if audio_variable_length:
+            model.audio_encoder.set_variable_length(True, bucket_frames=audio_bucket_frames)
+        model.audio_encoder.set_chunking(overlap_frames=audio_window_overlap, max_tokens=max_audio_tokens,
+                                         window_batch_size=audio_window_batch_size)
+        if segment_cache_size > 0:
+            model.enable_segment_cache(max_entries=segment_cache_size, max_mb=segment_cache_mb)
+        if draft_model:
+            model.enable_speculative(draft_model, num_draft_tokens=num_draft_tokens)
 
         ckpt_path = cfg.get("ckpt", "")  # load weights of MiniGPT-4
         if ckpt_path:
             print("Load Model Checkpoint: {}".format(ckpt_path))
-            ckpt = torch.load(ckpt_path, map_location="cpu")
-            msg = model.load_state_dict(ckpt['model'], strict=False)
-
-            if os.path.basename(ckpt_path) == "checkpoint_stage3.pth" and "llama" in language_model:
-                with torch.no_grad():
-                    for name, param in model.named_parameters():
-                        name = name.replace("language_model", "llama_model")
-                        name = name.replace("default.", "")
-                        if ckpt['model'].get(name, None) is not None:
-                            param.copy_(ckpt['model'][name])
-                            
-                    if vision_model == "eva_clip_g":
-                        model.language_proj.weight.copy_(ckpt['model']['llama_proj.weight'])
-                        model.language_proj.bias.copy_(ckpt['model']['llama_proj.bias'])
-                    else:
-                        model.language_proj[-1].weight.copy_(ckpt['model']['llama_proj.weight'])
-                        model.language_proj[-1].bias.copy_(ckpt['model']['llama_proj.bias'])
+            key_map = None
+            if os.path.splitext(os.path.basename(ckpt_path))[0] == "checkpoint_stage3" and "llama" in language_model:
+                key_map = stage3_key_map(model)
+            msg = load_weights(model, ckpt_path, key_map=key_map, device=device)
+        if meta_init:
+            # what no checkpoint provided (e.g. the projectors when training from scratch) is initialized here
+            materialize(model, device or "cpu")
+            logging.info("Model built with meta_init, peak host memory {:.1f} MB".format(peak_rss_mb()))
+
+        if inference_profile == "cpu_int8":
+            model.enable_cpu_inference(int8=True, encoder_dtype=cpu_encoder_dtype, num_threads=cpu_threads)
+        elif inference_profile == "cpu_fp32":
+            model.enable_cpu_inference(int8=False, encoder_dtype="fp32", num_threads=cpu_threads)
+
+        if concurrent_encoders:
+            model.enable_concurrent_encoders()
+        if compile_encoders:
+            model.enable_compile(buckets=list(compile_buckets), img_size=img_size, mode=compile_mode,
+                                 cache_dir=compile_cache_dir, modules=list(compile_modules))
+
+        # the keys cover every option the projected tokens depend on, the disk tier outlives a config
+        ckpt_id = "{}@{}".format(ckpt_path, os.path.getmtime(ckpt_path)) if ckpt_path else ""
+        if inference_profile == "cpu_int8" and cpu_encoder_dtype == "auto":
+            cpu_encoder_dtype = "bf16" if bf16_supported() else "fp32"
+        elif inference_profile != "cpu_int8":
+            cpu_encoder_dtype = "fp32"
+        weights = dict(language_model=language_model, ckpt=ckpt_id, precision=precision, low_resource=low_resource,
+                       inference_profile=inference_profile)
+        compiled = set(compile_modules) if compile_encoders else set()
+        if img_cache_mb > 0:
+            namespace = cache_namespace(
+                vision_model=vision_model, img_size=img_size, img_token_budget=img_token_budget, vit_sdpa=vit_sdpa,
+                encoder_dtype=cpu_encoder_dtype, compiled=sorted(compiled & {"vision", "projector"}), **weights)
+            model.enable_img_cache(namespace, max_mb=img_cache_mb, disk_dir=img_cache_dir)
+        if audio_cache_size > 0:
+            namespace = cache_namespace(
+                audio_model=audio_model, variable_length=audio_variable_length,
+                bucket_frames=audio_bucket_frames if audio_variable_length else None,
+                window_overlap=audio_window_overlap, window_batch_size=audio_window_batch_size,
+                max_audio_tokens=max_audio_tokens, compiled=sorted(compiled & {"audio", "projector"}), **weights)
+            model.enable_audio_cache(namespace, max_entries=audio_cache_size, max_mb=audio_cache_mb,
+                                     eviction=audio_cache_eviction, disk_dir=audio_cache_dir)
 
         return model
\ No newline at end of file
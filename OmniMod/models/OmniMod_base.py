@@ -1,15 +1,38 @@
 import logging
 import random
+from threading import Thread
 
 import torch
 from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 from OmniMod.common.registry import registry
 from OmniMod.models.base_model import BaseModel
 from transformers import StoppingCriteria, StoppingCriteriaList
 
-from OmniMod.conversation.conversation import StoppingCriteriaSub
+from OmniMod.conversation.conversation import (
+    BatchTextIteratorStreamer,
+    CancelCriteria,
+    StopSequenceCriteria,
+    stop_string_token_ids,
+)
+from OmniMod.models.embedding_cache import SegmentCache, tensor_digest
+from OmniMod.models.concurrent import ConcurrentRunner
+from OmniMod.models.decoding import (
+    cat_past,
+    decode_from_past,
+    ends_with_stop,
+    expand_past,
+    get_eos_token_ids,
+    get_pad_token_id,
+    left_pad_past,
+    min_new_tokens_for,
+    past_to_tuple,
+    position_ids_from_mask,
+    speculative_decode,
+)
 
 class OmniModBase(BaseModel):
     """
@@ -38,6 +61,8 @@ class OmniModBase(BaseModel):
         lora_target_modules=["q_proj", "v_proj"],
         lora_alpha=16,
         lora_dropout=0.05,
+        meta_init=False,  # build on the meta device and create the weights from their source, on device
+        device=None,
     ):
         super().__init__()
 
@@ -50,6 +75,8 @@ class OmniModBase(BaseModel):
             lora_target_modules=lora_target_modules,
             lora_alpha=lora_alpha,
             lora_dropout=lora_dropout,
+            meta_init=meta_init,
+            device=device,
         )
 
         self.visual_encoder, self.ln_vision, self.num_concat = self.init_vision_encoder(
@@ -58,13 +85,16 @@ class OmniModBase(BaseModel):
             img_size=img_size, 
             drop_path_rate=drop_path_rate, 
             use_checkpoint=use_grad_checkpoint, 
-            precision=precision
+            precision=precision,
+            meta_init=meta_init,
+            device=device,
         )
 
         self.audio_encoder = self.init_audio_encoder(
             audio_model,
             freeze_audio,
-            precision=precision
+            precision=precision,
+            device=device,
         )
 
         self.max_txt_len = max_txt_len
@@ -74,6 +104,209 @@ class OmniModBase(BaseModel):
         self.prompt_template = prompt_template
         self.prompt_list = []
 
+        self.img_cache = None
+        self.audio_cache = None
+        self.segment_cache = None
+        self.share_prefix = False
+
+        # a plain dict, not an attribute: the draft model must not become a submodule, see draft_model
+        self._draft = {"model": None}
+        self.num_draft_tokens = 4
+        self.speculative_counters = {}
+
+        self._stop_tokens = None
+        self.stop_counters = {}
+
+        self.encoder_runner = None
+
+    def train(self, mode=True):
+        # cached embeddings are only valid for the weights they were computed with
+        if mode:
+            self.clear_caches()
+        return super().train(mode)
+
+    def clear_caches(self):
+        if self.img_cache is not None:
+            self.img_cache.clear()
+        if self.audio_cache is not None:
+            self.audio_cache.clear()
+        if self.segment_cache is not None:
+            self.segment_cache.clear()
+
+    def cache_stats(self):
+        stats = {}
+        if self.img_cache is not None:
+            stats["img_cache"] = self.img_cache.stats()
+        if self.audio_cache is not None:
+            stats["audio_cache"] = self.audio_cache.stats()
+        if self.segment_cache is not None:
+            stats["segment_cache"] = self.segment_cache.stats()
+        return stats
+
+    def enable_concurrent_encoders(self):
+        """
+        Run the image and the audio encoder at the same time (threads, and streams on a GPU), and
+        the two towers of a dual vision encoder too.
+        """
+        self.encoder_runner = ConcurrentRunner()
+        if hasattr(self.visual_encoder, "runner"):
+            self.visual_encoder.runner = ConcurrentRunner()
+
+    def concurrency_stats(self):
+        if self.encoder_runner is None:
+            return {}
+        stats = {"encoders": self.encoder_runner.stats()}
+        if getattr(self.visual_encoder, "runner", None) is not None:
+            stats["vision_towers"] = self.visual_encoder.runner.stats()
+        return {"concurrency": stats}
+
+    def encode_multimodal(self, images=None, audios=None):
+        """
+        (img_embeds, img_atts), (audio_embeds, audio_atts) of a batch, (None, None) for what is
+        not given. The two encoders are independent and run concurrently when enabled.
+        """
+        if self.encoder_runner is not None and images is not None and audios is not None:
+            return self.encoder_runner.run([lambda: self.encode_img(images), lambda: self.encode_audio(audios)],
+                                           images.device)
+        img = self.encode_img(images) if images is not None else (None, None)
+        audio = self.encode_audio(audios) if audios is not None else (None, None)
+        return img, audio
+
+    @property
+    def draft_model(self):
+        """
+        The draft model of speculative decoding, kept outside the module tree: its weights are not
+        in state_dict() and checkpoints, and model-wide .to()/.half()/.float() leave it alone.
+        generate_speculative moves it to the device of the language model inputs.
+        """
+        return self._draft["model"]
+
+    def set_draft_model(self, draft_model):
+        self._draft["model"] = draft_model
+
+    def enable_speculative(self, draft_model_path, num_draft_tokens=4):
+        self.set_draft_model(self.init_draft_llm(draft_model_path).to(self.device))
+        self.num_draft_tokens = num_draft_tokens
+
+    def speculative_stats(self):
+        counters = self.speculative_counters
+        if not counters.get("sequences"):
+            return {}
+        decode_seconds = counters.get("draft_seconds", 0.0) + counters["verify_seconds"]
+        # one verify forward costs about as much as one plain decoding step, since decoding is bound by
+        # reading the weights, so plain decoding would have taken about one verify forward per token
+        verify_forwards = counters.get("verify_steps", 0) + counters["sequences"]
+        plain_seconds = counters["generated"] * counters["verify_seconds"] / verify_forwards
+        return {"speculative": {
+            "sequences": counters["sequences"],
+            "generated": counters["generated"],
+            "drafted": counters.get("drafted", 0),
+            "accepted": counters.get("accepted", 0),
+            "acceptance_rate": round(counters.get("accepted", 0) / max(counters.get("drafted", 0), 1), 4),
+            "tokens_per_verify": round(counters["generated"] / verify_forwards, 3),
+            "draft_seconds": round(counters.get("draft_seconds", 0.0), 3),
+            "verify_seconds": round(counters["verify_seconds"], 3),
+            "estimated_speedup": round(plain_seconds / max(decode_seconds, 1e-9), 3),
+        }}
+
+    def get_stop_tokens(self):
+        """
+        Stop token ids and stop token sequences for the loaded tokenizer: the eos ids of the
+        language model plus the encodings of end_sym and the eos string. With Llama-3 the answers
+        are trained to end with end_sym "</s>", which is plain text made of several tokens there.
+        """
+        if self._stop_tokens is None:
+            tokenizer = self.language_tokenizer
+            stop_ids = get_eos_token_ids(self.language_model, tokenizer)
+            stop_sequences = []
+            for stop_string in [self.end_sym, tokenizer.eos_token]:
+                if not stop_string:
+                    continue
+                for ids in stop_string_token_ids(tokenizer, stop_string):
+                    if len(ids) == 1 and ids[0] not in stop_ids:
+                        stop_ids.append(ids[0])
+                    elif len(ids) > 1 and ids not in stop_sequences:
+                        stop_sequences.append(ids)
+            self._stop_tokens = (stop_ids, stop_sequences)
+        return self._stop_tokens
+
+    def get_stopping_criteria(self, stop_words_ids=None):
+        stop_ids, stop_sequences = self.get_stop_tokens()
+        return StopSequenceCriteria(stop_ids + list(stop_words_ids or []), stop_sequences)
+
+    def update_stop_counters(self, stats):
+        for key, value in stats.items():
+            self.stop_counters[key] = self.stop_counters.get(key, 0) + value
+
+    def stop_stats(self):
+        counters = self.stop_counters
+        if not counters.get("sequences"):
+            return {}
+        total = counters["generated"] + counters["wasted"]
+        return {"stop": dict(counters, wasted_fraction=round(counters["wasted"] / max(total, 1), 4))}
+
+    def use_cache_for(self, cache):
+        # caching is inference only, training needs the graph through the encoders
+        return cache is not None and not self.training
+
+    def cached_encode(self, cache, inputs, encode_fn):
+        """
+        Encode a batch through encode_fn, reusing cached rows and only running the encoder on
+        the rows that are not cached yet. Identical rows within the batch are encoded once.
+        """
+        device = inputs.device
+        keys = [cache.key(x) for x in inputs]
+        embeds = {}
+        for key in keys:
+            if key not in embeds:
+                embeds[key] = cache.get(key)
+
+        missing = [key for key, embed in embeds.items() if embed is None]
+        if missing:
+            first_row = {}
+            for i, key in enumerate(keys):
+                first_row.setdefault(key, i)
+            rows = torch.tensor([first_row[key] for key in missing], device=device)
+            new_embeds, new_atts = encode_fn(inputs[rows])
+            # rows are cached without their padding, variable length audio has a length per question
+            for key, embed, length in zip(missing, new_embeds, new_atts.sum(1).tolist()):
+                cache.put(key, embed[:length])
+                embeds[key] = embed[:length]
+
+        outputs = pad_sequence([embeds[key].to(device) for key in keys], batch_first=True)
+        lengths = torch.tensor([len(embeds[key]) for key in keys], device=device)
+        atts = (torch.arange(outputs.shape[1], device=device)[None] < lengths[:, None]).long()
+        return outputs, atts
+
+    def tokenize_segments(self, segments, add_special_tokens=False):
+        """Token ids of each prompt segment, from the segment cache when possible."""
+        tokenize_fn = lambda texts: self.language_tokenizer(texts, add_special_tokens=add_special_tokens).input_ids
+        if self.segment_cache is None:
+            return tokenize_fn(segments)
+        return self.segment_cache.token_ids(segments, add_special_tokens, tokenize_fn)
+
+    def enable_segment_cache(self, max_entries=4096, max_mb=64):
+        self.segment_cache = SegmentCache(max_entries=max_entries, max_bytes=int(max_mb * (1 << 20)))
+
+    def embed_token_ids(self, token_ids, device):
+        """Embeddings [1, T, H] of a list of token ids, see embed_segments."""
+        return self.embed_segments([token_ids], device)[None]
+
+    def embed_segments(self, segments, device):
+        """
+        Embeddings [N, H] of the token id lists in segments, concatenated. In eval mode with a frozen
+        embedding table they are served from the segment cache; the misses, or all of the segments
+        otherwise, are embedded with one embed_tokens call.
+        """
+        weight = self.language_model.get_input_embeddings().weight
+        # training prompts mostly carry per-sample text (the question), they are not cached even for a frozen table
+        if not self.use_cache_for(self.segment_cache) or weight.requires_grad or not segments:
+            return self.embed_tokens(torch.tensor([t for ids in segments for t in ids], dtype=torch.long, device=device))
+        embed_fn = lambda missing: self.embed_tokens(
+            torch.tensor([t for ids in missing for t in ids], dtype=torch.long, device=weight.device))
+        embeds = self.segment_cache.embeddings([tuple(ids) for ids in segments], weight, embed_fn)
+        return torch.cat(embeds).to(device)
+
     def vit_to_cpu(self):
         self.ln_vision.to("cpu")
         self.ln_vision.float()
@@ -84,12 +317,10 @@ class OmniModBase(BaseModel):
         device = img_list[0].device
         prompt_segs = prompt.split('<ImageHere>')
         assert len(prompt_segs) == len(img_list) + 1, "Unmatched numbers of image placeholders and images."
-        seg_tokens = [
-            self.language_tokenizer(
-                seg, return_tensors="pt", add_special_tokens=i==0).to(device).input_ids # only add bos to the first seg
-            for i, seg in enumerate(prompt_segs)
-        ]
-        seg_embs = [self.embed_tokens(seg_t) for seg_t in seg_tokens]
+        # only add bos to the first seg
+        seg_tokens = self.tokenize_segments(prompt_segs[:1], add_special_tokens=True) + \
+            self.tokenize_segments(prompt_segs[1:], add_special_tokens=False)
+        seg_embs = [self.embed_token_ids(seg_t, device) for seg_t in seg_tokens]
 
         # mixed_embs = [emb for pair in zip(seg_embs[:-1], img_list) for emb in pair] + [seg_embs[-1], audio[0].to(self.device)] # [audio]
         # mixed_embs = torch.cat(mixed_embs, dim=1)
@@ -105,7 +336,7 @@ class OmniModBase(BaseModel):
         mixed_embs = torch.cat(mixed_embs, dim=1)
         return mixed_embs
         
-    def prompt_wrap(self, img_embeds, audio_embeds, img_atts, prompts, lengths=None):
+    def prompt_wrap(self, img_embeds, audio_embeds, img_atts, prompts, lengths=None, audio_atts=None):
         if prompts is None or len(prompts) == 0:
             # print("Prompt case")
             # If prompts are not provided, combine image and audio embeddings if available
@@ -148,172 +379,185 @@ class OmniModBase(BaseModel):
             return prompt_embeds, atts_prompt
         else:
             # return the multi-modal embedding in right padding
-            emb_lists = []
             if isinstance(prompts, str):
                 prompts = [prompts] * len(img_embeds)
+            return self.wrap_multimodal(img_embeds, audio_embeds, prompts, lengths, audio_atts)
 
-            if audio_embeds is None:
-
-                for idx, (each_img_embed, each_prompt) in enumerate(zip(img_embeds, prompts)):
-                    pn = each_img_embed.shape[-2]
-                    if lengths is not None:
-                        each_img_embed = each_img_embed.reshape(-1, each_img_embed.shape[-1])
-                        each_img_embed = each_img_embed[:lengths[idx] * pn]
-                    p_segs = each_prompt.split('<ImageHere>')
-                    interleave_emb = []
-                    for idx, seg in enumerate(p_segs[:-1]):
-                        p_tokens = self.language_tokenizer(
-                            seg, return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                        p_embed = self.embed_tokens(p_tokens.input_ids)
-                        interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, idx * pn:(idx + 1) * pn]], dim=1))
-                    wrapped_emb = torch.cat(interleave_emb, dim=1)
-                    p_tokens = self.language_tokenizer(
-                        p_segs[-1], return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                    p_embed = self.embed_tokens(p_tokens.input_ids)
-                    wrapped_emb = torch.cat([wrapped_emb, p_embed], dim=1)
-                    emb_lists.append(wrapped_emb)
-            else:
-                
-                for idx, (each_img_embed, each_prompt, each_audio_embed) in enumerate(zip(img_embeds, prompts, audio_embeds)):
-                    pn = each_img_embed.shape[-2]
-                    # aund = each_audio_embed.shape[-2]
-                    # each_audio_embed = each_audio_embed.unsqueeze(0)
-
-                    # print('Each sample: ', each_img_embed, each_prompt, each_audio_embed)
-                    # print('pn: ', pn, 'aund: ', aund)
-                    if lengths is not None:
-                        each_img_embed = each_img_embed.reshape(-1, each_img_embed.shape[-1])
-                        each_img_embed = each_img_embed[:lengths[idx] * pn]
-                    p_segs = each_prompt.split('<ImageHere>')
-                    interleave_emb = []
-                    # print('p_segs: ', p_segs)
-
-                    for inner_idx, seg in enumerate(p_segs[:-1]):
-                        # print('seg: ', seg)
-                        # print('each_img_embed[None][:, idx * pn:(idx + 1) * pn]: ', each_img_embed[None][:, idx * pn:(idx + 1) * pn])
-                        p_tokens = self.language_tokenizer(seg, return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                        p_embed = self.embed_tokens(p_tokens.input_ids)
-                        # print('Shape: ', p_embed.shape, each_img_embed[None][:, idx * pn:(idx + 1) * pn].shape, each_audio_embed.shape)
-                        interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, inner_idx * pn:(inner_idx + 1) * pn]], dim=1))
-
-                        # interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, idx * pn:(idx + 1) * pn], each_audio_embed], dim=1))
-                    wrapped_emb = torch.cat(interleave_emb, dim=1)
-                    p_tokens = self.language_tokenizer(p_segs[-1], return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                    p_embed = self.embed_tokens(p_tokens.input_ids)
-
-                    each_audio_embed = each_audio_embed.unsqueeze(0)
-                    # print('Shape: ', wrapped_emb.shape, p_embed.shape, each_audio_embed.shape)
-
-                    # each_audio_embed will be of shape [1, audio_embedding_dim]
-                    if each_audio_embed is None:
-                        wrapped_emb = torch.cat([wrapped_emb, p_embed], dim=1)
-                    else:
-                        wrapped_emb = torch.cat([wrapped_emb, p_embed, each_audio_embed], dim=1)
-                    
-                    emb_lists.append(wrapped_emb)
-
-            emb_lens = [emb.shape[1] for emb in emb_lists]
-            pad_emb = self.embed_tokens(torch.tensor(self.language_tokenizer.pad_token_id, device=img_embeds.device))
-
-            max_length = max(emb_lens) if max(emb_lens) < self.max_context_len else self.max_context_len
-            wrapped_embs = pad_emb.expand(len(emb_lens), max_length, -1).clone()
-            wrapped_atts = torch.zeros([len(emb_lens), max_length], dtype=torch.int, device=img_embeds.device)
-            
-            for i, emb in enumerate(emb_lists):
-                length = emb_lens[i] if emb_lens[i] < self.max_context_len else self.max_context_len
-                wrapped_embs[i, :length] = emb[:, :length]
-                wrapped_atts[i, :length] = 1
-            return wrapped_embs, wrapped_atts
+    def wrap_multimodal(self, img_embeds, audio_embeds, prompts, lengths=None, audio_atts=None):
+        """
+        Interleave each prompt with its image embeddings at <ImageHere>, append its audio embeddings
+        and right pad the batch. The prompt segments of the whole batch are tokenized in one call and
+        each distinct segment is embedded once, through the segment cache (see embed_segments); the
+        text, image and audio rows are then scattered into the padded buffer through index maps built
+        on the host and copied to the device at once.
+        Only the first audio_atts.sum() audio rows of a sample are used when audio_atts is given.
+        """
+        device = img_embeds.device
+        batch_size = len(prompts)
+        pn = img_embeds.shape[-2]
+        img_rows = img_embeds.reshape(batch_size, -1, img_embeds.shape[-1])
+
+        segments = [prompt.split('<ImageHere>') for prompt in prompts]
+        seg_ids = self.tokenize_segments([seg for segs in segments for seg in segs], add_special_tokens=False)
+        if audio_embeds is not None:
+            audio_lens = audio_atts.sum(1).tolist() if audio_atts is not None else [audio_embeds.shape[1]] * batch_size
+
+        # (batch, source, position) of every text token, image row and audio row; the source of a
+        # text token is its row in the embeddings of the distinct segments
+        segment_offsets = {}
+        text_b, text_src, text_pos = [], [], []
+        img_b, img_src, img_pos = [], [], []
+        audio_b, audio_src, audio_pos = [], [], []
+        emb_lens = []
+        seg_idx = 0
+        for b, segs in enumerate(segments):
+            num_img_rows = img_rows.shape[1] if lengths is None else min(int(lengths[b]) * pn, img_rows.shape[1])
+            pos = 0
+            for j in range(len(segs)):
+                ids = tuple(seg_ids[seg_idx])
+                seg_idx += 1
+                if ids not in segment_offsets:
+                    segment_offsets[ids] = sum(len(key) for key in segment_offsets)
+                text_b.extend([b] * len(ids))
+                text_src.extend(range(segment_offsets[ids], segment_offsets[ids] + len(ids)))
+                text_pos.extend(range(pos, pos + len(ids)))
+                pos += len(ids)
+                if j < len(segs) - 1:
+                    start, end = j * pn, min((j + 1) * pn, num_img_rows)
+                    if end > start:
+                        img_b.extend([b] * (end - start))
+                        img_src.extend(range(start, end))
+                        img_pos.extend(range(pos, pos + end - start))
+                        pos += end - start
+            if audio_embeds is not None:
+                num_audio_rows = audio_lens[b]
+                audio_b.extend([b] * num_audio_rows)
+                audio_src.extend(range(num_audio_rows))
+                audio_pos.extend(range(pos, pos + num_audio_rows))
+                pos += num_audio_rows
+            emb_lens.append(pos)
+
+        max_length = max(emb_lens) if max(emb_lens) < self.max_context_len else self.max_context_len
+        index_maps = [[text_b, text_src, text_pos], [img_b, img_src, img_pos], [audio_b, audio_src, audio_pos]]
+        if max(emb_lens) > max_length:
+            # drop what falls beyond max_context_len
+            for maps in index_maps:
+                keep = [i for i, pos in enumerate(maps[2]) if pos < max_length]
+                maps[:] = [[index[i] for i in keep] for index in maps]
+        sizes = [len(maps[0]) for maps in index_maps]
+        flat_index = [x for maps in index_maps for x in maps]
+        flat_index = torch.tensor([x for index in flat_index for x in index] + emb_lens, dtype=torch.long).to(device)
+        (text_b, text_src, text_pos, img_b, img_src, img_pos, audio_b, audio_src, audio_pos, emb_lens) = \
+            torch.split(flat_index, [size for size in sizes for _ in range(3)] + [batch_size])
+
+        pad_emb = self.embed_token_ids([self.language_tokenizer.pad_token_id], device)[0, 0]
+        wrapped_embs = pad_emb.expand(batch_size, max_length, -1).clone()
+        segment_embs = self.embed_segments(list(segment_offsets), device)
+        wrapped_embs[text_b, text_pos] = segment_embs[text_src].to(wrapped_embs.dtype)
+        wrapped_embs[img_b, img_pos] = img_rows[img_b, img_src].to(wrapped_embs.dtype)
+        if audio_embeds is not None:
+            wrapped_embs[audio_b, audio_pos] = audio_embeds[audio_b, audio_src].to(wrapped_embs.dtype)
+        wrapped_atts = (torch.arange(max_length, device=device)[None] < emb_lens[:, None]).int()
+        return wrapped_embs, wrapped_atts
+
+    def positions(self, length, device):
+        """arange(length) on device, kept across steps instead of being rebuilt for every batch."""
+        cached = getattr(self, "_positions", None)
+        if cached is None or cached.device != device or len(cached) < length:
+            self._positions = torch.arange(max(length, 1024), device=device)
+        return self._positions[:length]
 
     def concat_emb_input_output(self, input_embs, input_atts, output_embs, output_atts):
         """
         Concatenate the batched input embedding and batched output embedding together.
         Both the input and the output embedding should be right padded.
+
+        Row i is input_embs[i][:input_len], output_embs[i], input_embs[i][input_len:]. All rows are
+        built at once by writing the input and output vectors to their target positions, with the
+        input lengths computed in one reduction and kept on the device (no per-row host sync).
         """
-        input_lens = []
-        cat_embs = []
-        cat_atts = []
-        for i in range(input_embs.size(0)):
-            input_len = input_atts[i].sum()
-            input_lens.append(input_len)
-            cat_embs.append(
-                torch.cat([
-                    input_embs[i][:input_len],
-                    output_embs[i],
-                    input_embs[i][input_len:]
-                ])
-            )
-            cat_atts.append(
-                torch.cat([
-                    input_atts[i][:input_len],
-                    output_atts[i],
-                    input_atts[i][input_len:]
-                ])
-            )
-        cat_embs = torch.stack(cat_embs)
-        cat_atts = torch.stack(cat_atts)
+        batch_size, input_len, hidden = input_embs.shape
+        output_len = output_embs.shape[1]
+        device = input_embs.device
+
+        input_lens = input_atts.sum(dim=1)
+        input_pos = self.positions(input_len, device)[None].expand(batch_size, -1)
+        # the padding of the input moves behind the output
+        input_pos = input_pos + (input_pos >= input_lens[:, None]) * output_len
+        output_pos = input_lens[:, None] + self.positions(output_len, device)[None]
+
+        rows = self.positions(batch_size, device)[:, None]
+
+        cat_embs = input_embs.new_empty(
+            [batch_size, input_len + output_len, hidden], dtype=torch.promote_types(input_embs.dtype, output_embs.dtype))
+        cat_embs[rows, input_pos] = input_embs.to(cat_embs.dtype)
+        cat_embs[rows, output_pos] = output_embs.to(cat_embs.dtype)
+
+        cat_atts = input_atts.new_empty(
+            [batch_size, input_len + output_len], dtype=torch.promote_types(input_atts.dtype, output_atts.dtype))
+        cat_atts[rows, input_pos] = input_atts.to(cat_atts.dtype)
+        cat_atts[rows, output_pos] = output_atts.to(cat_atts.dtype)
         return cat_embs, cat_atts, input_lens
 
+    def build_targets(self, part_targets, input_lens, length):
+        """Labels [B, length]: part_targets placed right after the bos and the input of each row, -100 elsewhere."""
+        targets = torch.full([part_targets.shape[0], length], -100, dtype=torch.long, device=part_targets.device)
+        target_pos = input_lens[:, None] + 1 + self.positions(part_targets.shape[1], part_targets.device)[None]  # plus 1 for bos
+        return targets.scatter_(1, target_pos, part_targets.long())
+
     def tokenize_conversation(self, conv_q, conv_a):
         """concatenate conversation and make sure the model is only trained to regress the answer"""
-
-        to_regress_token_ids_list = []
-        targets_list = []
-
-        batch_size = len(conv_q)
-        for batch_idx in range(batch_size):
-            questions, answers = conv_q[batch_idx], conv_a[batch_idx]
-            questions = [self.language_tokenizer(self.language_tokenizer.bos_token + q,
-                                              return_tensors="pt",
-                                              add_special_tokens=False).to(self.device) for q in questions[1:]]  # the first question is handled in the prompt wrap function, skip it
-            answers = [self.language_tokenizer(a + self.end_sym,
-                                            return_tensors="pt",
-                                            add_special_tokens=False).to(self.device) for a in answers]
-            cur_id = []
-            cur_target = []
-            for i in range(len(questions)):
-                cur_id.append(answers[i].input_ids)
-                cur_target.append(answers[i].input_ids)
-                cur_id.append(questions[i].input_ids)
-                cur_target.append(torch.ones_like(questions[i].input_ids) * -100)
-
-            cur_id.append(answers[-1].input_ids)
-            cur_target.append(answers[-1].input_ids)
-
-            cur_id = torch.cat(cur_id, dim=1)
-            cur_target = torch.cat(cur_target, dim=1)
-            to_regress_token_ids_list.append(cur_id)
-            targets_list.append(cur_target)
-
-        max_len = min(max([target.shape[1] for target in targets_list]), self.max_txt_len)
-        to_regress_token_ids = torch.ones([batch_size, max_len],
-                                          dtype=cur_id.dtype, device=self.device) * self.language_tokenizer.pad_token_id
-        targets = torch.ones([batch_size, max_len],
-                                          dtype=cur_id.dtype, device=self.device) * -100
-        for batch_idx in range(batch_size):
-            cur_len = to_regress_token_ids_list[batch_idx].shape[1]
-            to_regress_token_ids[batch_idx, :cur_len] = to_regress_token_ids_list[batch_idx][0, :max_len]
-            targets[batch_idx, :cur_len] = targets_list[batch_idx][0, :max_len]
-
-        to_regress_token_attn = (to_regress_token_ids != self.language_tokenizer.pad_token_id).to(torch.int)
+        tokenizer = self.language_tokenizer
+
+        # every turn of the batch goes through the tokenizer in one call
+        texts, turns = [], []
+        for questions, answers in zip(conv_q, conv_a):
+            # the first question is handled in the prompt wrap function, skip it
+            questions = questions[1:]
+            turns.append(len(questions))
+            texts.extend(tokenizer.bos_token + q for q in questions)
+            texts.extend(answers[i] + self.end_sym for i in range(len(questions)))
+            texts.append(answers[-1] + self.end_sym)
+        token_ids = tokenizer(texts, add_special_tokens=False).input_ids
+
+        # answers are regressed, questions are masked out: a_0 q_1 a_1 ... q_n a_n
+        ids_list, question_mask_list = [], []
+        offset = 0
+        for num_questions in turns:
+            question_ids = token_ids[offset:offset + num_questions]
+            answer_ids = token_ids[offset + num_questions:offset + 2 * num_questions + 1]
+            offset += 2 * num_questions + 1
+
+            cur_ids, cur_mask = [], []
+            for answer, question in zip(answer_ids, question_ids):
+                cur_ids += answer + question
+                cur_mask += [False] * len(answer) + [True] * len(question)
+            cur_ids += answer_ids[-1]
+            cur_mask += [False] * len(answer_ids[-1])
+            ids_list.append(cur_ids)
+            question_mask_list.append(cur_mask)
+
+        max_len = min(max(len(ids) for ids in ids_list), self.max_txt_len)
+        pad_id = tokenizer.pad_token_id
+        # right pad on the host, then a single copy to the device; padding is marked like a question
+        ids = [(cur_ids + [pad_id] * max_len)[:max_len] for cur_ids in ids_list]
+        masks = [[int(m) for m in (cur_mask + [True] * max_len)[:max_len]] for cur_mask in question_mask_list]
+        packed = torch.tensor([ids, masks], dtype=torch.long).to(self.device)
+        to_regress_token_ids, ignore = packed[0], packed[1].bool()
+
+        targets = to_regress_token_ids.masked_fill(ignore, -100)
+        to_regress_token_attn = (to_regress_token_ids != pad_id).to(torch.int)
 
         return to_regress_token_ids, to_regress_token_attn, targets
 
     def preparing_embedding(self, samples):
         ### prepare input tokens
-        if "audio" in samples and "instruction_input" in samples:
-            # for instruction_input in samples["instruction_input"]:
-            #     if not instruction_input.endswith("<Img><ImageHere></Img>"):
-            #         raise ValueError("You cannot specify both audio and instruction_input at the same time")
-            audio_embeds, audio_atts = self.encode_audio(samples["audio"])
-
-        else:
-            audio_embeds, audio_atts = None, None
-
-        if 'image' in samples:
-            img_embeds, img_atts = self.encode_img(samples["image"])
-        else:
-            img_embeds = img_atts = None
+        # for instruction_input in samples["instruction_input"]:
+        #     if not instruction_input.endswith("<Img><ImageHere></Img>"):
+        #         raise ValueError("You cannot specify both audio and instruction_input at the same time")
+        audios = samples["audio"] if "audio" in samples and "instruction_input" in samples else None
+        images = samples["image"] if 'image' in samples else None
+        (img_embeds, img_atts), (audio_embeds, audio_atts) = self.encode_multimodal(images, audios)
 
         if 'conv_q' in samples:
             # handeling conversation datasets
@@ -325,7 +569,8 @@ class OmniModBase(BaseModel):
 
             conv_q = [[self.prompt_template.format(item) for item in items] for items in conv_q]
 
-            cond_embeds, cond_atts = self.prompt_wrap(img_embeds, img_atts, [q[0] for q in conv_q])
+            cond_embeds, cond_atts = self.prompt_wrap(img_embeds, audio_embeds, img_atts, [q[0] for q in conv_q],
+                                                      audio_atts=audio_atts)
             regress_token_ids, regress_atts, part_targets = self.tokenize_conversation(conv_q, conv_a)
 
         else:
@@ -344,10 +589,12 @@ class OmniModBase(BaseModel):
                 # the input is a image train (like videos)
                 bsz, pn, hs = img_embeds.shape
                 img_embeds = img_embeds.reshape(len(samples['image']), -1, pn, hs)
-                cond_embeds, cond_atts = self.prompt_wrap(img_embeds, audio_embeds, img_atts, instruction, samples['length'])
+                cond_embeds, cond_atts = self.prompt_wrap(img_embeds, audio_embeds, img_atts, instruction, samples['length'],
+                                                          audio_atts=audio_atts)
             else:
                 # print('Our input: ', img_embeds, audio_embeds, img_atts, instruction)
-                cond_embeds, cond_atts = self.prompt_wrap(img_embeds, audio_embeds, img_atts, instruction)
+                cond_embeds, cond_atts = self.prompt_wrap(img_embeds, audio_embeds, img_atts, instruction,
+                                                          audio_atts=audio_atts)
 
             ### prepare target tokens
             self.language_tokenizer.padding_side = "right"
@@ -391,11 +638,7 @@ class OmniModBase(BaseModel):
         attention_mask = torch.cat([bos_atts, attention_mask], dim=1)
 
         # ensemble the final targets
-        targets = torch.ones([inputs_embeds.shape[0], inputs_embeds.shape[1]],
-                             dtype=torch.long).to(self.device).fill_(-100)
-
-        for i, target in enumerate(part_targets):
-            targets[i, input_lens[i]+1:input_lens[i]+len(target)+1] = target  # plus 1 for bos
+        targets = self.build_targets(part_targets, input_lens, inputs_embeds.shape[1])
 
         with self.maybe_autocast():
             outputs = self.language_model(
@@ -430,7 +673,9 @@ class OmniModBase(BaseModel):
         length_penalty=1,
         temperature=1,
         do_sample=False,
-        stop_words_ids=[2],
+        stop_words_ids=None,
+        share_prefix=None,
+        speculative=None,
     ):
         '''
             function for generate test use
@@ -443,45 +688,41 @@ class OmniModBase(BaseModel):
         if images is not None and texts is None:
             raise ValueError("You must specify <Img><ImageHere></Img> in the text")
         
-        stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(
-            stops=[torch.tensor([i]).to(self.device) for i in stop_words_ids])])
-
-        # img_embeds, atts_img = self.encode_img(images.to(self.device))
-
-        # image_lists = [[image_emb[None]] for image_emb in img_embeds]
-
-        # audio_embeds, atts_audio = self.encode_audio(audios.to(self.device))
-        # audio_embeds = [[audio_embed[None]] for audio_embed in audio_embeds]
-
-        # batch_embs = [self.get_context_emb(text, img_list, audio_embed) for text, img_list, audio_embed in zip(texts, image_lists, audio_embeds)]
-        
-        # Process images
-        img_embeds, atts_img = self.encode_img(images.to(self.device)) if images is not None else (None, None)
-        image_lists = [[image_emb[None]] for image_emb in img_embeds] if img_embeds is not None else None
-
-        # Process audios only if audios are provided
-        if audios is not None:
-            audio_embeds, atts_audio = self.encode_audio(audios.to(self.device))
-            audio_embeds = [[audio_embed[None]] for audio_embed in audio_embeds]
-        else:
-            audio_embeds = [None] * len(texts)  # Handle the case where audios is None
-
-        # Generate batch embeddings
-        batch_embs = [self.get_context_emb(text, img_list, audio_embed)
-                    for text, img_list, audio_embed in zip(texts, image_lists, audio_embeds)]
-
-        batch_size = len(batch_embs)
-        max_len = max([emb.shape[1] for emb in batch_embs])
-        emb_dim = batch_embs[0].shape[2]
-        dtype = batch_embs[0].dtype
-        device = batch_embs[0].device
+        # stop_words_ids are extra stop token ids on top of the ones derived from the tokenizer
+        stopping_criteria = self.get_stopping_criteria(stop_words_ids)
+
+        if speculative is None:
+            speculative = self.draft_model is not None
+        if speculative and num_beams == 1 and not do_sample:
+            outputs = self.generate_speculative(
+                images=images,
+                audios=audios,
+                texts=texts,
+                max_new_tokens=max_new_tokens,
+                min_length=min_length,
+                repetition_penalty=repetition_penalty,
+                stopping_criteria=stopping_criteria,
+            )
+            return self.decode_answers(outputs)
+
+        if share_prefix is None:
+            share_prefix = self.share_prefix
+        if share_prefix and num_beams == 1:
+            outputs = self.generate_shared_prefix(
+                images=images,
+                audios=audios,
+                texts=texts,
+                max_new_tokens=max_new_tokens,
+                min_length=min_length,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
+                do_sample=do_sample,
+                stopping_criteria=stopping_criteria,
+            )
+            return self.decode_answers(outputs)
 
-        embs = torch.zeros([batch_size, max_len, emb_dim], dtype=dtype, device=device)
-        attn_mask = torch.zeros([batch_size, max_len], dtype=torch.int, device=device)
-        for i, emb in enumerate(batch_embs):
-            emb_len = emb.shape[1]
-            embs[i, -emb_len:] = emb[0]
-            attn_mask[i, -emb_len:] = 1
+        embs, attn_mask = self.prepare_generation_inputs(images, audios, texts)
 
         with self.maybe_autocast():
             outputs = self.language_model.generate(
@@ -495,8 +736,9 @@ class OmniModBase(BaseModel):
                 min_length=min_length,
                 top_p=top_p,
                 repetition_penalty=repetition_penalty,
-                # stopping_criteria=stopping_criteria,
+                stopping_criteria=StoppingCriteriaList([stopping_criteria]),
             )
+        self.update_stop_counters(stopping_criteria.stats())
 
         # with self.maybe_autocast():
         #     outputs = self.language_model.generate(
@@ -507,18 +749,319 @@ class OmniModBase(BaseModel):
         #         do_sample=do_sample,
         #         # stopping_criteria=stopping_criteria,
         #     )
+        return self.decode_answers(outputs)
+
+    def decode_answers(self, outputs):
         answers = []
         for output_token in outputs:
             if output_token[0] == 0:
                 output_token = output_token[1:]
             output_texts = self.language_tokenizer.decode(output_token, skip_special_tokens=True)
-            output_texts = output_texts.split('</s>')[0]  # remove the stop sign </s>
-            output_texts = output_texts.replace("<s>", "")
-            output_texts = output_texts.split(r'[/INST]')[-1].strip()
-            answers.append(output_texts)
+            answers.append(self.postprocess_generation(output_texts))
 
         return answers
 
+    @torch.no_grad()
+    def generate_shared_prefix(
+        self,
+        images=None,
+        audios=None,
+        texts=None,
+        max_new_tokens=20,
+        min_length=1,
+        top_p=0.9,
+        repetition_penalty=1,
+        temperature=1,
+        do_sample=False,
+        stopping_criteria=None,
+    ):
+        '''
+            generate for batches where several questions are asked about the same image.
+            Requests with the same image and prompt text only differ in their audio question,
+            which is appended at the end of the context. The shared part is prefilled once per
+            group and its key/value cache is forked for the question suffixes. Returns the
+            generated token ids.
+        '''
+        (img_embeds, _), (audio_embeds, atts_audio) = self.encode_multimodal(
+            images.to(self.device) if images is not None else None,
+            audios.to(self.device) if audios is not None else None)
+        if audios is not None:
+            audio_embeds = self.unpad_audio_embeds(audio_embeds, atts_audio)
+        else:
+            audio_embeds = [None] * len(texts)
+
+        groups = {}
+        prefixes, suffixes = [], []
+        for i, text in enumerate(texts):
+            img_list = [img_embeds[i][None]] if img_embeds is not None else []
+            image_key = tensor_digest(images[i]) if images is not None else None
+            group = groups.setdefault((text, image_key), [])
+            if not group:
+                prefixes.append(self.get_context_emb(text, img_list))
+            group.append(i)
+            if audio_embeds[i] is not None:
+                suffixes.append(audio_embeds[i][None].to(prefixes[-1].device))
+            else:
+                suffixes.append(None)
+
+        device = prefixes[0].device
+        group_pasts, group_masks, group_logits, order = [], [], [], []
+        for prefix, members in zip(prefixes, groups.values()):
+            if any(suffixes[i] is None for i in members):
+                # nothing differs after the prefix, keep its last position as the suffix
+                member_suffixes = [prefix[:, -1:] for _ in members]
+                prefix = prefix[:, :-1]
+            else:
+                member_suffixes = [suffixes[i] for i in members]
+
+            with self.maybe_autocast():
+                outputs = self.language_model(inputs_embeds=prefix, use_cache=True, return_dict=True)
+            past = expand_past(past_to_tuple(outputs.past_key_values), len(members))
+
+            # left pad the suffixes, the padding sits between prefix and suffix and is masked out
+            suffix_len = max(suffix.shape[1] for suffix in member_suffixes)
+            suffix_embs = prefix.new_zeros([len(members), suffix_len, prefix.shape[-1]])
+            attention_mask = torch.ones([len(members), prefix.shape[1] + suffix_len], dtype=torch.long, device=device)
+            for j, suffix in enumerate(member_suffixes):
+                suffix_embs[j, suffix_len - suffix.shape[1]:] = suffix[0]
+                attention_mask[j, prefix.shape[1]:prefix.shape[1] + suffix_len - suffix.shape[1]] = 0
+
+            with self.maybe_autocast():
+                outputs = self.language_model(
+                    inputs_embeds=suffix_embs,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids_from_mask(attention_mask)[:, prefix.shape[1]:],
+                    past_key_values=past,
+                    use_cache=True,
+                    return_dict=True,
+                )
+            group_pasts.append(past_to_tuple(outputs.past_key_values))
+            group_masks.append(attention_mask)
+            group_logits.append(outputs.logits[:, -1])
+            order.extend(members)
+
+        # merge the groups into one decoding batch, left padding the shorter contexts
+        max_len = max(mask.shape[1] for mask in group_masks)
+        past = cat_past([left_pad_past(past, max_len) for past in group_pasts])
+        attention_mask = torch.cat([F.pad(mask, (max_len - mask.shape[1], 0)) for mask in group_masks])
+        logits = torch.cat(group_logits)
+
+        eos_token_ids = get_eos_token_ids(self.language_model, self.language_tokenizer)
+        if stopping_criteria is None:
+            stopping_criteria = self.get_stopping_criteria()
+        generated = decode_from_past(
+            self.language_model,
+            past,
+            attention_mask,
+            logits,
+            eos_token_ids=eos_token_ids,
+            pad_token_id=get_pad_token_id(self.language_model, eos_token_ids),
+            max_new_tokens=max_new_tokens,
+            autocast=self.maybe_autocast,
+            repetition_penalty=repetition_penalty,
+            temperature=temperature,
+            top_p=top_p,
+            do_sample=do_sample,
+            # max_len is the length of the left padded contexts generate would get
+            min_new_tokens=min_new_tokens_for(min_length, max_len),
+            stopping_criteria=stopping_criteria,
+        )
+        self.update_stop_counters(stopping_criteria.stats())
+
+        # back to the request order
+        outputs = torch.empty_like(generated)
+        outputs[torch.tensor(order, device=generated.device)] = generated
+        return outputs
+
+    @torch.no_grad()
+    def generate_speculative(
+        self,
+        images=None,
+        audios=None,
+        texts=None,
+        max_new_tokens=20,
+        min_length=1,
+        repetition_penalty=1,
+        stopping_criteria=None,
+    ):
+        '''
+            greedy generate with the draft model proposing tokens for the language model to verify.
+            The draft model cannot read the image and audio tokens, it sees the prompt text without
+            placeholders and the answer so far; this only lowers the acceptance rate, the answers
+            are the same as greedy generate. Sequences are decoded one at a time, returns the
+            generated token ids of each.
+        '''
+        assert self.draft_model is not None, "Call enable_speculative first"
+        context_embs = self.get_generation_context_embs(images, audios, texts)
+        device = context_embs[0].device
+        if next(self.draft_model.parameters()).device != device:
+            self.set_draft_model(self.draft_model.to(device))
+        eos_token_ids = get_eos_token_ids(self.language_model, self.language_tokenizer)
+        if stopping_criteria is None:
+            stopping_criteria = self.get_stopping_criteria()
+
+        # as in generate, min_length counts the context of the padded batch
+        min_new_tokens = min_new_tokens_for(min_length, max(emb.shape[1] for emb in context_embs))
+        outputs = []
+        for text, context_emb in zip(texts, context_embs):
+            draft_input_ids = self.language_tokenizer(text.replace('<ImageHere>', ''), add_special_tokens=True).input_ids
+            generated = speculative_decode(
+                self.language_model,
+                self.draft_model,
+                context_emb,
+                draft_input_ids,
+                eos_token_ids=eos_token_ids,
+                max_new_tokens=max_new_tokens,
+                num_draft_tokens=self.num_draft_tokens,
+                autocast=self.maybe_autocast,
+                repetition_penalty=repetition_penalty,
+                min_new_tokens=min_new_tokens,
+                stop_ids=stopping_criteria.stop_ids,
+                stop_sequences=stopping_criteria.stop_sequences,
+                stats=self.speculative_counters,
+            )
+            outputs.append(torch.tensor(generated, dtype=torch.long))
+            # sequences are decoded on their own, nothing is generated past the stop
+            self.update_stop_counters({
+                "sequences": 1,
+                "generated": len(generated),
+                "wasted": 0,
+                "truncated": int(not ends_with_stop(generated, stopping_criteria.stop_ids,
+                                                    stopping_criteria.stop_sequences)),
+            })
+        return outputs
+
+    def stream_generate(
+        self,
+        images=None,
+        audios=None,
+        texts=None,
+        num_beams=1,
+        max_new_tokens=20,
+        min_length=1,
+        top_p=0.9,
+        repetition_penalty=1,
+        length_penalty=1,
+        temperature=1,
+        do_sample=False,
+        timeout=None,
+    ):
+        '''
+            streaming variant of generate. Returns an iterator that yields, after every decoding step,
+            a list with the newly decoded text of each sequence in the batch. Joining the pieces of a
+            sequence gives the same answer generate returns.
+            An error of the generation is raised by the iterator; call its cancel() to stop the
+            generation early, e.g. when the client went away.
+        '''
+        if num_beams > 1:
+            raise ValueError("Streaming is only supported for greedy decoding and sampling (num_beams=1)")
+        if images is not None and texts is None:
+            raise ValueError("You must specify <Img><ImageHere></Img> in the text")
+
+        with torch.no_grad():
+            embs, attn_mask = self.prepare_generation_inputs(images, audios, texts)
+
+        streamer = BatchTextIteratorStreamer(
+            self.language_tokenizer,
+            batch_size=embs.shape[0],
+            postprocess=self.postprocess_generation,
+            stop_strings=['</s>', r'[/INST]'] + ([self.end_sym] if self.end_sym.strip() else []),
+            timeout=timeout,
+        )
+        generation_kwargs = dict(
+            inputs_embeds=embs,
+            attention_mask=attn_mask,
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            length_penalty=length_penalty,
+            temperature=temperature,
+            do_sample=do_sample,
+            min_length=min_length,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            stopping_criteria=StoppingCriteriaList([self.get_stopping_criteria(), CancelCriteria(streamer)]),
+            streamer=streamer,
+        )
+        thread = Thread(target=self._generate_in_thread, kwargs=generation_kwargs)
+        thread.start()
+        return streamer
+
+    def _generate_in_thread(self, streamer, **kwargs):
+        error = None
+        try:
+            # autocast state is thread local, so it has to be entered inside the generation thread
+            with self.maybe_autocast():
+                self.language_model.generate(streamer=streamer, **kwargs)
+        except Exception as e:
+            logging.exception("Streaming generation failed")
+            error = e
+        finally:
+            # the consumer waits for the end of the stream, it must come even if generate failed
+            streamer.end(error=error)
+
+    def postprocess_generation(self, output_texts):
+        if self.end_sym.strip():
+            # generation stops right after end_sym when it is not a single special token
+            output_texts = output_texts.split(self.end_sym)[0]
+        return self.postprocess_answer(output_texts)
+
+    @staticmethod
+    def postprocess_answer(output_texts):
+        output_texts = output_texts.split('</s>')[0]  # remove the stop sign </s>
+        output_texts = output_texts.replace("<s>", "")
+        output_texts = output_texts.split(r'[/INST]')[-1].strip()
+        return output_texts
+
+    def prepare_generation_inputs(self, images=None, audios=None, texts=None):
+        """
+        Build the left padded context embeddings and attention mask that generate feeds to the language model.
+        """
+        batch_embs = self.get_generation_context_embs(images, audios, texts)
+        return self.pad_context_embs(batch_embs)
+
+    def get_generation_context_embs(self, images=None, audios=None, texts=None):
+        """
+        Context embedding [1, L_i, H] of every request, unpadded.
+        """
+        (img_embeds, atts_img), (audio_embeds, atts_audio) = self.encode_multimodal(
+            images.to(self.device) if images is not None else None,
+            audios.to(self.device) if audios is not None else None)
+        # Process images
+        image_lists = [[image_emb[None]] for image_emb in img_embeds] if img_embeds is not None else None
+
+        # Process audios only if audios are provided
+        if audios is not None:
+            audio_embeds = [[audio_embed[None]] for audio_embed in self.unpad_audio_embeds(audio_embeds, atts_audio)]
+        else:
+            audio_embeds = [None] * len(texts)  # Handle the case where audios is None
+
+        # Generate batch embeddings
+        batch_embs = [self.get_context_emb(text, img_list, audio_embed)
+                    for text, img_list, audio_embed in zip(texts, image_lists, audio_embeds)]
+        return batch_embs
+
+    @staticmethod
+    def unpad_audio_embeds(audio_embeds, atts_audio):
+        """Audio embeddings of each request without the padding of variable length audio."""
+        return [audio_embed[:length] for audio_embed, length in zip(audio_embeds, atts_audio.sum(1).tolist())]
+
+    @staticmethod
+    def pad_context_embs(batch_embs):
+        batch_size = len(batch_embs)
+        max_len = max([emb.shape[1] for emb in batch_embs])
+        emb_dim = batch_embs[0].shape[2]
+        dtype = batch_embs[0].dtype
+        device = batch_embs[0].device
+
+        embs = torch.zeros([batch_size, max_len, emb_dim], dtype=dtype, device=device)
+        attn_mask = torch.zeros([batch_size, max_len], dtype=torch.int, device=device)
+        for i, emb in enumerate(batch_embs):
+            emb_len = emb.shape[1]
+            embs[i, -emb_len:] = emb[0]
+            attn_mask[i, -emb_len:] = 1
+
+        return embs, attn_mask
+
     @torch.no_grad()
     def multi_select(self, images, texts, answers, num_cand=None):
         all_losses = []
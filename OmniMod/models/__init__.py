@@ -6,13 +6,11 @@
 """
 
 import logging
+import importlib
 import torch
 from omegaconf import OmegaConf
 
 from OmniMod.common.registry import registry
-from OmniMod.models.base_model import BaseModel
-from OmniMod.models.OmniMod_base import OmniModBase
-from OmniMod.models.OmniMod import OmniMod
 from OmniMod.processors.base_processor import BaseProcessor
 
 
@@ -20,9 +18,25 @@ __all__ = [
     "load_model",
     "BaseModel",
     "OmniModBase",
-    "OmniMod"
 ]
 
+# the models pull in the vision and audio encoders, they are imported on first use. The OmniMod
+# class is not re-exported: once the registry imports it, OmniMod.models.OmniMod is its module
+_lazy_attributes = {
+    "BaseModel": "OmniMod.models.base_model",
+    "OmniModBase": "OmniMod.models.OmniMod_base",
+}
+
+registry.register_lazy("model_name_mapping", "OmniMod", "OmniMod.models.OmniMod")
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 def load_model(name, model_type, is_eval=False, device="cpu", checkpoint=None):
     """
@@ -169,10 +183,12 @@ class ModelZoo:
     >>> print(len(model_zoo))
     """
 
-    def __init__(self) -> None:
-        self.model_zoo = {
-            k: list(v.PRETRAINED_MODEL_CONFIG_DICT.keys())
-            for k, v in registry.mapping["model_name_mapping"].items()
+    @property
+    def model_zoo(self):
+        # imports every registered model
+        return {
+            k: list(registry.get_model_class(k).PRETRAINED_MODEL_CONFIG_DICT.keys())
+            for k in registry.list_models()
         }
 
     def __str__(self) -> str:
@@ -18,6 +18,7 @@ from peft import (
     prepare_model_for_kbit_training,
 )
 
+from OmniMod.common.checkpoint import load_weights
 from OmniMod.common.dist_utils import download_cached_file
 from OmniMod.common.utils import get_abs_path, is_url
 from .vision_model.builder import build_vision_encoder
@@ -48,18 +49,12 @@ class BaseModel(nn.Module):
             cached_file = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location="cpu")
         elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location="cpu")
+            cached_file = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        if "model" in checkpoint.keys():
-            state_dict = checkpoint["model"]
-        else:
-            state_dict = checkpoint
-
-        msg = self.load_state_dict(state_dict, strict=False)
+        msg = load_weights(self, cached_file)
 
         logging.info("Missing keys {}".format(msg.missing_keys))
         logging.info("load checkpoint from %s" % url_or_filename)
@@ -149,9 +144,12 @@ class BaseModel(nn.Module):
             if precision is not None:
                 kwargs["precision"] = "fp32"  # fp16 is not for training
 
+        device = kwargs.get("device")
         visual_encoder, num_concat = build_vision_encoder(model_name, **kwargs)
 
         ln_vision = LayerNorm(visual_encoder.num_features)
+        if device is not None:
+            visual_encoder, ln_vision = visual_encoder.to(device), ln_vision.to(device)
 
         if freeze:
             for param in visual_encoder.parameters():
@@ -176,7 +174,10 @@ class BaseModel(nn.Module):
             if precision is not None:
                 kwargs["precision"] = "fp32"  # fp16 is not for training
 
+        device = kwargs.pop("device", None)
         audio_encoder = build_audio_encoder(model_name, **kwargs)
+        if device is not None:
+            audio_encoder = audio_encoder.to(device)
 
         if freeze:
             for param in audio_encoder.parameters():
@@ -189,7 +190,7 @@ class BaseModel(nn.Module):
         return audio_encoder
 
     def init_llm(cls, language_model_path, bits=8, low_resource=False, low_res_device=0, lora_r=0,
-                 lora_target_modules=["q_proj","v_proj"], **lora_kargs):
+                 lora_target_modules=["q_proj","v_proj"], meta_init=False, device=None, **lora_kargs):
         logging.info(f'Loading language model at {language_model_path}')
 
   
@@ -217,6 +218,11 @@ class BaseModel(nn.Module):
                     bnb_4bit_quant_type="nf4"
                 )
             ))
+        elif meta_init:
+            # the weights are read shard by shard into an empty model, on device when given
+            model_args["low_cpu_mem_usage"] = True
+            if device is not None:
+                model_args["device_map"] = {"": device}
             
         # model_args = {}
         # if low_resource:
@@ -280,21 +286,33 @@ class BaseModel(nn.Module):
         logging.info(f'Loading language model Done!')
         return model, tokenizer
 
+    @classmethod
+    def init_draft_llm(cls, draft_model_path, torch_dtype=torch.float16):
+        """
+        Small frozen language model for speculative decoding. It must share the vocabulary of
+        the main language model, e.g. Llama-3.2-1B for a Llama-3.1-8B backbone.
+        """
+        from transformers import AutoModelForCausalLM
+
+        logging.info(f'Loading draft language model at {draft_model_path}')
+        model = AutoModelForCausalLM.from_pretrained(draft_model_path, torch_dtype=torch_dtype)
+        for param in model.parameters():
+            param.requires_grad = False
+        model.eval()
+        return model
+
 
     def load_from_pretrained(self, url_or_filename):
         if is_url(url_or_filename):
             cached_file = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location="cpu")
         elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location="cpu")
+            cached_file = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-
-        msg = self.load_state_dict(state_dict, strict=False)
+        msg = load_weights(self, cached_file)
 
         # logging.info("Missing keys {}".format(msg.missing_keys))
         logging.info("load checkpoint from %s" % url_or_filename)
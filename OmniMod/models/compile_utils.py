@@ -0,0 +1,66 @@
+import os
+import logging
+
+import torch
+
+
+def bucket_size(batch_size, buckets):
+    """Smallest bucket that holds batch_size, None when the batch is larger than every bucket."""
+    for bucket in buckets:
+        if bucket >= batch_size:
+            return bucket
+    return None
+
+
+def _slice_batch(outputs, batch_size):
+    if torch.is_tensor(outputs):
+        return outputs[:batch_size]
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(_slice_batch(output, batch_size) for output in outputs)
+    return outputs
+
+
+def compile_bucketed(module, buckets, mode=None, dynamic=False, backend="inductor"):
+    """
+    Compile module.forward for a fixed set of batch sizes. A batch is padded up to the next
+    bucket by repeating its last row and the padded rows are sliced off the outputs, so each
+    bucket is compiled once and later batches never trigger a recompile. Batches larger than
+    the last bucket are run in chunks of it. The forward is replaced in place, which keeps the
+    parameter names of module (and therefore checkpoint loading) unchanged. Use dynamic=None
+    for modules whose other dimensions vary, torch.compile then makes them symbolic after the
+    first recompile. backend is passed to torch.compile, "eager" only captures the graphs.
+    """
+    buckets = sorted(buckets)
+    compiled = torch.compile(module.forward, mode=mode, dynamic=dynamic, backend=backend)
+    # one graph per bucket; the limit is per code object, which modules of the same class share
+    torch._dynamo.config.cache_size_limit += len(buckets) + 1
+
+    def forward(x, *args, **kwargs):
+        batch_size = x.shape[0]
+        bucket = bucket_size(batch_size, buckets)
+        if bucket is None:
+            chunks = [forward(chunk, *args, **kwargs) for chunk in x.split(buckets[-1])]
+            if torch.is_tensor(chunks[0]):
+                return torch.cat(chunks)
+            return type(chunks[0])(torch.cat(outputs) for outputs in zip(*chunks))
+        if bucket > batch_size:
+            x = torch.cat([x, x[-1:].expand(bucket - batch_size, *x.shape[1:])])
+        return _slice_batch(compiled(x, *args, **kwargs), batch_size)
+
+    module.forward = forward
+    module.compile_buckets = buckets
+    return module
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Keep the inductor kernels (and, on PyTorch versions that have it, the compiled FX graphs)
+    in cache_dir so that later runs skip most of the compilation.
+    """
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, "fx_graph_cache"):
+        inductor_config.fx_graph_cache = True
+    logging.info("torch.compile cache in {}".format(os.environ.get("TORCHINDUCTOR_CACHE_DIR", "the default directory")))
@@ -0,0 +1,111 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def _record_stream(outputs, stream):
+    # the outputs were allocated on a side stream and are about to be used on stream
+    if torch.is_tensor(outputs):
+        if outputs.is_cuda:
+            outputs.record_stream(stream)
+    elif isinstance(outputs, (tuple, list)):
+        for output in outputs:
+            _record_stream(output, stream)
+
+
+def _autocast_state(device_type):
+    """(enabled, dtype) of autocast for device_type in the calling thread."""
+    if hasattr(torch, "get_autocast_dtype"):  # torch >= 2.4
+        return torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    if device_type == "cuda":
+        return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+
+
+class ConcurrentRunner:
+    """
+    Runs independent pieces of work at the same time, e.g. the image and the audio encoder.
+
+    Each function runs in a worker thread (PyTorch releases the GIL inside its ops, so on CPU the
+    encoders overlap) and, on a CUDA device, on its own stream that first waits for the work
+    already queued on the current stream. run() joins them: the current stream waits for the
+    side streams, so the results can be used right away. The workers run with the caller's grad
+    mode and autocast state. Busy time (the sum over functions) and wall time of every call are
+    accumulated in counters to show the overlap achieved.
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.streams = {}
+        self.counters = {}
+
+    def _stream(self, device, index):
+        key = (device.index, index)
+        if key not in self.streams:
+            self.streams[key] = torch.cuda.Stream(device=device)
+        return self.streams[key]
+
+    def run(self, fns, device):
+        device = torch.device(device)
+        use_cuda = device.type == "cuda"
+        # grad mode and autocast are thread local, the workers must see the caller's
+        grad_enabled = torch.is_grad_enabled()
+        autocast_enabled, autocast_dtype = _autocast_state(device.type)
+        wall_start = time.perf_counter()
+        if use_cuda:
+            main_stream = torch.cuda.current_stream(device)
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record(main_stream)
+
+        def task(index, fn):
+            with torch.set_grad_enabled(grad_enabled), \
+                    torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_enabled):
+                if not use_cuda:
+                    start = time.perf_counter()
+                    output = fn()
+                    return output, time.perf_counter() - start
+                stream = self._stream(device, index)
+                with torch.cuda.device(device), torch.cuda.stream(stream):
+                    stream.wait_stream(main_stream)
+                    begin, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                    begin.record(stream)
+                    output = fn()
+                    end.record(stream)
+                return output, (begin, end)
+
+        futures = [self.executor.submit(task, index, fn) for index, fn in enumerate(fns)]
+        results = [future.result() for future in futures]
+        outputs = [output for output, _ in results]
+
+        if use_cuda:
+            for index in range(len(fns)):
+                main_stream.wait_stream(self._stream(device, index))
+            _record_stream(outputs, main_stream)
+            stop_event = torch.cuda.Event(enable_timing=True)
+            stop_event.record(main_stream)
+            # the results are consumed right away, so this wait costs next to nothing
+            stop_event.synchronize()
+            busy = sum(begin.elapsed_time(end) for _, (begin, end) in results) / 1000
+            wall = start_event.elapsed_time(stop_event) / 1000
+        else:
+            busy = sum(seconds for _, seconds in results)
+            wall = time.perf_counter() - wall_start
+
+        self.counters["calls"] = self.counters.get("calls", 0) + 1
+        self.counters["busy_seconds"] = self.counters.get("busy_seconds", 0.0) + busy
+        self.counters["wall_seconds"] = self.counters.get("wall_seconds", 0.0) + wall
+        return outputs
+
+    def stats(self):
+        counters = self.counters
+        if not counters.get("calls"):
+            return {}
+        busy, wall = counters["busy_seconds"], counters["wall_seconds"]
+        return {
+            "calls": counters["calls"],
+            "busy_seconds": round(busy, 3),
+            "wall_seconds": round(wall, 3),
+            # share of the serial time saved by running the functions together
+            "overlap": round(max(busy - wall, 0.0) / busy, 4) if busy > 0 else 0.0,
+        }
@@ -0,0 +1,44 @@
+import os
+
+import torch
+import torch.nn as nn
+
+
+def default_num_threads():
+    """Cores this process may run on, which respects the affinity set by the container or taskset."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def bf16_supported():
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def quantize_linear_layers(module):
+    """
+    Dynamic int8 quantization of every nn.Linear of module, including module itself. The layers
+    are swapped in place: the float weights are released layer by layer rather than copied first.
+    """
+    # quantize_dynamic only swaps the children of the module it is given
+    wrapped = nn.Sequential(module)
+    torch.ao.quantization.quantize_dynamic(wrapped, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return wrapped[0]
+
+
+def run_in_dtype(module, dtype):
+    """
+    Cast the weights of module to dtype and its floating point inputs with them, its output is cast
+    back to float32 so that the rest of the model does not see the difference.
+    """
+    module.to(dtype)
+
+    def cast_inputs(_, args):
+        return tuple(arg.to(dtype) if torch.is_tensor(arg) and arg.is_floating_point() else arg for arg in args)
+
+    def cast_output(_, args, output):
+        return output.float() if torch.is_tensor(output) else output
+
+    module.register_forward_pre_hook(cast_inputs)
+    module.register_forward_hook(cast_output)
+    return module
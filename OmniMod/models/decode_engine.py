@@ -0,0 +1,240 @@
+import time
+import logging
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+
+from OmniMod.models.decoding import (
+    cat_past,
+    ends_with_stop,
+    get_eos_token_ids,
+    left_pad_past,
+    min_new_tokens_for,
+    next_token_scores,
+    past_to_tuple,
+    position_ids_from_mask,
+    select_next_tokens,
+    select_past,
+)
+
+
+class DecodeRequest:
+    """A sequence tracked by the DecodeEngine, from admission until it is retired."""
+
+    def __init__(self, context_emb, max_new_tokens, min_new_tokens=0, callback=None, request_id=None):
+        self.context_emb = context_emb
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.callback = callback
+        self.request_id = request_id
+
+        self.tokens = []
+        self.answer = None
+        self.finished = False
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_time = None
+
+
+class DecodeEngine:
+    """
+    Iteration-level (continuous) batching on top of inputs_embeds-prefilled sequences.
+
+    Unlike HF generate on a static batch, the running batch changes at every decoding step:
+    waiting requests are prefilled and admitted whenever a slot is free, and a sequence is
+    retired as soon as it produces an eos token or reaches its own max_new_tokens. The key/value
+    caches of the running sequences are kept as one left padded batch, which is re-laid out only
+    when sequences join or leave.
+
+    Typical use:
+        engine = DecodeEngine(model, max_batch_size=16)
+        for emb in model.get_generation_context_embs(images, audios, texts):
+            engine.add_request(emb, callback=lambda request: print(request.answer))
+        engine.run()
+    """
+
+    def __init__(self, model, max_batch_size=16, max_new_tokens=20, min_length=1, temperature=1.0, top_p=0.9,
+                 do_sample=False, repetition_penalty=1.0):
+        self.model = model
+        self.language_model = model.language_model
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.min_length = min_length
+        self.sampling_kwargs = dict(
+            temperature=temperature,
+            top_p=top_p,
+            do_sample=do_sample,
+            repetition_penalty=repetition_penalty,
+        )
+        self.eos_token_ids = get_eos_token_ids(self.language_model, model.language_tokenizer)
+        self.stop_ids, self.stop_sequences = model.get_stop_tokens()
+
+        self.waiting = deque()
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.logits = None
+
+        self.num_steps = 0
+        self.num_tokens = 0
+
+    @property
+    def num_waiting(self):
+        return len(self.waiting)
+
+    @property
+    def num_running(self):
+        return len(self.running)
+
+    def is_idle(self):
+        return not self.waiting and not self.running
+
+    def add_request(self, context_emb, max_new_tokens=None, min_length=None, callback=None, request_id=None):
+        # each request decodes as if it was given alone to generate, min_length counts its context
+        min_length = self.min_length if min_length is None else min_length
+        request = DecodeRequest(
+            context_emb,
+            max_new_tokens=max_new_tokens or self.max_new_tokens,
+            min_new_tokens=min_new_tokens_for(min_length, context_emb.shape[1]),
+            callback=callback,
+            request_id=request_id,
+        )
+        self.waiting.append(request)
+        return request
+
+    def _forward(self, **kwargs):
+        with self.model.maybe_autocast():
+            outputs = self.language_model(use_cache=True, return_dict=True, **kwargs)
+        return past_to_tuple(outputs.past_key_values), outputs.logits[:, -1]
+
+    def _admit(self):
+        num_admit = min(self.max_batch_size - len(self.running), len(self.waiting))
+        if num_admit <= 0:
+            return
+        admitted = [self.waiting.popleft() for _ in range(num_admit)]
+
+        embs, attention_mask = self.model.pad_context_embs([request.context_emb for request in admitted])
+        attention_mask = attention_mask.long()
+        past_key_values, logits = self._forward(
+            inputs_embeds=embs,
+            attention_mask=attention_mask,
+            position_ids=position_ids_from_mask(attention_mask),
+        )
+        for request in admitted:
+            request.context_emb = None
+
+        if self.running:
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            past_key_values = cat_past([
+                left_pad_past(self.past_key_values, length),
+                left_pad_past(past_key_values, length),
+            ])
+            attention_mask = torch.cat([
+                F.pad(self.attention_mask, (length - self.attention_mask.shape[1], 0)),
+                F.pad(attention_mask, (length - attention_mask.shape[1], 0)),
+            ])
+            logits = torch.cat([self.logits, logits])
+
+        self.running.extend(admitted)
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.logits = logits
+
+    def _scores(self):
+        if self.sampling_kwargs["repetition_penalty"] == 1.0 and \
+                all(len(request.tokens) >= request.min_new_tokens for request in self.running):
+            return next_token_scores(self.logits, eos_token_ids=self.eos_token_ids, **self.sampling_kwargs)
+        # the penalty and the eos mask depend on each sequence's own history, which have different lengths
+        return torch.cat([
+            next_token_scores(
+                self.logits[i:i + 1],
+                torch.tensor(request.tokens, dtype=torch.long, device=self.logits.device).reshape(1, -1),
+                min_new_tokens=request.min_new_tokens,
+                eos_token_ids=self.eos_token_ids,
+                **self.sampling_kwargs
+            )
+            for i, request in enumerate(self.running)
+        ])
+
+    def _retire(self, request, stopped):
+        request.finished = True
+        request.finish_time = time.perf_counter()
+        request.answer = self.model.decode_answers([torch.tensor(request.tokens, dtype=torch.long)])[0]
+        # a retired sequence leaves the batch right away, so no step is wasted on it
+        self.model.update_stop_counters(
+            {"sequences": 1, "generated": len(request.tokens), "wasted": 0, "truncated": int(not stopped)})
+        if request.callback is not None:
+            request.callback(request)
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admit waiting requests, pick the next token of every running sequence, retire the
+        finished ones and run one decoding forward for the rest. Returns the retired requests.
+        """
+        self._admit()
+        if not self.running:
+            return []
+
+        next_tokens = select_next_tokens(self._scores(), do_sample=self.sampling_kwargs["do_sample"])
+        # one host transfer per step, the tokens have to be routed to their requests anyway
+        token_list = next_tokens.tolist()
+        self.num_steps += 1
+        self.num_tokens += len(token_list)
+
+        now = time.perf_counter()
+        keep, retired = [], []
+        for i, (request, token) in enumerate(zip(self.running, token_list)):
+            request.tokens.append(token)
+            if request.first_token_time is None:
+                request.first_token_time = now
+            stopped = ends_with_stop(request.tokens, self.stop_ids, self.stop_sequences)
+            if stopped or len(request.tokens) >= request.max_new_tokens:
+                self._retire(request, stopped)
+                retired.append(request)
+            else:
+                keep.append(i)
+
+        if not keep:
+            self.running = []
+            self.past_key_values = self.attention_mask = self.logits = None
+            return retired
+
+        if retired:
+            index = torch.tensor(keep, device=next_tokens.device)
+            self.running = [self.running[i] for i in keep]
+            self.past_key_values = select_past(self.past_key_values, index)
+            self.attention_mask = self.attention_mask[index]
+            next_tokens = next_tokens[index]
+            # drop the columns that are padding for every remaining sequence
+            num_pad = int((self.attention_mask.sum(0) == 0).long().cumprod(0).sum())
+            if num_pad > 0:
+                self.past_key_values = tuple((k[:, :, num_pad:], v[:, :, num_pad:]) for k, v in self.past_key_values)
+                self.attention_mask = self.attention_mask[:, num_pad:]
+
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones([len(self.running), 1])], dim=1)
+        self.past_key_values, self.logits = self._forward(
+            input_ids=next_tokens[:, None],
+            attention_mask=self.attention_mask,
+            position_ids=position_ids_from_mask(self.attention_mask)[:, -1:],
+            past_key_values=self.past_key_values,
+        )
+        return retired
+
+    def run(self):
+        """Step until every added request is finished."""
+        finished = []
+        while not self.is_idle():
+            finished.extend(self.step())
+        logging.info("Decode engine: {} steps, {} tokens, {:.2f} sequences per step".format(
+            self.num_steps, self.num_tokens, self.num_tokens / max(self.num_steps, 1)))
+        return finished
+
+    def generate(self, context_embs, max_new_tokens=None, min_length=None):
+        """Decode a list of context embeddings and return their answers in order."""
+        requests = [self.add_request(emb, max_new_tokens=max_new_tokens, min_length=min_length)
+                    for emb in context_embs]
+        self.run()
+        return [request.answer for request in requests]
@@ -0,0 +1,281 @@
+"""
+Helpers for decoding loops that run the language model step by step on top of
+inputs_embeds-prefilled key/value caches, instead of going through HF generate.
+"""
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def past_to_tuple(past_key_values):
+    """Return the key/value cache in the legacy ((key, value), ...) layout."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past_key_values)
+
+
+def expand_past(past_key_values, n):
+    """Fork a batch-1 cache into n identical rows."""
+    return tuple((k.expand(n, -1, -1, -1), v.expand(n, -1, -1, -1)) for k, v in past_key_values)
+
+
+def left_pad_past(past_key_values, length):
+    """Left pad the sequence dimension of a cache to length, the padded slots must be masked out."""
+    padded = []
+    for k, v in past_key_values:
+        pad = length - k.shape[2]
+        padded.append((F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))))
+    return tuple(padded)
+
+
+def cat_past(pasts):
+    """Concatenate caches of equal sequence length along the batch dimension."""
+    return tuple(
+        (torch.cat([past[i][0] for past in pasts]), torch.cat([past[i][1] for past in pasts]))
+        for i in range(len(pasts[0]))
+    )
+
+
+def select_past(past_key_values, index):
+    return tuple((k[index], v[index]) for k, v in past_key_values)
+
+
+def position_ids_from_mask(attention_mask):
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.masked_fill(attention_mask == 0, 1)
+
+
+def get_eos_token_ids(language_model, tokenizer):
+    eos_token_id = getattr(language_model.generation_config, "eos_token_id", None)
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    return list(eos_token_id)
+
+
+def get_pad_token_id(language_model, eos_token_ids):
+    """Token HF generate pads finished sequences with: the pad token of the generation config, else eos."""
+    pad_token_id = getattr(language_model.generation_config, "pad_token_id", None)
+    return eos_token_ids[0] if pad_token_id is None else pad_token_id
+
+
+def min_new_tokens_for(min_length, context_len):
+    """
+    min_length of HF generate as a number of new tokens. Generating from inputs_embeds,
+    transformers counts min_length over the left padded context of the batch, so its eos mask
+    only applies while fewer than min_length - context_len tokens have been generated.
+    """
+    return max(min_length - context_len, 0)
+
+
+def ends_with_stop(tokens, stop_ids, stop_sequences=()):
+    """Host side check of a token list against stop ids and stop token sequences."""
+    if not tokens:
+        return False
+    if tokens[-1] in stop_ids:
+        return True
+    return any(len(tokens) >= len(ids) and tokens[-len(ids):] == list(ids) for ids in stop_sequences)
+
+
+def next_token_scores(logits, generated=None, repetition_penalty=1.0, temperature=1.0, top_p=1.0,
+                      do_sample=False, min_new_tokens=0, eos_token_ids=()):
+    """
+    Apply the same logits processors and warpers as HF generate for the options generate
+    exposes. generated holds the tokens produced so far, which is all HF sees as input_ids
+    when generating from inputs_embeds.
+    """
+    scores = logits.float()
+    if generated is not None and generated.shape[1] > 0:
+        if repetition_penalty != 1.0:
+            score = torch.gather(scores, 1, generated)
+            score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            scores = scores.scatter(1, generated, score)
+        if generated.shape[1] < min_new_tokens:
+            scores[:, list(eos_token_ids)] = -float("inf")
+    elif min_new_tokens > 0:
+        scores[:, list(eos_token_ids)] = -float("inf")
+
+    if do_sample:
+        if temperature != 1.0:
+            scores = scores / temperature
+        if top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
+            sorted_indices_to_remove[..., -1:] = 0
+            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+            scores = scores.masked_fill(indices_to_remove, -float("inf"))
+    return scores
+
+
+def select_next_tokens(scores, do_sample=False):
+    if do_sample:
+        return torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+    return scores.argmax(dim=-1)
+
+
+def decode_from_past(language_model, past_key_values, attention_mask, logits, eos_token_ids, pad_token_id,
+                     max_new_tokens=20, autocast=None, stopping_criteria=None, check_every=8, **sampling_kwargs):
+    """
+    Greedy or sampled decoding from an already prefilled cache.
+
+    logits are the last-position logits of the prefill, attention_mask covers the cached
+    positions. A sequence is finished when it produces an eos token, or when stopping_criteria
+    (called like a HF StoppingCriteria, returning a bool tensor [B]) says so. Finished sequences
+    are padded with pad_token_id. Whether every sequence is finished is only read on the host
+    every check_every steps, so the loop may run a few steps past that point; the columns
+    generated after it are dropped. Returns the generated token ids [B, T].
+    """
+    batch_size = logits.shape[0]
+    device = logits.device
+    eos = torch.tensor(eos_token_ids, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    generated = torch.zeros([batch_size, 0], dtype=torch.long, device=device)
+    # number of steps until every sequence was finished, kept on the device
+    length = torch.zeros([], dtype=torch.long, device=device)
+
+    for step in range(max_new_tokens):
+        scores = next_token_scores(logits, generated, eos_token_ids=eos_token_ids, **sampling_kwargs)
+        next_tokens = select_next_tokens(scores, do_sample=sampling_kwargs.get("do_sample", False))
+        next_tokens = torch.where(finished, torch.full_like(next_tokens, pad_token_id), next_tokens)
+        generated = torch.cat([generated, next_tokens[:, None]], dim=1)
+        length = length + (~finished).any().long()
+        finished = finished | torch.isin(next_tokens, eos)
+        if stopping_criteria is not None:
+            finished = finished | stopping_criteria(generated, scores)
+        if step == max_new_tokens - 1 or ((step + 1) % check_every == 0 and bool(finished.all())):
+            break
+
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones([batch_size, 1])], dim=1)
+        position_ids = position_ids_from_mask(attention_mask)[:, -1:]
+        with autocast():
+            outputs = language_model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits[:, -1]
+
+    return generated[:, :int(length)]
+
+
+def crop_past(past_key_values, length):
+    """Keep the first length positions of a cache, e.g. to drop rejected draft tokens."""
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+def greedy_tokens(logits, histories, repetition_penalty=1.0, min_new_tokens=0, eos_token_ids=()):
+    """
+    Greedy choice for each row of logits [N, V], row i continuing the tokens histories[i].
+    Rows are only processed one by one when a history dependent processor is active.
+    """
+    if repetition_penalty == 1.0 and min(len(history) for history in histories) >= min_new_tokens:
+        return logits.argmax(dim=-1).tolist()
+    tokens = []
+    for row, history in zip(logits, histories):
+        generated = torch.tensor([history], dtype=torch.long, device=logits.device).reshape(1, -1)
+        scores = next_token_scores(row[None], generated, repetition_penalty=repetition_penalty,
+                                   min_new_tokens=min_new_tokens, eos_token_ids=eos_token_ids)
+        tokens.append(int(scores.argmax(dim=-1)))
+    return tokens
+
+
+def speculative_decode(language_model, draft_model, context_emb, draft_input_ids, eos_token_ids,
+                       max_new_tokens=20, num_draft_tokens=4, autocast=None, repetition_penalty=1.0,
+                       min_new_tokens=0, stop_ids=None, stop_sequences=(), stats=None):
+    """
+    Greedy speculative decoding of a single sequence.
+
+    The draft model proposes num_draft_tokens tokens from draft_input_ids (a text-only view of
+    the prompt) followed by the answer so far; language_model then scores the pending token
+    and all proposals in one forward on top of its inputs_embeds-prefilled cache. The longest
+    prefix of proposals matching its own greedy choices is accepted, plus the token it picks at
+    the first mismatch, so the output is exactly what greedy decoding of language_model gives.
+    Decoding stops at stop_ids (the eos ids by default) or at the end of one of stop_sequences.
+    Returns the generated token ids as a list; counters are accumulated into stats.
+    """
+    stats = stats if stats is not None else {}
+    stop_ids = eos_token_ids if stop_ids is None else stop_ids
+    device = context_emb.device
+
+    def forward(model, **kwargs):
+        with autocast():
+            outputs = model(use_cache=True, return_dict=True, **kwargs)
+        return past_to_tuple(outputs.past_key_values), outputs.logits[0]
+
+    def pick(logits, histories):
+        return greedy_tokens(logits, histories, repetition_penalty=repetition_penalty,
+                             min_new_tokens=min_new_tokens, eos_token_ids=eos_token_ids)
+
+    start_time = time.perf_counter()
+    past, logits = forward(language_model, inputs_embeds=context_emb)
+    past_len = context_emb.shape[1]
+    generated = pick(logits[-1:], [[]])
+    stats["verify_seconds"] = stats.get("verify_seconds", 0.0) + time.perf_counter() - start_time
+
+    draft_past, draft_len = None, 0
+    while len(generated) < max_new_tokens and not ends_with_stop(generated, stop_ids, stop_sequences):
+        num_proposals = min(num_draft_tokens, max_new_tokens - len(generated) - 1)
+
+        # draft: feed whatever of the sequence it has not seen yet, then extend it greedily
+        start_time = time.perf_counter()
+        sequence = list(draft_input_ids) + generated
+        proposals = []
+        for _ in range(num_proposals):
+            new_ids = torch.tensor([sequence[draft_len:]], dtype=torch.long, device=device)
+            draft_past, draft_logits = forward(
+                draft_model,
+                input_ids=new_ids,
+                past_key_values=draft_past,
+                position_ids=torch.arange(draft_len, len(sequence), device=device)[None],
+            )
+            draft_len = len(sequence)
+            proposals.extend(pick(draft_logits[-1:], [generated + proposals]))
+            sequence.append(proposals[-1])
+            if ends_with_stop(generated + proposals, stop_ids, stop_sequences):
+                break
+        draft_seconds = time.perf_counter() - start_time
+
+        # verify: one forward over the pending token and the proposals
+        start_time = time.perf_counter()
+        new_ids = torch.tensor([generated[-1:] + proposals], dtype=torch.long, device=device)
+        past, logits = forward(
+            language_model,
+            input_ids=new_ids,
+            past_key_values=past,
+            position_ids=torch.arange(past_len, past_len + new_ids.shape[1], device=device)[None],
+        )
+        targets = pick(logits, [generated + proposals[:j] for j in range(len(proposals) + 1)])
+        num_accepted = 0
+        while num_accepted < len(proposals) and proposals[num_accepted] == targets[num_accepted]:
+            num_accepted += 1
+
+        # the caches stay valid up to the last accepted proposal
+        past_len += 1 + num_accepted
+        past = crop_past(past, past_len)
+        draft_len = min(draft_len, len(draft_input_ids) + len(generated) + num_accepted)
+        if draft_past is not None:
+            draft_past = crop_past(draft_past, draft_len)
+        for token in targets[:num_accepted + 1]:
+            generated.append(token)
+            if ends_with_stop(generated, stop_ids, stop_sequences):
+                break
+        verify_seconds = time.perf_counter() - start_time
+
+        stats["draft_seconds"] = stats.get("draft_seconds", 0.0) + draft_seconds
+        stats["verify_seconds"] = stats.get("verify_seconds", 0.0) + verify_seconds
+        stats["verify_steps"] = stats.get("verify_steps", 0) + 1
+        stats["drafted"] = stats.get("drafted", 0) + len(proposals)
+        stats["accepted"] = stats.get("accepted", 0) + num_accepted
+
+    generated = generated[:max_new_tokens]
+    stats["generated"] = stats.get("generated", 0) + len(generated)
+    stats["sequences"] = stats.get("sequences", 0) + 1
+    return generated
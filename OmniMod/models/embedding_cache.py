@@ -0,0 +1,239 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_digest(tensor, namespace=""):
+    """sha256 of the raw bytes, dtype and shape of a tensor, salted with a namespace."""
+    tensor = tensor.detach().contiguous().cpu()
+    hasher = hashlib.sha256()
+    hasher.update(namespace.encode())
+    hasher.update(str(tensor.dtype).encode())
+    hasher.update(str(tuple(tensor.shape)).encode())
+    # viewing as bytes also covers dtypes numpy does not know, e.g. bfloat16
+    hasher.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of encoder outputs.
+
+    Entries are keyed by the digest of the preprocessed input together with a namespace that
+    identifies the weights producing them (encoder name, checkpoint, ...). The in-memory tier is
+    bounded by max_bytes and, optionally, max_entries, and evicts in "lru" or "fifo" order; when
+    disk_dir is given, entries are also written there and looked up on a memory miss, so they
+    survive restarts.
+    """
+
+    def __init__(self, namespace="", max_bytes=1 << 30, max_entries=None, eviction="lru", disk_dir=None):
+        assert eviction in ("lru", "fifo"), "Unknown eviction policy {}".format(eviction)
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, tensor):
+        return tensor_digest(tensor, self.namespace)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".pt")
+
+    def _insert(self, key, value):
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.num_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes or \
+                (self.max_entries is not None and len(self._entries) > self.max_entries):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.num_bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                if self.eviction == "lru":
+                    self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+            if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+                try:
+                    value = torch.load(self._disk_path(key), map_location="cpu")
+                except Exception as e:
+                    logging.warning("Failed to read cached embedding {}: {}".format(key, e))
+                else:
+                    self._insert(key, value)
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # clone so that a cached row does not keep the whole batch tensor alive
+        value = value.detach().clone()
+        with self._lock:
+            self._insert(key, value)
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = "{}.tmp{}".format(path, os.getpid())
+                torch.save(value.cpu(), tmp_path)
+                os.replace(tmp_path, path)
+
+    def clear(self):
+        """Drop the in-memory tier, the disk tier is namespaced and stays valid."""
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+class SegmentCache:
+    """
+    LRU caches for the constant text of prompts ("[INST]", "<Img>", fixed instructions, ...):
+    segment string -> token ids, and token ids -> embeddings. Both hold at most max_entries
+    entries, and the embeddings at most max_bytes.
+
+    Embeddings are tied to the weight tensor they were computed from; when the weight is
+    reloaded, moved or updated in place (its version counter changes), the cached embeddings
+    are dropped.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._token_ids = OrderedDict()
+        self._embeds = OrderedDict()
+        self._weight_key = None
+        self._lock = threading.Lock()
+        self.embed_bytes = 0
+
+        self.token_hits = 0
+        self.token_misses = 0
+        self.embed_hits = 0
+        self.embed_misses = 0
+        self.embed_evictions = 0
+        self.invalidations = 0
+
+    def _store(self, entries, key, value):
+        entries[key] = value
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def _store_embedding(self, key, value):
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return
+        # clone so that a cached segment does not keep the embeddings of the whole batch alive
+        self._embeds[key] = (value.clone(), size)
+        self.embed_bytes += size
+        while self.embed_bytes > self.max_bytes or len(self._embeds) > self.max_entries:
+            _, (_, evicted_size) = self._embeds.popitem(last=False)
+            self.embed_bytes -= evicted_size
+            self.embed_evictions += 1
+
+    def token_ids(self, texts, add_special_tokens, tokenize_fn):
+        """Token ids of each text; the misses are tokenized together with one tokenize_fn call."""
+        keys = [(text, add_special_tokens) for text in texts]
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._token_ids:
+                    self._token_ids.move_to_end(key)
+                    found[key] = self._token_ids[key]
+            self.token_hits += sum(key in found for key in keys)
+            self.token_misses += sum(key not in found for key in keys)
+
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            new_ids = tokenize_fn([text for text, _ in missing])
+            with self._lock:
+                for key, ids in zip(missing, new_ids):
+                    ids = list(ids)
+                    self._store(self._token_ids, key, ids)
+                    found[key] = ids
+        return [found[key] for key in keys]
+
+    def embeddings(self, segments, weight, embed_fn):
+        """
+        Embeddings of each tuple of token ids in segments. The misses are embedded together with
+        one embed_fn call, which gets the missing tuples and returns their embeddings concatenated.
+        """
+        weight_key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        found = {}
+        with self._lock:
+            if weight_key != self._weight_key:
+                if self._embeds:
+                    self.invalidations += 1
+                self._embeds.clear()
+                self.embed_bytes = 0
+                self._weight_key = weight_key
+            for key in segments:
+                if key in self._embeds:
+                    self._embeds.move_to_end(key)
+                    found[key] = self._embeds[key][0]
+            self.embed_hits += sum(key in found for key in segments)
+            self.embed_misses += sum(key not in found for key in segments)
+
+        missing = list(dict.fromkeys(key for key in segments if key not in found))
+        if missing:
+            new_embeds = embed_fn(missing).detach().split([len(key) for key in missing])
+            with self._lock:
+                for key, value in zip(missing, new_embeds):
+                    found[key] = value
+                    if weight_key == self._weight_key:
+                        self._store_embedding(key, value)
+        return [found[key] for key in segments]
+
+    def clear(self):
+        with self._lock:
+            self._token_ids.clear()
+            self._embeds.clear()
+            self.embed_bytes = 0
+
+    def stats(self):
+        token_lookups = self.token_hits + self.token_misses
+        embed_lookups = self.embed_hits + self.embed_misses
+        return {
+            "token_entries": len(self._token_ids),
+            "embed_entries": len(self._embeds),
+            "embed_bytes": self.embed_bytes,
+            "embed_evictions": self.embed_evictions,
+            "token_hit_rate": round(self.token_hits / token_lookups, 4) if token_lookups else 0.0,
+            "embed_hit_rate": round(self.embed_hits / embed_lookups, 4) if embed_lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,57 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+from accelerate import init_empty_weights
+
+from OmniMod.common.checkpoint import assign_tensor
+
+
+def init_empty(enabled=True):
+    """
+    Context in which the parameters of new modules are created on the meta device: no memory and
+    no random init. Buffers (position ids, index tables) are small and computed, they stay real.
+    """
+    return init_empty_weights() if enabled else contextlib.nullcontext()
+
+
+def assign_state_dict(module, state_dict, device=None):
+    """
+    Fill the tensors of a module created with init_empty from state_dict, on device. The tensors
+    of state_dict become the module's (no copy when device and dtype already match). Returns the
+    keys of state_dict the module does not have.
+    """
+    names = set(module.state_dict().keys())
+    unexpected = []
+    for key, value in state_dict.items():
+        if key in names:
+            assign_tensor(module, key, value, device=device)
+        else:
+            unexpected.append(key)
+    return unexpected
+
+
+def materialize(module, device):
+    """
+    Allocate on device the tensors still on the meta device, i.e. those no checkpoint provided,
+    and initialize them with reset_parameters of their module, as if it had been built there.
+    """
+    for name, submodule in module.named_modules():
+        tensors = {**submodule._parameters, **submodule._buffers}
+        meta = [key for key, tensor in tensors.items() if tensor is not None and tensor.is_meta]
+        if not meta:
+            continue
+        if len(meta) < len([tensor for tensor in tensors.values() if tensor is not None]) or \
+                not hasattr(submodule, "reset_parameters"):
+            raise RuntimeError("{} of {} were not loaded and cannot be initialized".format(
+                meta, name or type(module).__name__))
+        for key in meta:
+            if key in submodule._parameters:
+                param = submodule._parameters[key]
+                submodule._parameters[key] = nn.Parameter(torch.empty_like(param, device=device),
+                                                          requires_grad=param.requires_grad)
+            else:
+                submodule._buffers[key] = torch.empty_like(submodule._buffers[key], device=device)
+        with torch.no_grad():
+            submodule.reset_parameters()
+    return module
@@ -2,15 +2,53 @@ from transformers.models.whisper.modeling_whisper import *
 import torch.nn as nn
 
 class WhisperForLiteGPT(nn.Module):
-    def __init__(self):
+    def __init__(self, asr_encoder=None):
         super().__init__()
-        self.asr_encoder = WhisperForConditionalGeneration.from_pretrained("Hanhpt23/whisper-tiny-silvar",
-                                                                           max_source_positions = 1500, # 256 
-                                                                           ignore_mismatched_sizes=True
-                                                                           ).model.encoder
+        if asr_encoder is None:
+            asr_encoder = WhisperForConditionalGeneration.from_pretrained("Hanhpt23/whisper-tiny-silvar",
+                                                                          max_source_positions = 1500, # 256 
+                                                                          ignore_mismatched_sizes=True
+                                                                          ).model.encoder
+        self.asr_encoder = asr_encoder
         self.d_model = self.asr_encoder.config.d_model
-        self.pooling = nn.AdaptiveAvgPool2d((256, self.d_model)) # 1500 -> 256
-        
+        self.num_tokens = 256
+        self.pooling = nn.AdaptiveAvgPool2d((self.num_tokens, self.d_model)) # 1500 -> 256
+
+        # variable length mode, see encode_variable_length
+        self.variable_length = False
+        self.bucket_frames = 200
+
+        # audio longer than one window, see encode_chunked
+        self.overlap_frames = 200
+        self.max_tokens = 1024
+        self.window_batch_size = 4
+
+    @property
+    def window_frames(self):
+        return self.asr_encoder.config.max_source_positions * 2
+
+    def set_variable_length(self, enabled=True, bucket_frames=200):
+        assert bucket_frames % 2 == 0, "bucket_frames must be even, the encoder downsamples the frames by 2"
+        self.variable_length = enabled
+        self.bucket_frames = bucket_frames
+
+    def set_chunking(self, overlap_frames=200, max_tokens=1024, window_batch_size=4):
+        assert overlap_frames < self.window_frames, "the windows must overlap by less than their length"
+        self.overlap_frames = overlap_frames
+        self.max_tokens = max_tokens
+        self.window_batch_size = window_batch_size
+
+    def encode(self, input_features):
+        """
+        Pooled features and the number of tokens of each question, or None for the number of
+        tokens when every question fills all num_tokens tokens (the fixed 30 s mode).
+        """
+        if input_features.shape[-1] > self.window_frames:
+            return self.encode_chunked(input_features)
+        if self.variable_length:
+            return self.encode_variable_length(input_features)
+        return self(input_features), None
+
     def forward(
         self,
         input_features,
@@ -30,10 +68,120 @@ class WhisperForLiteGPT(nn.Module):
         ).last_hidden_state
         output = self.pooling(output)
         return output
-    
+
+    @staticmethod
+    def mel_lengths(input_features):
+        """
+        Number of mel frames before the 30 s padding. The feature extractor pads the waveform with
+        zeros, which all land on the floor of the log-mel, in every bin.
+        """
+        floor = input_features.amin(dim=(1, 2), keepdim=True)
+        is_audio = (input_features > floor).any(dim=1)
+        positions = torch.arange(1, input_features.shape[-1] + 1, device=input_features.device)
+        return (is_audio * positions).amax(dim=1).clamp(min=1)
+
+    def encode_variable_length(self, input_features):
+        """
+        Encode only the real frames of each question instead of the full 30 s window.
+
+        The batch is cropped to its longest question rounded up to bucket_frames, padded frames
+        are masked out as attention keys, and every question is pooled over its own frames at
+        the token rate of the fixed mode (256 tokens per 30 s). Returns the pooled features
+        [B, N, d_model], zero after each question, and the number of tokens of each question.
+        """
+        encoder = self.asr_encoder
+        max_positions = encoder.config.max_source_positions
+
+        mel_lens = self.mel_lengths(input_features)
+        max_len = int(mel_lens.max())  # the only host sync, it sets the cropped length
+        crop = min(input_features.shape[-1], -(-max_len // self.bucket_frames) * self.bucket_frames)
+        input_features = input_features[..., :crop]
+
+        hidden_states = nn.functional.gelu(encoder.conv1(input_features))
+        hidden_states = nn.functional.gelu(encoder.conv2(hidden_states)).permute(0, 2, 1)
+        batch_size, length, _ = hidden_states.shape
+        hidden_states = hidden_states + encoder.embed_positions.weight[:length]
+        hidden_states = nn.functional.dropout(hidden_states, p=encoder.dropout, training=encoder.training)
+
+        positions = torch.arange(length, device=hidden_states.device)
+        enc_lens = (mel_lens + 1) // 2  # conv2 has stride 2
+        key_mask = positions[None] < enc_lens[:, None]
+        mask_dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else hidden_states.dtype
+        attention_mask = torch.zeros([batch_size, 1, length, length], dtype=mask_dtype, device=hidden_states.device)
+        attention_mask = attention_mask.masked_fill(~key_mask[:, None, None, :], torch.finfo(mask_dtype).min)
+
+        for encoder_layer in encoder.layers:
+            hidden_states = encoder_layer(hidden_states, attention_mask, layer_head_mask=None)[0]
+        hidden_states = encoder.layer_norm(hidden_states)
+
+        # adaptive average pooling of each question over its own frames, as one batched matmul
+        token_lens = ((enc_lens * self.num_tokens + max_positions - 1) // max_positions).clamp(min=1)
+        num_tokens = -(-length * self.num_tokens // max_positions)
+        index = torch.arange(num_tokens, device=hidden_states.device)[None, :, None]
+        starts = index * enc_lens[:, None, None] // token_lens[:, None, None]
+        ends = ((index + 1) * enc_lens[:, None, None] + token_lens[:, None, None] - 1) // token_lens[:, None, None]
+        weights = (positions >= starts) & (positions < ends) & (index < token_lens[:, None, None])
+        weights = weights / weights.sum(dim=-1, keepdim=True).clamp(min=1)
+        output = torch.bmm(weights.to(hidden_states.dtype), hidden_states)
+        return output, token_lens
+
+    def encode_chunked(self, input_features):
+        """
+        Encode features longer than one 30 s window (see WhisperAudioProcessor max_duration).
+
+        Each question is split into windows overlapping by overlap_frames. Only the windows that
+        hold audio are encoded, window_batch_size at a time, so the encoder memory does not grow
+        with the duration. Every window keeps the tokens of its own span (the overlap is split
+        halfway between neighbours, the last window keeps all its tokens as in the fixed mode, or
+        its real ones in variable length mode), the tokens are concatenated in time and average
+        pooled down to max_tokens when there are more. Returns the same as encode_variable_length.
+        """
+        window, overlap = self.window_frames, self.overlap_frames
+        hop = window - overlap
+        mel_lens = self.mel_lengths(input_features)
+        floors = input_features.amin(dim=(1, 2))
+        mel_lens, floors = mel_lens.tolist(), floors.tolist()
+
+        # (question, start frame, first owned frame, end of owned frames) of every window
+        windows = []
+        for b, length in enumerate(mel_lens):
+            starts = list(range(0, max(length - overlap, 1), hop))
+            for k, start in enumerate(starts):
+                first = start + overlap // 2 if k > 0 else start
+                end = start + window - overlap // 2 if k < len(starts) - 1 else start + window
+                windows.append((b, start, first, end))
+
+        rate = self.num_tokens / window
+        pieces = [[] for _ in mel_lens]
+        for i in range(0, len(windows), self.window_batch_size):
+            chunk = windows[i:i + self.window_batch_size]
+            features = torch.stack([
+                nn.functional.pad(input_features[b, :, start:start + window],
+                                  (0, max(start + window - input_features.shape[-1], 0)), value=floors[b])
+                for b, start, _, _ in chunk
+            ])
+            if self.variable_length:
+                output, token_lens = self.encode_variable_length(features)
+                token_lens = token_lens.tolist()
+            else:
+                output, token_lens = self(features), [self.num_tokens] * len(chunk)
+            for (b, start, first, end), tokens, num_tokens in zip(chunk, output, token_lens):
+                lo = int(round((first - start) * rate))
+                hi = min(max(int(round((end - start) * rate)), lo + 1), num_tokens)
+                pieces[b].append(tokens[lo:hi])
+
+        outputs = []
+        for question_pieces in pieces:
+            tokens = torch.cat(question_pieces)
+            if len(tokens) > self.max_tokens:
+                tokens = nn.functional.adaptive_avg_pool1d(tokens.t()[None], self.max_tokens)[0].t()
+            outputs.append(tokens)
+        token_lens = torch.tensor([len(tokens) for tokens in outputs], device=input_features.device)
+        return nn.utils.rnn.pad_sequence(outputs, batch_first=True), token_lens
+
 def create_whisper(**kwargs):
     precision = kwargs.get("precision", "fp16")
     model = WhisperForLiteGPT()
     if precision == "fp16":
         model = model.half()
-    return model
\ No newline at end of file
+    return model
@@ -0,0 +1,51 @@
+import torch
+import torch.nn.functional as F
+
+
+def bipartite_merge(x, size, positions, r):
+    """
+    One round of bipartite soft matching: the tokens are split alternately into two sets, each
+    token of the first set is matched to its most similar token of the second set, and the r
+    best matched ones are merged into their match (average weighted by the number of patches
+    each token already holds). The remaining tokens are put back in their original order.
+    """
+    batch_size, _, dim = x.shape
+    a, b = x[:, ::2], x[:, 1::2]
+    scores = F.normalize(a, dim=-1) @ F.normalize(b, dim=-1).transpose(1, 2)
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    src_idx, unm_idx = edge_idx[:, :r], edge_idx[:, r:]
+    dst_idx = node_idx.gather(1, src_idx)
+
+    weighted_a, weighted_b = (x * size)[:, ::2], (x * size)[:, 1::2]
+    size_a, size_b = size[:, ::2], size[:, 1::2]
+    gather = lambda t, index: t.gather(1, index[..., None].expand(-1, -1, t.shape[-1]))
+    weighted_b = weighted_b.scatter_add(1, dst_idx[..., None].expand(-1, -1, dim), gather(weighted_a, src_idx))
+    size_b = size_b.scatter_add(1, dst_idx[..., None], gather(size_a, src_idx))
+
+    weighted = torch.cat([gather(weighted_a, unm_idx), weighted_b], dim=1)
+    size = torch.cat([gather(size_a, unm_idx), size_b], dim=1)
+    positions = torch.cat([positions[:, ::2].gather(1, unm_idx), positions[:, 1::2]], dim=1)
+
+    order = positions.argsort(dim=1)
+    weighted, size, positions = gather(weighted, order), gather(size, order), positions.gather(1, order)
+    return weighted / size, size, positions
+
+
+def merge_tokens(x, num_tokens):
+    """
+    Merge the tokens [B, N, C] of a vision encoder down to num_tokens by repeated bipartite
+    soft matching (ToMe, Bolya et al. 2023), without any training. Each round removes at most
+    half of the tokens, the merged tokens keep the spatial order of the patches they hold.
+    """
+    batch_size, length, _ = x.shape
+    if length <= num_tokens:
+        return x
+    dtype = x.dtype
+    x = x.float()
+    size = x.new_ones(batch_size, length, 1)
+    positions = torch.arange(length, device=x.device).expand(batch_size, length)
+    while x.shape[1] > num_tokens:
+        r = min(x.shape[1] - num_tokens, x.shape[1] // 2)
+        x, size, positions = bipartite_merge(x, size, positions, r)
+    return x.to(dtype)
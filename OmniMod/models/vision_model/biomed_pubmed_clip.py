@@ -9,9 +9,14 @@ class BiomedPubmedCLIP(nn.Module):
         self.biomed_clip = create_model_from_pretrained("hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224", return_transform=False).visual.trunk
         self.pubmed_clip = CLIPModel.from_pretrained("flaviagiammarino/pubmed-clip-vit-base-patch32").vision_model
         self.num_features = 768
+        self.runner = None  # a ConcurrentRunner runs the two towers at the same time
     def forward(self, x):
-        x1 = self.biomed_clip.forward_features(x)[:, 1:, :]
-        x2 = self.pubmed_clip(x).last_hidden_state[:, 1:, :]
+        biomed = lambda: self.biomed_clip.forward_features(x)[:, 1:, :]
+        pubmed = lambda: self.pubmed_clip(x).last_hidden_state[:, 1:, :]
+        if self.runner is not None:
+            x1, x2 = self.runner.run([biomed, pubmed], x.device)
+        else:
+            x1, x2 = biomed(), pubmed()
         x = torch.cat([x1, x2], dim=1)
         return x
     
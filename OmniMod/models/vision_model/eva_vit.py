@@ -16,6 +16,7 @@ from timm.models.layers import drop_path, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
 
 from OmniMod.common.dist_utils import download_cached_file
+from OmniMod.models.meta_init import assign_state_dict, init_empty, materialize
 
 def _cfg(url='', **kwargs):
     return {
@@ -115,6 +116,36 @@ class Attention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        # F.scaled_dot_product_attention instead of the explicit softmax, see VisionTransformer.set_sdpa
+        self.use_sdpa = False
+        self.attn_mask_cache = None
+
+    def get_relative_position_bias(self):
+        num_tokens = self.window_size[0] * self.window_size[1] + 1
+        relative_position_bias = \
+            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+                num_tokens, num_tokens, -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def get_attn_mask(self, rel_pos_bias, dtype):
+        """The relative position biases as an additive attention mask, None when there are none."""
+        attn_mask = None
+        table = self.relative_position_bias_table
+        if table is not None:
+            if self.training or (torch.is_grad_enabled() and table.requires_grad):
+                attn_mask = self.get_relative_position_bias().to(dtype)
+            else:
+                # the gather gives the same mask on every forward until the table is changed in place
+                key = (table._version, table.device, dtype)
+                if self.attn_mask_cache is None or self.attn_mask_cache[0] != key:
+                    with torch.no_grad():
+                        self.attn_mask_cache = (key, self.get_relative_position_bias().to(dtype))
+                attn_mask = self.attn_mask_cache[1]
+        if rel_pos_bias is not None:
+            rel_pos_bias = rel_pos_bias.to(dtype)
+            attn_mask = rel_pos_bias if attn_mask is None else attn_mask + rel_pos_bias
+        return attn_mask.unsqueeze(0) if attn_mask is not None else None
+
     def forward(self, x, rel_pos_bias=None):
         B, N, C = x.shape
         qkv_bias = None
@@ -125,16 +156,22 @@ class Attention(nn.Module):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
+        if self.use_sdpa:
+            # scaled_dot_product_attention divides by sqrt(head_dim), the scale argument is torch>=2.1 only
+            q = q * (self.scale * q.shape[-1] ** 0.5)
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=self.get_attn_mask(rel_pos_bias, q.dtype),
+                dropout_p=self.attn_drop.p if self.training else 0.)
+            x = x.transpose(1, 2).reshape(B, N, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
         if self.relative_position_bias_table is not None:
-            relative_position_bias = \
-                self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                    self.window_size[0] * self.window_size[1] + 1,
-                    self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            attn = attn + self.get_relative_position_bias().unsqueeze(0)
 
         if rel_pos_bias is not None:
             attn = attn + rel_pos_bias
@@ -314,6 +351,16 @@ class VisionTransformer(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_sdpa(self, enabled=True):
+        """
+        Compute the attention of every block with F.scaled_dot_product_attention, which does not
+        materialize the attention matrix when its fused kernels apply. The relative position
+        biases become an additive mask, cached per block while the model is not training.
+        """
+        for blk in self.blocks:
+            blk.attn.use_sdpa = enabled
+            blk.attn.attn_mask_cache = None
+
     def get_classifier(self):
         return self.head
 
@@ -412,20 +459,21 @@ def convert_weights_to_fp16(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
     
     
-def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16"):
-    model = VisionTransformer(
-        img_size=img_size,
-        patch_size=14,
-        use_mean_pooling=False,
-        embed_dim=1408,
-        depth=39,
-        num_heads=1408//88,
-        mlp_ratio=4.3637,
-        qkv_bias=True,
-        drop_path_rate=drop_path_rate,
-        norm_layer=partial(nn.LayerNorm, eps=1e-6),
-        use_checkpoint=use_checkpoint,
-    )  
+def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16",meta_init=False,device=None):
+    with init_empty(meta_init):
+        model = VisionTransformer(
+            img_size=img_size,
+            patch_size=14,
+            use_mean_pooling=False,
+            embed_dim=1408,
+            depth=39,
+            num_heads=1408//88,
+            mlp_ratio=4.3637,
+            qkv_bias=True,
+            drop_path_rate=drop_path_rate,
+            norm_layer=partial(nn.LayerNorm, eps=1e-6),
+            use_checkpoint=use_checkpoint,
+        )  
     url = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/eva_vit_g.pth"
     cached_file = download_cached_file(
         url, check_hash=False, progress=True
@@ -433,7 +481,12 @@ def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precis
     state_dict = torch.load(cached_file, map_location="cpu")    
     interpolate_pos_embed(model,state_dict)
     
-    incompatible_keys = model.load_state_dict(state_dict, strict=False)
+    if meta_init:
+        # the weights are created on device from the checkpoint, with no random init to overwrite
+        assign_state_dict(model, state_dict, device=device)
+        materialize(model, device or "cpu")
+    else:
+        incompatible_keys = model.load_state_dict(state_dict, strict=False)
 #     print(incompatible_keys)
     
     if precision == "fp16":
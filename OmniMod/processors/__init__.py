@@ -5,13 +5,9 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import importlib
+
 from OmniMod.processors.base_processor import BaseProcessor
-from OmniMod.processors.blip_processors import (
-    Blip2ImageTrainProcessor,
-    Blip2ImageEvalProcessor,
-    BlipCaptionProcessor,
-)
-from OmniMod.processors.whisper_processors import WhisperAudioProcessor
 
 from OmniMod.common.registry import registry
 
@@ -23,6 +19,27 @@ __all__ = [
     'WhisperAudioProcessor',
 ]
 
+# imported on first use, the registry imports them on the first lookup of their names
+_lazy_attributes = {
+    "Blip2ImageTrainProcessor": "OmniMod.processors.blip_processors",
+    "Blip2ImageEvalProcessor": "OmniMod.processors.blip_processors",
+    "BlipCaptionProcessor": "OmniMod.processors.blip_processors",
+    "WhisperAudioProcessor": "OmniMod.processors.whisper_processors",
+}
+
+registry.register_lazy("processor_name_mapping", "blip_caption", "OmniMod.processors.blip_processors")
+registry.register_lazy("processor_name_mapping", "blip2_image_train", "OmniMod.processors.blip_processors")
+registry.register_lazy("processor_name_mapping", "blip2_image_eval", "OmniMod.processors.blip_processors")
+registry.register_lazy("processor_name_mapping", "whisper_processor", "OmniMod.processors.whisper_processors")
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 def load_processor(name, cfg=None):
     """
@@ -14,13 +14,16 @@ from transformers import WhisperProcessor
 
 @registry.register_processor("whisper_processor")
 class WhisperAudioProcessor(BaseProcessor):
-    def __init__(self, model_name="openai/whisper-tiny", sampling_rate=16000):
+    def __init__(self, model_name="openai/whisper-tiny", sampling_rate=16000, max_duration=30):
         self.audio_processor = WhisperProcessor.from_pretrained(model_name)
         self.sampling_rate = sampling_rate
+        # seconds the waveform is padded or truncated to, the encoder splits more than 30 s into windows
+        self.max_duration = max_duration
 
     def __call__(self, waveform):
         # Process the waveform using the WhisperProcessor
-        return self.audio_processor(waveform, sampling_rate=self.sampling_rate, return_tensors="pt").input_features
+        return self.audio_processor(waveform, sampling_rate=self.sampling_rate, return_tensors="pt",
+                                    max_length=int(self.max_duration * self.sampling_rate)).input_features
 
     @classmethod
     def from_config(cls, cfg=None):
@@ -29,5 +32,6 @@ class WhisperAudioProcessor(BaseProcessor):
 
         model_name = cfg.get("model_name", "openai/whisper-tiny")
         sampling_rate = cfg.get("sampling_rate", 16000)
+        max_duration = cfg.get("max_duration", 30)
 
-        return cls(model_name=model_name, sampling_rate=sampling_rate)
+        return cls(model_name=model_name, sampling_rate=sampling_rate, max_duration=max_duration)
@@ -5,6 +5,18 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
-from OmniMod.runners.runner_base import RunnerBase
+import importlib
+
+from OmniMod.common.registry import registry
 
 __all__ = ["RunnerBase"]
+
+registry.register_lazy("runner_name_mapping", "runner_base", "OmniMod.runners.runner_base")
+
+
+def __getattr__(name):
+    if name == "RunnerBase":
+        from OmniMod.runners.runner_base import RunnerBase
+
+        return RunnerBase
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
@@ -10,11 +10,21 @@ import json
 import logging
 import os
 import time
+from functools import partial
+from glob import glob
 from pathlib import Path
 
 import torch
 import torch.distributed as dist
 import webdataset as wds
+from OmniMod.common.checkpoint import (
+    AsyncCheckpointWriter,
+    checkpoint_metadata,
+    is_safetensors,
+    load_weights,
+    save_weights,
+    write_atomic,
+)
 from OmniMod.common.dist_utils import (
     download_cached_file,
     get_rank,
@@ -58,6 +68,7 @@ class RunnerBase:
         self._scaler = None
         self._dataloaders = None
         self._lr_sched = None
+        self._checkpoint_writer = None
 
         self.start_epoch = 0
 
@@ -333,6 +344,45 @@ class RunnerBase:
     def use_dist_eval_sampler(self):
         return self.config.run_cfg.get("use_dist_eval_sampler", True)
 
+    @property
+    def async_checkpoint(self):
+        """
+        Set to True to write checkpoints in a background thread while training goes on.
+        """
+        return self.config.run_cfg.get("async_checkpoint", False)
+
+    @property
+    def checkpoint_format(self):
+        """
+        "full": checkpoint_{epoch}.pth with the trainable weights, the optimizer state and the config.
+        "adapter": the trainable weights (LoRA adapters and projectors) in checkpoint_{epoch}.safetensors
+        and the optimizer state in optimizer_{epoch}.pth, old files are removed, see _evict_checkpoints.
+        """
+        return self.config.run_cfg.get("checkpoint_format", "full")
+
+    @property
+    def keep_last_checkpoints(self):
+        # 0 keeps every epoch checkpoint
+        return int(self.config.run_cfg.get("keep_last_checkpoints", 0))
+
+    @property
+    def keep_optimizer_states(self):
+        return max(int(self.config.run_cfg.get("keep_optimizer_states", 1)), 1)
+
+    @property
+    def checkpoint_writer(self):
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = AsyncCheckpointWriter()
+
+        return self._checkpoint_writer
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written in the background, if any, is on disk.
+        """
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
+
     @property
     def resume_ckpt_path(self):
         return self.config.run_cfg.get("resume_ckpt_path", None)
@@ -411,6 +461,11 @@ class RunnerBase:
             if self.config.run_cfg.distributed:
                 dist.barrier()
 
+        # the best checkpoint is reloaded for testing, on every rank
+        self.wait_for_checkpoint()
+        if self.config.run_cfg.distributed:
+            dist.barrier()
+
         # testing phase
         test_epoch = "best" if len(self.valid_splits) > 0 else cur_epoch
         self.evaluate(cur_epoch=test_epoch, skip_reload=self.evaluate_only)
@@ -576,6 +631,9 @@ class RunnerBase:
         """
         Save the checkpoint at the current epoch.
         """
+        if self.checkpoint_format == "adapter":
+            return self._save_adapter_checkpoint(cur_epoch, is_best=is_best)
+
         model_no_ddp = self.unwrap_dist_model(self.model)
         param_grad_dic = {
             k: v.requires_grad for (k, v) in model_no_ddp.named_parameters()
@@ -597,26 +655,87 @@ class RunnerBase:
             "checkpoint_{}.pth".format("best" if is_best else cur_epoch),
         )
         logging.info("Saving checkpoint at epoch {} to {}.".format(cur_epoch, save_to))
-        torch.save(save_obj, save_to)
+        if self.async_checkpoint:
+            self.checkpoint_writer.save([(save_obj, save_to, torch.save)])
+        else:
+            torch.save(save_obj, save_to)
+
+    def _save_adapter_checkpoint(self, cur_epoch, is_best=False):
+        """
+        Save the trainable weights to a safetensors file and the optimizer state to a separate file,
+        then remove the files the retention policy no longer keeps.
+        """
+        model_no_ddp = self.unwrap_dist_model(self.model)
+        # only the parameters that are trained, i.e. the LoRA adapters and the projectors, no buffers
+        weights = {k: v for k, v in model_no_ddp.named_parameters() if v.requires_grad}
+        training_state = {
+            "optimizer": self.optimizer.state_dict(),
+            "config": self.config.to_dict(),
+            "scaler": self.scaler.state_dict() if self.scaler else None,
+            "epoch": cur_epoch,
+        }
+        name = "best" if is_best else cur_epoch
+        weights_path = os.path.join(self.output_dir, "checkpoint_{}.safetensors".format(name))
+        optimizer_path = os.path.join(self.output_dir, "optimizer_{}.pth".format(name))
+        files = [
+            (weights, weights_path, partial(save_weights, metadata={"epoch": cur_epoch})),
+            (training_state, optimizer_path, torch.save),
+        ]
+        logging.info("Saving checkpoint at epoch {} to {}.".format(cur_epoch, weights_path))
+        if self.async_checkpoint:
+            self.checkpoint_writer.save(files, callback=self._evict_checkpoints)
+        else:
+            for obj, path, save_fn in files:
+                write_atomic(obj, path, save_fn)
+            self._evict_checkpoints()
+
+    def _evict_checkpoints(self):
+        """
+        Keep checkpoint_best and the last keep_last_checkpoints epoch checkpoints, and the optimizer
+        states of the keep_optimizer_states latest epochs that still have their weights, plus the
+        optimizer state of checkpoint_best. Files are ordered by the epoch in their name.
+        """
+        def saved_epochs(prefix, ext):
+            epochs = {}
+            for path in glob(os.path.join(self.output_dir, "{}*{}".format(prefix, ext))):
+                name = os.path.basename(path)[len(prefix):-len(ext)]
+                if name.isdigit():
+                    epochs[int(name)] = path
+            return [epochs[epoch] for epoch in sorted(epochs)]
+
+        epoch_paths = saved_epochs("checkpoint_", ".safetensors")
+        if self.keep_last_checkpoints > 0:
+            for path in epoch_paths[:-self.keep_last_checkpoints]:
+                logging.info("Removing old checkpoint {}.".format(path))
+                os.remove(path)
+
+        kept = 0
+        for path in reversed(saved_epochs("optimizer_", ".pth")):
+            name = os.path.basename(path)[len("optimizer_"):-len(".pth")]
+            weights_path = os.path.join(self.output_dir, "checkpoint_{}.safetensors".format(name))
+            if kept < self.keep_optimizer_states and os.path.isfile(weights_path):
+                kept += 1
+            else:
+                logging.info("Removing old optimizer state {}.".format(path))
+                os.remove(path)
 
     def _reload_best_model(self, model):
         """
         Load the best checkpoint for evaluation.
         """
-        checkpoint_path = os.path.join(self.output_dir, "checkpoint_best.pth")
+        self.wait_for_checkpoint()
+        checkpoint_path = os.path.join(self.output_dir, "checkpoint_best.safetensors")
+        if not os.path.isfile(checkpoint_path):
+            checkpoint_path = os.path.join(self.output_dir, "checkpoint_best.pth")
 
         logging.info("Loading checkpoint from {}.".format(checkpoint_path))
-        checkpoint = torch.load(checkpoint_path, map_location="cpu")
-        try:
-            model.load_state_dict(checkpoint["model"])
-        except RuntimeError as e:
+        msg = load_weights(model, checkpoint_path)
+        if msg.missing_keys or msg.unexpected_keys:
             logging.warning(
                 """
                 Key mismatch when loading checkpoint. This is expected if only part of the model is saved.
-                Trying to load the model with strict=False.
                 """
             )
-            model.load_state_dict(checkpoint["model"], strict=False)
         return model
 
     def _load_checkpoint(self, url_or_filename):
@@ -628,6 +747,8 @@ class RunnerBase:
                 url_or_filename, check_hash=False, progress=True
             )
             checkpoint = torch.load(cached_file, map_location=self.device)
+        elif os.path.isfile(url_or_filename) and is_safetensors(url_or_filename):
+            return self._load_adapter_checkpoint(url_or_filename)
         elif os.path.isfile(url_or_filename):
             checkpoint = torch.load(url_or_filename, map_location=self.device)
         else:
@@ -636,13 +757,32 @@ class RunnerBase:
         state_dict = checkpoint["model"]
         message = self.unwrap_dist_model(self.model).load_state_dict(state_dict,strict=False)
 
+        self._load_training_state(checkpoint)
+        logging.info("Resume checkpoint from {}".format(url_or_filename))
+
+    def _load_adapter_checkpoint(self, checkpoint_path):
+        """
+        Resume from checkpoint_{epoch}.safetensors and, when it was kept, optimizer_{epoch}.pth.
+        """
+        load_weights(self.unwrap_dist_model(self.model), checkpoint_path)
+        optimizer_path = os.path.join(
+            os.path.dirname(checkpoint_path),
+            os.path.basename(checkpoint_path).replace("checkpoint_", "optimizer_")[:-len(".safetensors")] + ".pth",
+        )
+        if os.path.isfile(optimizer_path):
+            self._load_training_state(torch.load(optimizer_path, map_location=self.device))
+        else:
+            logging.warning("No optimizer state {}, the optimizer starts from scratch.".format(optimizer_path))
+            self.start_epoch = checkpoint_metadata(checkpoint_path).get("epoch", -1) + 1
+        logging.info("Resume checkpoint from {}".format(checkpoint_path))
+
+    def _load_training_state(self, checkpoint):
         self.optimizer.load_state_dict(checkpoint["optimizer"])
         if self.scaler and "scaler" in checkpoint:
             self.scaler.load_state_dict(checkpoint["scaler"])
 
         self.start_epoch = checkpoint["epoch"] + 1
         print("resume the checkpoint")
-        logging.info("Resume checkpoint from {}".format(url_or_filename))
 
     @main_process
     def log_stats(self, stats, split_name):
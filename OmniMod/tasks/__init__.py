@@ -5,9 +5,25 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import importlib
+
 from OmniMod.common.registry import registry
-from OmniMod.tasks.base_task import BaseTask
-from OmniMod.tasks.image_text_pretrain import ImageTextPretrainTask
+
+# imported on first use, the registry imports them on the first lookup of their names
+_lazy_attributes = {
+    "BaseTask": "OmniMod.tasks.base_task",
+    "ImageTextPretrainTask": "OmniMod.tasks.image_text_pretrain",
+}
+
+registry.register_lazy("task_name_mapping", "image_text_pretrain", "OmniMod.tasks.image_text_pretrain")
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
 
 
 def setup_task(cfg):
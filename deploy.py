@@ -29,7 +29,7 @@ def load_model(config_path):
     cfg = Config(config_path)
     model_config = cfg.model_cfg
     model_cls = registry.get_model_class(model_config.arch)
-    model = model_cls.from_config(model_config).to('cuda:0')
+    model = model_cls.from_config(model_config, device='cuda:0').to('cuda:0')
     model.eval()
 
     # Load processors
@@ -56,15 +56,24 @@ def generate_from_inputs(model, vis_processor, audio_processor, max_new_tokens=5
         waveform = audio_processor(waveform_array)
 
         texts = prepare_texts([text], conv_temp)
-        predicts = model.generate(images=image,
-                                audios=waveform,
-                                texts=texts,
-                                max_new_tokens=max_new_tokens,
-                                temperature=temperature,
-                                top_p=top_p,
-                                do_sample=do_sample)
-        
-        return predicts[0]
+        streamer = model.stream_generate(images=image,
+                                         audios=waveform,
+                                         texts=texts,
+                                         max_new_tokens=max_new_tokens,
+                                         temperature=temperature,
+                                         top_p=top_p,
+                                         do_sample=do_sample)
+
+        # yield the partial answer as tokens arrive instead of waiting for the full generation
+        answer = ""
+        try:
+            for deltas in streamer:
+                answer += deltas[0]
+                yield answer
+        finally:
+            # gradio closes the generator when the request is cancelled or the page goes away,
+            # the generation thread must not keep decoding on the shared model
+            streamer.cancel()
 
     return calling
 
@@ -79,12 +88,12 @@ def setup(model, vis_processor, audio_processor):
         fn=generate_from_inputs(model, vis_processor, audio_processor),
         inputs=inputs,
         outputs="text",
-        live=True,
         title="Multimodal Input LLM",
         description="A multimodal LLM interface accepting text, image, and speech inputs and returning text output."
     )
 
-    # Launch the interface
+    # Launch the interface, the queue is required for streaming outputs
+    iface.queue()
     iface.launch()
 
 def parse_args():
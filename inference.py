@@ -1,10 +1,16 @@
+import os
 import json
+import time
 from OmniMod.common.registry import registry
 from OmniMod.common.config import Config
 from OmniMod.conversation.conversation import Conversation, SeparatorStyle
+from OmniMod.models.decode_engine import DecodeEngine
 from PIL import Image
 import torchaudio
 import argparse
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
 
 # Define conversation template
 CONV_VISION = Conversation(
@@ -24,12 +30,15 @@ def prepare_texts(texts, conv_temp):
     texts = [conv.get_prompt() for conv in convs]
     return texts
 
-def load_model(config_path):
-    cfg = Config(config_path)
+def load_model(config_path, device='cuda:0', options=None):
+    cfg = Config(argparse.Namespace(cfg_path=config_path, options=options))
     model_config = cfg.model_cfg
     model_cls = registry.get_model_class(model_config.arch)
-    model = model_cls.from_config(model_config).to('cuda:0')
+    model = model_cls.from_config(model_config, device=device).to(device)
     model.eval()
+    if model.compile_buckets:
+        # compile every bucket now rather than on the first requests
+        model.warmup_compiled()
 
     # Load processors
     key = list(cfg.datasets_cfg.keys())[0]
@@ -70,20 +79,226 @@ def generate_from_inputs(model, vis_processor, audio_processor, input_list, max_
 
     return results
 
+class ManifestDataset(Dataset):
+    """
+    Reads a JSONL manifest where each line is a {"image", "audio", "text"} record.
+    An optional "id" field is used to key the predictions, otherwise the line number is used.
+    """
+    def __init__(self, manifest_path, vis_processor, audio_processor, skip_ids=None):
+        self.vis_processor = vis_processor
+        self.audio_processor = audio_processor
+
+        skip_ids = skip_ids or set()
+        self.records = []
+        with open(manifest_path, 'r') as f:
+            for line_idx, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record["id"] = str(record.get("id", line_idx))
+                if record["id"] not in skip_ids:
+                    self.records.append(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+
+        image = Image.open(record["image"]).convert('RGB')
+        image = self.vis_processor(image)
+        waveform, _ = torchaudio.load(record["audio"])
+        waveform_array = waveform.squeeze().numpy()
+        waveform = self.audio_processor(waveform_array).squeeze(0)
+
+        return {
+            "id": record["id"],
+            "image": image,
+            "audio": waveform,
+            "text": record["text"],
+        }
+
+def load_finished_ids(output_path):
+    """Ids already written to the output file, so a restarted run only redoes the in-flight batch."""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                finished.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                # a partially written last line from a crashed run
+                continue
+    return finished
+
+def drop_partial_line(output_path):
+    """Truncate a last line left without its newline by a crashed run, the next prediction would be appended to it."""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(pos, 1 << 16)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            pos -= step
+            if newline >= 0:
+                pos += newline + 1
+                break
+        if pos < end:
+            f.truncate(pos)
+
+def generate_from_manifest(model, vis_processor, audio_processor, manifest_path, output_path, batch_size=8,
+                           num_workers=4, max_new_tokens=50, temperature=1.0, top_p=0.9, do_sample=False,
+                           engine="hf", max_running=None):
+    if engine == "continuous":
+        return generate_from_manifest_continuous(model, vis_processor, audio_processor, manifest_path, output_path,
+                                                 batch_size=batch_size,
+                                                 num_workers=num_workers,
+                                                 max_new_tokens=max_new_tokens,
+                                                 temperature=temperature,
+                                                 top_p=top_p,
+                                                 do_sample=do_sample,
+                                                 max_running=max_running)
+
+    conv_temp = CONV_VISION.copy()
+    drop_partial_line(output_path)
+    dataset = ManifestDataset(manifest_path, vis_processor, audio_processor,
+                              skip_ids=load_finished_ids(output_path))
+    # the workers preprocess (image decode, transforms, log-mel) the next batches while the model generates
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    num_samples = 0
+    num_tokens = 0
+    start_time = time.time()
+    with open(output_path, 'a') as f:
+        for batch in tqdm(data_loader):
+            texts = prepare_texts(batch["text"], conv_temp)
+            predicts = model.generate(images=batch["image"],
+                                      audios=batch["audio"],
+                                      texts=texts,
+                                      max_new_tokens=max_new_tokens,
+                                      temperature=temperature,
+                                      top_p=top_p,
+                                      do_sample=do_sample)
+            for sample_id, text, predict in zip(batch["id"], batch["text"], predicts):
+                f.write(json.dumps({"id": sample_id, "input": text, "prediction": predict}, ensure_ascii=False) + "\n")
+            f.flush()
+
+            num_samples += len(predicts)
+            num_tokens += sum(len(ids) for ids in model.language_tokenizer(predicts, add_special_tokens=False).input_ids)
+
+    return report_stats(model, num_samples, num_tokens, start_time)
+
+def generate_from_manifest_continuous(model, vis_processor, audio_processor, manifest_path, output_path, batch_size=8,
+                                      num_workers=4, max_new_tokens=50, temperature=1.0, top_p=0.9, do_sample=False,
+                                      max_running=None):
+    """
+    Same as generate_from_manifest, but decodes with the continuous batching engine: a finished
+    sequence frees its slot right away and the next manifest record takes it, instead of the whole
+    batch waiting for its longest answer. Predictions are written in completion order.
+    """
+    conv_temp = CONV_VISION.copy()
+    drop_partial_line(output_path)
+    dataset = ManifestDataset(manifest_path, vis_processor, audio_processor,
+                              skip_ids=load_finished_ids(output_path))
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    engine = DecodeEngine(model,
+                          max_batch_size=max_running or batch_size,
+                          max_new_tokens=max_new_tokens,
+                          temperature=temperature,
+                          top_p=top_p,
+                          do_sample=do_sample)
+
+    counters = {"samples": 0, "tokens": 0}
+    start_time = time.time()
+    with open(output_path, 'a') as f:
+
+        def write_prediction(request):
+            sample_id, text = request.request_id
+            f.write(json.dumps({"id": sample_id, "input": text, "prediction": request.answer}, ensure_ascii=False) + "\n")
+            f.flush()
+            counters["samples"] += 1
+            counters["tokens"] += len(model.language_tokenizer(request.answer, add_special_tokens=False).input_ids)
+
+        for batch in tqdm(data_loader):
+            texts = prepare_texts(batch["text"], conv_temp)
+            with torch.no_grad():
+                context_embs = model.get_generation_context_embs(images=batch["image"],
+                                                                 audios=batch["audio"],
+                                                                 texts=texts)
+            for sample_id, text, context_emb in zip(batch["id"], batch["text"], context_embs):
+                engine.add_request(context_emb, callback=write_prediction, request_id=(sample_id, text))
+            # decode until the new records are admitted, the loader prepares the next batch meanwhile
+            while engine.num_waiting > 0:
+                engine.step()
+        engine.run()
+
+    return report_stats(model, counters["samples"], counters["tokens"], start_time,
+                        decode_steps=engine.num_steps,
+                        mean_running=round(engine.num_tokens / max(engine.num_steps, 1), 3))
+
+def report_stats(model, num_samples, num_tokens, start_time, **extra):
+    elapsed = max(time.time() - start_time, 1e-6)
+    stats = {
+        "samples": num_samples,
+        "tokens": num_tokens,
+        "seconds": round(elapsed, 2),
+        "samples_per_sec": round(num_samples / elapsed, 3),
+        "tokens_per_sec": round(num_tokens / elapsed, 3),
+    }
+    stats.update(extra)
+    stats.update(model.cache_stats())
+    stats.update(model.speculative_stats())
+    stats.update(model.stop_stats())
+    stats.update(model.token_merge_stats())
+    stats.update(model.concurrency_stats())
+    print(json.dumps(stats, indent=2))
+    return stats
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config_path", type=str, default="path_to_your_config_file.yaml")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--options", nargs="+", default=None,
+                        help="override config entries, e.g. model.inference_profile=cpu_int8")
     parser.add_argument("--audio", type=str, default="path_to_your_audio_file.wav")
     parser.add_argument("--image", type=str, default="path_to_your_image_file.jpg")
     parser.add_argument("--text", type=str, default="path_to_your_image_file.jpg")
+    parser.add_argument("--manifest", type=str, default=None, help="JSONL file of {image, audio, text} records, enables batch mode")
+    parser.add_argument("--output", type=str, default="predictions.jsonl", help="JSONL file the batch mode appends predictions to")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--do_sample", action="store_true")
+    parser.add_argument("--engine", type=str, default="hf", choices=["hf", "continuous"],
+                        help="hf: static batches through generate, continuous: iteration-level batching")
+    parser.add_argument("--max_running", type=int, default=None,
+                        help="max sequences decoded together by the continuous engine, defaults to batch_size")
     args = parser.parse_args()
     return args
 
 if __name__ == "__main__":
     args = parse_args()
     config_path = args.config_path
-    model, vis_processor, text_processor, audio_processor = load_model(config_path)
-    
+    model, vis_processor, text_processor, audio_processor = load_model(config_path, device=args.device, options=args.options)
+
+    if args.manifest is not None:
+        generate_from_manifest(model, vis_processor, audio_processor, args.manifest, args.output,
+                               batch_size=args.batch_size,
+                               num_workers=args.num_workers,
+                               max_new_tokens=args.max_new_tokens,
+                               temperature=args.temperature,
+                               top_p=args.top_p,
+                               do_sample=args.do_sample,
+                               engine=args.engine,
+                               max_running=args.max_running)
+        exit(0)
+
     input_list = [
         {"audio": args.audio, "image": args.image, "text": args.text},
     ]
@@ -0,0 +1,107 @@
+"""
+Eager vs torch.compile (with batch bucketing) latency of the encoders and the projector, on CPU.
+
+The modules are randomly initialised with the architecture of the real ones (a shallower EVA
+ViT by default, Whisper tiny's encoder and the projector MLP), so nothing is downloaded. For
+every batch size the compiled module pads the batch up to its bucket; the script checks that
+the outputs match the eager ones and prints the warm-up (compile) time and the latency per
+call. Run it twice with the same --cache_dir to see the effect of the compile cache.
+
+    python scripts/benchmark_compile.py --batch_sizes 1 3 5 8 --buckets 1 2 4 8 --threads 8
+"""
+import os
+import sys
+import time
+import argparse
+from functools import partial
+
+import torch
+import torch.nn as nn
+from transformers import WhisperConfig
+from transformers.models.whisper.modeling_whisper import WhisperEncoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OmniMod.models.compile_utils import compile_bucketed, enable_compile_cache
+from OmniMod.models.text2speech.whisper import WhisperForLiteGPT
+from OmniMod.models.vision_model.eva_vit import VisionTransformer
+
+
+def build_vision(img_size, depth):
+    return VisionTransformer(img_size=img_size, patch_size=14, use_mean_pooling=False, embed_dim=1408, depth=depth,
+                             num_heads=1408 // 88, mlp_ratio=4.3637, qkv_bias=True,
+                             norm_layer=partial(nn.LayerNorm, eps=1e-6))
+
+
+def build_whisper():
+    config = WhisperConfig(d_model=384, encoder_layers=4, encoder_attention_heads=6, encoder_ffn_dim=1536,
+                           max_source_positions=1500)
+    model = WhisperForLiteGPT.__new__(WhisperForLiteGPT)
+    nn.Module.__init__(model)
+    model.asr_encoder = WhisperEncoder(config)
+    model.d_model = config.d_model
+    model.num_tokens = 256
+    model.pooling = nn.AdaptiveAvgPool2d((model.num_tokens, model.d_model))
+    return model
+
+
+def build_projector(in_dim, hidden_size):
+    return nn.Sequential(nn.Linear(in_dim, 5632), nn.GELU(), nn.Linear(5632, hidden_size))
+
+
+def latency(module, inputs, iters):
+    module(inputs)
+    start = time.perf_counter()
+    for _ in range(iters):
+        module(inputs)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 3, 5, 8])
+    parser.add_argument("--buckets", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--img_size", type=int, default=224)
+    parser.add_argument("--vit_depth", type=int, default=6, help="the real EVA ViT-g has 39 blocks")
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--mode", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default="torch_compile_cache")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    enable_compile_cache(args.cache_dir)
+    torch.manual_seed(0)
+
+    num_patches = (args.img_size // 14) ** 2
+    modules = {
+        "eva_vit": (build_vision(args.img_size, args.vit_depth),
+                    lambda b: torch.randn(b, 3, args.img_size, args.img_size)),
+        "whisper": (build_whisper(), lambda b: torch.randn(b, 80, 3000)),
+        "projector": (build_projector(1408 * 4, 4096), lambda b: torch.randn(b, num_patches // 4, 1408 * 4)),
+    }
+
+    print("{:>10} {:>6} {:>8} {:>10} {:>12} {:>8}".format("module", "batch", "bucket", "eager ms", "compiled ms", "speedup"))
+    with torch.no_grad():
+        for name, (module, make_inputs) in modules.items():
+            module.eval()
+            eager = {b: latency(module, make_inputs(b), args.iters) for b in args.batch_sizes}
+            inputs = {b: make_inputs(b) for b in args.batch_sizes}
+            expected = {b: module(inputs[b]) for b in args.batch_sizes}
+
+            compile_bucketed(module, args.buckets, mode=args.mode)
+            start = time.perf_counter()
+            for bucket in args.buckets:
+                module(make_inputs(bucket))
+            print("{:>10} warm-up of {} buckets: {:.1f}s".format(name, len(args.buckets), time.perf_counter() - start))
+
+            for b in args.batch_sizes:
+                assert torch.allclose(module(inputs[b]), expected[b], atol=1e-3, rtol=1e-3), "outputs differ"
+                compiled = latency(module, inputs[b], args.iters)
+                bucket = next((x for x in args.buckets if x >= b), args.buckets[-1])
+                print("{:>10} {:>6} {:>8} {:>10.2f} {:>12.2f} {:>7.2f}x".format(
+                    name, b, bucket, eager[b], compiled, eager[b] / compiled))
+
+
+if __name__ == "__main__":
+    main()
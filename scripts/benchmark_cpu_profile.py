@@ -0,0 +1,78 @@
+"""
+CPU throughput and answer agreement of the cpu_int8 inference profile against cpu_fp32.
+
+Runs the records of a manifest (the JSONL of inference.py) through batch inference on the CPU
+once per profile, one model at a time so that only one copy of the weights is in memory, and
+reports the samples and tokens per second of each profile, the exact match rate of the int8
+answers against the float32 ones and their mean character-level similarity.
+
+    python scripts/benchmark_cpu_profile.py --config_path eval_configs/evaluate.yaml \
+        --manifest cases.jsonl --limit 32 --cpu_threads 16
+"""
+import os
+import sys
+import gc
+import json
+import argparse
+import difflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import generate_from_manifest, load_model
+
+
+def read_predictions(path):
+    with open(path, 'r') as f:
+        return {record["id"]: record["prediction"] for record in map(json.loads, f)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", type=str, required=True)
+    parser.add_argument("--manifest", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, default="cpu_profile_predictions")
+    parser.add_argument("--limit", type=int, default=32, help="records of the manifest to run")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--max_new_tokens", type=int, default=50)
+    parser.add_argument("--cpu_threads", type=int, default=0, help="0: all the cores this process may use")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, "manifest.jsonl")
+    with open(args.manifest, 'r') as f, open(manifest_path, 'w') as out:
+        lines = [line for line in f if line.strip()][:args.limit]
+        out.writelines(lines)
+
+    stats, predictions = {}, {}
+    for profile in ["cpu_fp32", "cpu_int8"]:
+        output_path = os.path.join(args.output_dir, "{}.jsonl".format(profile))
+        if os.path.exists(output_path):
+            os.remove(output_path)  # generate_from_manifest resumes from existing predictions
+        options = ["model.inference_profile={}".format(profile), "model.cpu_threads={}".format(args.cpu_threads)]
+        model, vis_processor, _, audio_processor = load_model(args.config_path, device="cpu", options=options)
+        stats[profile] = generate_from_manifest(model, vis_processor, audio_processor, manifest_path, output_path,
+                                                batch_size=args.batch_size,
+                                                num_workers=args.num_workers,
+                                                max_new_tokens=args.max_new_tokens)
+        predictions[profile] = read_predictions(output_path)
+        del model
+        gc.collect()
+
+    baseline, quantized = predictions["cpu_fp32"], predictions["cpu_int8"]
+    ids = [sample_id for sample_id in baseline if sample_id in quantized]
+    exact = sum(baseline[i].strip() == quantized[i].strip() for i in ids)
+    similarity = sum(difflib.SequenceMatcher(None, baseline[i], quantized[i]).ratio() for i in ids)
+    print(json.dumps({
+        "samples": len(ids),
+        "fp32_samples_per_sec": stats["cpu_fp32"]["samples_per_sec"],
+        "int8_samples_per_sec": stats["cpu_int8"]["samples_per_sec"],
+        "fp32_tokens_per_sec": stats["cpu_fp32"]["tokens_per_sec"],
+        "int8_tokens_per_sec": stats["cpu_int8"]["tokens_per_sec"],
+        "speedup": round(stats["cpu_int8"]["samples_per_sec"] / max(stats["cpu_fp32"]["samples_per_sec"], 1e-9), 3),
+        "exact_match": round(exact / max(len(ids), 1), 4),
+        "mean_similarity": round(similarity / max(len(ids), 1), 4),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Peak host memory and time of building the EVA ViT and loading its weights, the usual way (random
+init, then a copy of the checkpoint over it) and with meta_init (parameters created on the meta
+device, then taken from the checkpoint on --device).
+
+The ViT has the architecture of EVA ViT-g (a shallower one by default); its randomly initialised
+weights are first written to a safetensors file. Each mode runs in its own process so that the
+peak resident memory of one does not hide the other's.
+
+    python scripts/benchmark_meta_init.py --depth 20 --device cpu
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OmniMod.common.checkpoint import load_weights, peak_rss_mb, rss_mb, save_weights
+from OmniMod.models.meta_init import init_empty, materialize
+from OmniMod.models.vision_model.eva_vit import VisionTransformer
+
+
+def build(args, meta_init=False):
+    with init_empty(meta_init):
+        return VisionTransformer(img_size=args.img_size, patch_size=14, use_mean_pooling=False, embed_dim=1408,
+                                 depth=args.depth, num_heads=1408 // 88, mlp_ratio=4.3637, qkv_bias=True,
+                                 norm_layer=partial(nn.LayerNorm, eps=1e-6))
+
+
+def run(args):
+    before = rss_mb()
+    start = time.perf_counter()
+    meta_init = args.mode == "meta_init"
+    model = build(args, meta_init=meta_init)
+    load_weights(model, args.checkpoint, strict=True, device=args.device)
+    if meta_init:
+        materialize(model, args.device)
+    model.to(args.device)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": round(seconds, 2), "peak_mb": round(peak_rss_mb() - before, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img_size", type=int, default=448)
+    parser.add_argument("--depth", type=int, default=20, help="the real EVA ViT-g has 39 blocks")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--mode", type=str, default=None, choices=["eager", "meta_init"],
+                        help="run a single mode in this process (used by the script itself)")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mode:
+        return run(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = os.path.join(tmp_dir, "vit.safetensors")
+        save_weights(build(args).state_dict(), checkpoint)
+        size_mb = os.path.getsize(checkpoint) / (1 << 20)
+
+        results = {}
+        for mode in ["eager", "meta_init"]:
+            command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--checkpoint", checkpoint,
+                       "--img_size", str(args.img_size), "--depth", str(args.depth), "--device", args.device]
+            stdout = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results[mode] = json.loads(stdout.strip().splitlines()[-1])
+
+    print("checkpoint {:.1f} MB".format(size_mb))
+    print("{:>10} {:>10} {:>10}".format("mode", "seconds", "peak MB"))
+    for mode in ["eager", "meta_init"]:
+        print("{:>10} {:>10.2f} {:>10.1f}".format(mode, results[mode]["seconds"], results[mode]["peak_mb"]))
+
+
+if __name__ == "__main__":
+    main()
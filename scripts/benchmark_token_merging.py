@@ -0,0 +1,98 @@
+"""
+Context length and latency with and without visual token merging.
+
+Runs the records of a manifest (the JSONL of inference.py) through the model once with every
+patch token and once per --budgets value (img_token_budget, visual tokens per image), and
+reports the mean context length, the prefill time (one forward over the context) and the
+end-to-end generate time per sample. The predictions of each budget are written next to
+--output so that their accuracy can be compared.
+
+    python scripts/benchmark_token_merging.py --config_path eval_configs/evaluate.yaml \
+        --manifest cases.jsonl --budgets 32 16
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import CONV_VISION, ManifestDataset, load_model, prepare_texts
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def run(model, data_loader, max_new_tokens, output_path):
+    conv_temp = CONV_VISION.copy()
+    context_tokens = prefill_seconds = generate_seconds = 0.0
+    num_samples = 0
+    with open(output_path, 'w') as f:
+        for batch in data_loader:
+            texts = prepare_texts(batch["text"], conv_temp)
+
+            synchronize(model.device)
+            start = time.perf_counter()
+            embs, attn_mask = model.prepare_generation_inputs(batch["image"], batch["audio"], texts)
+            with model.maybe_autocast():
+                model.language_model(inputs_embeds=embs, attention_mask=attn_mask)
+            synchronize(model.device)
+            prefill_seconds += time.perf_counter() - start
+            context_tokens += attn_mask.sum().item()
+
+            start = time.perf_counter()
+            predicts = model.generate(images=batch["image"], audios=batch["audio"], texts=texts,
+                                      max_new_tokens=max_new_tokens)
+            synchronize(model.device)
+            generate_seconds += time.perf_counter() - start
+
+            for sample_id, predict in zip(batch["id"], predicts):
+                f.write(json.dumps({"id": sample_id, "prediction": predict}, ensure_ascii=False) + "\n")
+            num_samples += len(predicts)
+
+    return {
+        "context_tokens": round(context_tokens / num_samples, 1),
+        "prefill_ms": round(prefill_seconds / num_samples * 1000, 2),
+        "generate_ms": round(generate_seconds / num_samples * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", type=str, required=True)
+    parser.add_argument("--manifest", type=str, required=True)
+    parser.add_argument("--output", type=str, default="predictions_token_merging.jsonl")
+    parser.add_argument("--budgets", type=int, nargs="+", default=[32, 16])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    model, vis_processor, _, audio_processor = load_model(args.config_path)
+    dataset = ManifestDataset(args.manifest, vis_processor, audio_processor)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    model.clear_caches()
+    model.img_cache = None  # every run has to encode the images itself
+
+    results = {}
+    root, ext = os.path.splitext(args.output)
+    for budget in [0] + args.budgets:
+        model.enable_token_merging(budget)
+        results[budget] = run(model, data_loader, args.max_new_tokens, "{}_{}{}".format(root, budget, ext))
+
+    baseline = results[0]
+    print("{:>8} {:>10} {:>12} {:>12} {:>10}".format("budget", "context", "prefill ms", "generate ms", "speedup"))
+    for budget, result in results.items():
+        print("{:>8} {:>10} {:>12} {:>12} {:>9.2f}x".format(
+            budget or "off", result["context_tokens"], result["prefill_ms"], result["generate_ms"],
+            baseline["generate_ms"] / max(result["generate_ms"], 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
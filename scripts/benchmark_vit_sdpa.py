@@ -0,0 +1,103 @@
+"""
+Latency and peak memory of the EVA ViT with the explicit attention and with vit_sdpa, on CPU.
+
+The ViT is randomly initialised with the architecture of EVA ViT-g (a shallower one by default)
+and, with --rel_pos_bias, with a relative position bias table per block. Each attention runs in
+its own process so that the peak resident memory of one does not hide the other's; the script
+checks that the outputs match and prints the latency per forward and the peak memory the forward
+added on top of the weights.
+
+    python scripts/benchmark_vit_sdpa.py --img_size 448 --depth 8 --batch_size 2 --threads 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OmniMod.models.vision_model.eva_vit import VisionTransformer
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = VisionTransformer(img_size=args.img_size, patch_size=14, use_mean_pooling=False, embed_dim=1408,
+                              depth=args.depth, num_heads=1408 // 88, mlp_ratio=4.3637, qkv_bias=True,
+                              norm_layer=partial(nn.LayerNorm, eps=1e-6), use_rel_pos_bias=args.rel_pos_bias)
+    if args.rel_pos_bias:
+        for blk in model.blocks:
+            nn.init.normal_(blk.attn.relative_position_bias_table, std=0.5)
+    model.eval()
+    model.set_sdpa(args.attention == "sdpa")
+    images = torch.randn(args.batch_size, 3, args.img_size, args.img_size)
+
+    with torch.no_grad():
+        before = rss_mb()
+        output = model(images)
+        peak = peak_rss_mb() - before
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            model(images)
+        latency = (time.perf_counter() - start) / args.iters * 1000
+
+    torch.save(output, args.output)
+    print(json.dumps({"latency_ms": round(latency, 2), "peak_mb": round(peak, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img_size", type=int, default=448)
+    parser.add_argument("--depth", type=int, default=8, help="the real EVA ViT-g has 39 blocks")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--rel_pos_bias", action="store_true", help="give every block a relative position bias")
+    parser.add_argument("--attention", type=str, default=None, choices=["eager", "sdpa"],
+                        help="run a single attention in this process (used by the script itself)")
+    parser.add_argument("--output", type=str, default="vit_sdpa_output.pt")
+    args = parser.parse_args()
+
+    if args.attention:
+        return run(args)
+
+    results = {}
+    for attention in ["eager", "sdpa"]:
+        output = "{}.{}".format(args.output, attention)
+        command = [sys.executable, os.path.abspath(__file__), "--attention", attention, "--output", output,
+                   "--img_size", str(args.img_size), "--depth", str(args.depth), "--iters", str(args.iters),
+                   "--batch_size", str(args.batch_size), "--threads", str(args.threads)]
+        if args.rel_pos_bias:
+            command.append("--rel_pos_bias")
+        stdout = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results[attention] = json.loads(stdout.strip().splitlines()[-1])
+        results[attention]["output"] = torch.load(output)
+        os.remove(output)
+
+    max_diff = (results["eager"]["output"] - results["sdpa"]["output"]).abs().max().item()
+    print("{:>8} {:>12} {:>10}".format("attention", "latency ms", "peak MB"))
+    for attention in ["eager", "sdpa"]:
+        print("{:>8} {:>12.2f} {:>10.1f}".format(attention, results[attention]["latency_ms"],
+                                                  results[attention]["peak_mb"]))
+    print("speedup {:.2f}x, max abs difference of the outputs {:.2e}".format(
+        results["eager"]["latency_ms"] / results["sdpa"]["latency_ms"], max_diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Fixed (30 s) vs duration-aware Whisper encoding of the spoken questions.
+
+Encodes the audio of a manifest (the JSONL of inference.py, only "audio" is read) in batches
+with WhisperForLiteGPT in both modes and reports the encoder time per question, the number of
+audio tokens handed to the LLM, and how close the variable length tokens are to the tokens the
+fixed mode produces for the same time span (mean cosine similarity). The end-to-end accuracy
+is measured by running evaluate.py with audio_variable_length set and unset.
+
+    python scripts/benchmark_whisper_length.py --manifest cases.jsonl --batch_size 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+import torchaudio
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OmniMod.models.text2speech.whisper import WhisperForLiteGPT
+from OmniMod.processors.whisper_processors import WhisperAudioProcessor
+
+
+def load_features(manifest_path, audio_processor, limit):
+    features = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            waveform, _ = torchaudio.load(json.loads(line)["audio"])
+            features.append(audio_processor(waveform.squeeze().numpy()).squeeze(0))
+            if len(features) == limit:
+                break
+    return torch.stack(features)
+
+
+def timed(fn, device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True)
+    parser.add_argument("--limit", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--bucket_frames", type=int, default=200)
+    parser.add_argument("--processor", type=str, default="openai/whisper-tiny")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    features = load_features(args.manifest, WhisperAudioProcessor(model_name=args.processor), args.limit)
+    encoder = WhisperForLiteGPT().to(args.device).eval()
+    encoder.bucket_frames = args.bucket_frames
+
+    fixed_time = variable_time = 0.0
+    num_tokens, similarities, durations = 0, [], []
+    with torch.no_grad():
+        # warm up both paths
+        encoder(features[:1].to(args.device))
+        encoder.encode_variable_length(features[:1].to(args.device))
+        for start in range(0, len(features), args.batch_size):
+            batch = features[start:start + args.batch_size].to(args.device)
+            fixed, seconds = timed(lambda: encoder(batch), args.device)
+            fixed_time += seconds
+            (variable, token_lens), seconds = timed(lambda: encoder.encode_variable_length(batch), args.device)
+            variable_time += seconds
+
+            durations.extend((encoder.mel_lengths(batch) / 100).tolist())
+            for i, length in enumerate(token_lens.tolist()):
+                num_tokens += length
+                similarities.append(F.cosine_similarity(variable[i, :length], fixed[i, :length], dim=-1).mean().item())
+
+    num_samples = len(features)
+    print(json.dumps({
+        "samples": num_samples,
+        "mean_duration_s": round(sum(durations) / num_samples, 2),
+        "fixed_ms_per_sample": round(fixed_time / num_samples * 1000, 3),
+        "variable_ms_per_sample": round(variable_time / num_samples * 1000, 3),
+        "encoder_speedup": round(fixed_time / max(variable_time, 1e-9), 2),
+        "fixed_tokens_per_sample": encoder.num_tokens,
+        "variable_tokens_per_sample": round(num_tokens / num_samples, 1),
+        "mean_cosine_similarity": round(sum(similarities) / num_samples, 4),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Convert .pth checkpoints (the ckpt of the model config, checkpoint_best.pth of a run) to
+safetensors files, which from_config and the runner memory-map and copy tensor by tensor into
+the model instead of unpickling the whole file. Only the model weights are converted, with the
+epoch and config as metadata; keep the .pth to resume training.
+
+    python scripts/convert_checkpoint.py checkpoint_stage3.pth output/run/checkpoint_best.pth
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OmniMod.common.checkpoint import convert_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoints", type=str, nargs="+", help=".pth files to convert")
+    parser.add_argument("--output_dir", type=str, default=None, help="default: next to each .pth file")
+    args = parser.parse_args()
+
+    for src in args.checkpoints:
+        dst = None
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            dst = os.path.join(args.output_dir, os.path.splitext(os.path.basename(src))[0] + ".safetensors")
+        start = time.time()
+        dst = convert_checkpoint(src, dst)
+        print("{} ({:.1f} MB) -> {} ({:.1f} MB) in {:.1f}s".format(
+            src, os.path.getsize(src) / (1 << 20), dst, os.path.getsize(dst) / (1 << 20), time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
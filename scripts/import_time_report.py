@@ -0,0 +1,67 @@
+"""
+Startup cost of importing OmniMod (or of running a script) broken down per module.
+
+Runs the target in a fresh interpreter with `python -X importtime` and reports the total import
+time, the self time summed per top-level package (torch, transformers, open_clip, ...) and the
+modules with the largest cumulative time, i.e. including everything they import.
+
+    python scripts/import_time_report.py                      # import OmniMod
+    python scripts/import_time_report.py --module OmniMod.models.OmniMod
+    python scripts/import_time_report.py --script inference.py --args=--help
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+from collections import defaultdict
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(command, cwd):
+    stderr = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=cwd,
+                            capture_output=True, text=True).stderr
+    records = []
+    for line in stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            records.append((name, int(self_us), int(cumulative_us), len(indent)))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", type=str, default="OmniMod", help="module to import")
+    parser.add_argument("--script", type=str, default=None, help="script to run instead of importing --module")
+    parser.add_argument("--args", type=str, default="", help="arguments of --script, e.g. --args=--help")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if args.script:
+        command = [args.script] + args.args.split()
+    else:
+        command = ["-c", "import {}".format(args.module)]
+    records = import_times(command, repo_root)
+    if not records:
+        sys.exit("no import times recorded, does the target run?")
+
+    top_level = min(depth for _, _, _, depth in records)
+    total = sum(cumulative for _, _, cumulative, depth in records if depth == top_level)
+    per_package = defaultdict(int)
+    for name, self_us, _, _ in records:
+        per_package[name.split(".")[0]] += self_us
+
+    print("total import time {:.2f}s, {} modules".format(total / 1e6, len(records)))
+    print("\nself time per top-level package")
+    for package, self_us in sorted(per_package.items(), key=lambda item: -item[1])[:args.top]:
+        print("{:>10.1f} ms {:>6.1%}  {}".format(self_us / 1e3, self_us / total, package))
+    print("\nlargest cumulative time (the module and what it imports)")
+    for name, _, cumulative, depth in sorted(records, key=lambda record: -record[2])[:args.top]:
+        print("{:>10.1f} ms {:>6.1%}  {}{}".format(cumulative / 1e3, cumulative / total, " " * (depth - top_level), name))
+
+
+if __name__ == "__main__":
+    main()
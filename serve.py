@@ -0,0 +1,371 @@
+import io
+import time
+import base64
+import queue
+import asyncio
+import logging
+import argparse
+import threading
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchaudio
+import uvicorn
+from PIL import Image
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+from inference import CONV_VISION, load_model, prepare_texts
+from OmniMod.models.decode_engine import DecodeEngine
+
+
+class GenerateRequest(BaseModel):
+    text: str
+    image: str  # base64 encoded image file
+    audio: str  # base64 encoded wav file
+
+
+class BatchStats:
+    """Queue, batch size and latency counters used to size the batching window."""
+
+    def __init__(self, window_size=1000):
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window_size)
+        self.queue_waits = deque(maxlen=window_size)
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def update(self, batch_size, queue_waits, latencies):
+        self.record_batch(batch_size)
+        self.record_requests(queue_waits, latencies)
+
+    def record_batch(self, batch_size):
+        self.num_batches += 1
+        self.batch_sizes[batch_size] += 1
+
+    def record_requests(self, queue_waits, latencies):
+        self.num_requests += len(latencies)
+        self.queue_waits.extend(queue_waits)
+        self.latencies.extend(latencies)
+
+    @staticmethod
+    def _percentiles(values):
+        if len(values) == 0:
+            return {"p50": None, "p95": None, "p99": None, "max": None}
+        values = sorted(values)
+        pick = lambda q: round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 2)
+        return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1] * 1000, 2)}
+
+    def summary(self, queue_depth):
+        return {
+            "queue_depth": queue_depth,
+            "num_requests": self.num_requests,
+            "num_batches": self.num_batches,
+            "mean_batch_size": round(sum(size * count for size, count in self.batch_sizes.items()) / self.num_batches, 3)
+            if self.num_batches else None,
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+            "queue_wait_ms": self._percentiles(self.queue_waits),
+            "latency_ms": self._percentiles(self.latencies),
+        }
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for a blocking generate function.
+
+    A batch is dispatched once it holds max_batch_size requests or max_wait_ms after
+    its first request arrived, whichever comes first. generate_fn receives a list of
+    preprocessed items and must return one answer per item; it runs on a single
+    worker thread so the model only ever sees one batch at a time.
+    """
+
+    def __init__(self, generate_fn, max_batch_size=8, max_wait_ms=20):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.stats = BatchStats()
+
+        self.queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        self._executor.shutdown(wait=False)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # take whatever else is already waiting, the window only bounds how long we wait for it
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            # any error fails the requests of the batch, the worker itself must survive it or
+            # every later request would wait forever
+            try:
+                batch = await self._collect_batch()
+                items = [item for item, _, _ in batch]
+                dispatch_time = time.perf_counter()
+                answers = await loop.run_in_executor(self._executor, self.generate_fn, items)
+                if len(answers) != len(batch):
+                    # the answers cannot be matched to the requests
+                    raise RuntimeError("generate_fn returned {} answers for a batch of {} requests".format(
+                        len(answers), len(batch)))
+
+                finish_time = time.perf_counter()
+                for (_, future, _), answer in zip(batch, answers):
+                    if not future.done():
+                        future.set_result(answer)
+                self.stats.update(
+                    len(batch),
+                    queue_waits=[dispatch_time - submit_time for _, _, submit_time in batch],
+                    latencies=[finish_time - submit_time for _, _, submit_time in batch],
+                )
+            except Exception as e:
+                logging.exception("Micro-batch failed")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class EngineBatcher:
+    """
+    Drop-in replacement for MicroBatcher that decodes with the continuous batching engine.
+
+    New requests join the running batch at the next decoding step instead of waiting for the
+    current batch to finish, and each request is answered as soon as its own sequence ends.
+    The engine runs on a dedicated thread; context_fn turns a list of preprocessed items into
+    their context embeddings. In the stats a "batch" is one decoding step.
+    """
+
+    def __init__(self, engine, context_fn):
+        self.engine = engine
+        self.context_fn = context_fn
+        self.stats = BatchStats()
+
+        self.pending = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        self.pending.put(None)
+
+    @property
+    def queue_depth(self):
+        return self.pending.qsize() + self.engine.num_waiting
+
+    async def submit(self, item):
+        future = self._loop.create_future()
+        self.pending.put((item, future, time.perf_counter()))
+        return await future
+
+    def _resolve(self, future, answer=None, error=None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(answer)
+
+    def _on_finished(self, request):
+        future, submit_time = request.request_id
+        self.stats.record_requests(
+            queue_waits=[request.first_token_time - submit_time],
+            latencies=[request.finish_time - submit_time],
+        )
+        self._loop.call_soon_threadsafe(self._resolve, future, request.answer)
+
+    def _admit(self):
+        # block for new work only when there is nothing to decode
+        entries = [self.pending.get()] if self.engine.is_idle() else []
+        while True:
+            try:
+                entries.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        entries = [entry for entry in entries if entry is not None]
+        if not entries:
+            return
+
+        try:
+            context_embs = self.context_fn([item for item, _, _ in entries])
+        except Exception as e:
+            for _, future, _ in entries:
+                self._loop.call_soon_threadsafe(self._resolve, future, None, e)
+            return
+        for (_, future, submit_time), context_emb in zip(entries, context_embs):
+            self.engine.add_request(context_emb, callback=self._on_finished, request_id=(future, submit_time))
+
+    def _fail_running(self, error):
+        requests = list(self.engine.waiting) + list(self.engine.running)
+        self.engine.waiting.clear()
+        self.engine.running = []
+        self.engine.past_key_values = self.engine.attention_mask = self.engine.logits = None
+        for request in requests:
+            self._loop.call_soon_threadsafe(self._resolve, request.request_id[0], None, error)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._admit()
+            if self.engine.is_idle():
+                continue
+            num_tokens = self.engine.num_tokens
+            try:
+                self.engine.step()
+            except Exception as e:
+                self._fail_running(e)
+                continue
+            # one token per running sequence
+            self.stats.record_batch(self.engine.num_tokens - num_tokens)
+
+
+def make_generate_fn(model, max_new_tokens=50, temperature=1.0, top_p=0.9, do_sample=False):
+    conv_temp = CONV_VISION.copy()
+
+    def generate_fn(items):
+        images = torch.stack([item["image"] for item in items])
+        audios = torch.stack([item["audio"] for item in items])
+        texts = prepare_texts([item["text"] for item in items], conv_temp)
+        return model.generate(images=images,
+                              audios=audios,
+                              texts=texts,
+                              max_new_tokens=max_new_tokens,
+                              temperature=temperature,
+                              top_p=top_p,
+                              do_sample=do_sample)
+
+    return generate_fn
+
+
+def make_context_fn(model):
+    conv_temp = CONV_VISION.copy()
+
+    @torch.no_grad()
+    def context_fn(items):
+        images = torch.stack([item["image"] for item in items])
+        audios = torch.stack([item["audio"] for item in items])
+        texts = prepare_texts([item["text"] for item in items], conv_temp)
+        return model.get_generation_context_embs(images=images, audios=audios, texts=texts)
+
+    return context_fn
+
+
+def make_preprocess_fn(vis_processor, audio_processor):
+
+    def preprocess(request):
+        image = Image.open(io.BytesIO(base64.b64decode(request.image))).convert('RGB')
+        image = vis_processor(image)
+        waveform, _ = torchaudio.load(io.BytesIO(base64.b64decode(request.audio)))
+        waveform_array = waveform.squeeze().numpy()
+        waveform = audio_processor(waveform_array).squeeze(0)
+        return {"image": image, "audio": waveform, "text": request.text}
+
+    return preprocess
+
+
+def build_app(batcher, preprocess_fn):
+    @asynccontextmanager
+    async def lifespan(app):
+        # the batcher runs for the lifetime of the server
+        batcher.start()
+        try:
+            yield
+        finally:
+            await batcher.stop()
+
+    app = FastAPI(title="SilVar-Med inference", lifespan=lifespan)
+
+    @app.post("/generate")
+    async def generate(request: GenerateRequest):
+        start_time = time.perf_counter()
+        try:
+            # decoding and the log-mel transform run off the event loop
+            item = await asyncio.get_running_loop().run_in_executor(None, preprocess_fn, request)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail="Invalid input: {}".format(e))
+        answer = await batcher.submit(item)
+        return {"prediction": answer, "latency_ms": round((time.perf_counter() - start_time) * 1000, 2)}
+
+    @app.get("/metrics")
+    async def metrics():
+        return batcher.stats.summary(batcher.queue_depth)
+
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_path", type=str, default="./config.yaml")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--engine", type=str, default="hf", choices=["hf", "continuous"],
+                        help="hf: micro-batches through generate, continuous: iteration-level batching")
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_wait_ms", type=float, default=20)
+    parser.add_argument("--max_new_tokens", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--do_sample", action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    model, vis_processor, text_processor, audio_processor = load_model(args.config_path, device=args.device)
+
+    if args.engine == "continuous":
+        engine = DecodeEngine(model,
+                              max_batch_size=args.max_batch_size,
+                              max_new_tokens=args.max_new_tokens,
+                              temperature=args.temperature,
+                              top_p=args.top_p,
+                              do_sample=args.do_sample)
+        batcher = EngineBatcher(engine, make_context_fn(model))
+    else:
+        generate_fn = make_generate_fn(model,
+                                       max_new_tokens=args.max_new_tokens,
+                                       temperature=args.temperature,
+                                       top_p=args.top_p,
+                                       do_sample=args.do_sample)
+        batcher = MicroBatcher(generate_fn, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    app = build_app(batcher, make_preprocess_fn(vis_processor, audio_processor))
+    uvicorn.run(app, host=args.host, port=args.port)
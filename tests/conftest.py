@@ -0,0 +1,127 @@
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ["[INST]", "[/INST]", "<Img>", "</Img>", "what", "is", "in", "the", "image", "describe", "this",
+         "a", "cat", "dog", "on", "table", "and", "how", "many", "are", "there"] + ["w{}".format(i) for i in range(40)]
+
+
+def tiny_tokenizer(eos_token="</s>"):
+    """
+    Word level tokenizer with the special tokens of the Llama tokenizer, built offline. With another
+    eos_token, "</s>" is plain text split into the pieces "<", "/", "s", ">" as with Llama-3.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors, decoders
+    from transformers import PreTrainedTokenizerFast
+
+    specials = ["<unk>", "<s>", eos_token, "$$"]
+    pieces = ["<", "##/", "##s", "##>"] if eos_token != "</s>" else []
+    vocab = {token: i for i, token in enumerate(specials + WORDS + pieces)}
+    tokenizer = Tokenizer(models.WordPiece(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 1)])
+    tokenizer.decoder = decoders.WordPiece(prefix="##")
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token=eos_token,
+                                        unk_token="<unk>", pad_token="$$")
+    return tokenizer
+
+
+def tiny_llama(vocab_size, seed=0):
+    from transformers import LlamaConfig
+    from OmniMod.models.language_model.modeling_llama import LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256,
+                         bos_token_id=1, eos_token_id=2, pad_token_id=3)
+    model = LlamaForCausalLM(config).eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
+
+
+class TinyVisionEncoder(nn.Module):
+    """Patch embedding only: [B, 3, 16, 16] images -> [B, 16, 8] patch features."""
+    num_features = 8
+
+    def __init__(self):
+        super().__init__()
+        self.patch_embed = nn.Conv2d(3, self.num_features, kernel_size=4, stride=4)
+
+    def forward(self, images):
+        return self.patch_embed(images).flatten(2).transpose(1, 2)
+
+
+class TinyAudioEncoder(nn.Module):
+    """
+    [B, 80, T] log-mel features -> T / 2 tokens. All-zero trailing frames are padding, so questions
+    of different durations give different numbers of tokens, like Whisper with variable length.
+    """
+    d_model = 8
+    window_frames = 3000
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(80, self.d_model)
+
+    def encode(self, features):
+        tokens = self.proj(features.transpose(1, 2))[:, ::2]
+        frames = (features.abs().sum(1) > 0).long()
+        num_frames = (frames * torch.arange(1, frames.shape[1] + 1)).argmax(1) + 1
+        token_lens = (num_frames + 1) // 2
+        if bool((token_lens == tokens.shape[1]).all()):
+            return tokens, None
+        return tokens, token_lens
+
+
+def build_tiny_model(eos_token="</s>", **kwargs):
+    from OmniMod.models.base_model import LayerNorm
+    from OmniMod.models.OmniMod import OmniMod
+
+    class TinyOmniMod(OmniMod):
+        def init_llm(self, language_model_path, **llm_kwargs):
+            tokenizer = tiny_tokenizer(eos_token)
+            return tiny_llama(len(tokenizer)), tokenizer
+
+        @classmethod
+        def init_vision_encoder(cls, model_name, freeze, **encoder_kwargs):
+            return TinyVisionEncoder(), LayerNorm(TinyVisionEncoder.num_features), 4
+
+        @classmethod
+        def init_audio_encoder(cls, model_name, freeze, **encoder_kwargs):
+            return TinyAudioEncoder()
+
+    torch.manual_seed(0)
+    kwargs = dict(dict(language_model="tiny", img_size=16, precision="fp32", max_txt_len=64), **kwargs)
+    model = TinyOmniMod(**kwargs)
+    # random projectors give embeddings far larger than the token embeddings, scale them down
+    with torch.no_grad():
+        for proj in [model.language_proj, model.audio_language_proj]:
+            for param in proj.parameters():
+                param.mul_(0.1)
+    return model.eval()
+
+
+@pytest.fixture
+def tiny_model():
+    return build_tiny_model()
+
+
+def make_inputs(batch_size, num_frames=(40,), seed=0):
+    """Images, ragged audio questions (all-zero padded frames) and prompts for a tiny model."""
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randn(batch_size, 3, 16, 16, generator=generator)
+    audios = torch.zeros(batch_size, 80, max(num_frames))
+    for i in range(batch_size):
+        frames = num_frames[i % len(num_frames)]
+        audios[i, :, :frames] = torch.randn(80, frames, generator=generator)
+    prompts = ["[INST] <Img><ImageHere></Img> what is in the image [/INST]",
+               "[INST] <Img><ImageHere></Img> describe this [/INST]",
+               "[INST] <Img><ImageHere></Img> how many cat are there on the table [/INST]"]
+    texts = [prompts[i % len(prompts)] for i in range(batch_size)]
+    return images, audios, texts
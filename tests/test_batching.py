@@ -0,0 +1,170 @@
+"""The batched prompt and target assembly against the per-sample loops it replaced."""
+import pytest
+import torch
+
+from conftest import make_inputs
+
+
+def per_sample_wrap(model, img_embeds, audio_embeds, prompts, lengths=None, audio_atts=None):
+    """The per-sample loop of prompt_wrap: tokenize and embed segment by segment, then right pad."""
+    emb_lists = []
+    for idx, each_prompt in enumerate(prompts):
+        each_img_embed = img_embeds[idx]
+        pn = each_img_embed.shape[-2]
+        if lengths is not None:
+            each_img_embed = each_img_embed.reshape(-1, each_img_embed.shape[-1])
+            each_img_embed = each_img_embed[:lengths[idx] * pn]
+        p_segs = each_prompt.split('<ImageHere>')
+        interleave_emb = []
+        for inner_idx, seg in enumerate(p_segs[:-1]):
+            p_tokens = model.language_tokenizer(seg, return_tensors="pt", add_special_tokens=False)
+            p_embed = model.embed_tokens(p_tokens.input_ids)
+            interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, inner_idx * pn:(inner_idx + 1) * pn]], dim=1))
+        wrapped_emb = torch.cat(interleave_emb, dim=1)
+        p_tokens = model.language_tokenizer(p_segs[-1], return_tensors="pt", add_special_tokens=False)
+        p_embed = model.embed_tokens(p_tokens.input_ids)
+        if audio_embeds is None:
+            wrapped_emb = torch.cat([wrapped_emb, p_embed], dim=1)
+        else:
+            each_audio_embed = audio_embeds[idx]
+            if audio_atts is not None:
+                each_audio_embed = each_audio_embed[:int(audio_atts[idx].sum())]
+            wrapped_emb = torch.cat([wrapped_emb, p_embed, each_audio_embed.unsqueeze(0)], dim=1)
+        emb_lists.append(wrapped_emb)
+
+    emb_lens = [emb.shape[1] for emb in emb_lists]
+    pad_emb = model.embed_tokens(torch.tensor(model.language_tokenizer.pad_token_id))
+    max_length = max(emb_lens) if max(emb_lens) < model.max_context_len else model.max_context_len
+    wrapped_embs = pad_emb.expand(len(emb_lens), max_length, -1).clone()
+    wrapped_atts = torch.zeros([len(emb_lens), max_length], dtype=torch.int)
+    for i, emb in enumerate(emb_lists):
+        length = emb_lens[i] if emb_lens[i] < model.max_context_len else model.max_context_len
+        wrapped_embs[i, :length] = emb[:, :length]
+        wrapped_atts[i, :length] = 1
+    return wrapped_embs, wrapped_atts
+
+
+def per_sample_concat(input_embs, input_atts, output_embs, output_atts):
+    input_lens, cat_embs, cat_atts = [], [], []
+    for i in range(input_embs.size(0)):
+        input_len = input_atts[i].sum()
+        input_lens.append(input_len)
+        cat_embs.append(torch.cat([input_embs[i][:input_len], output_embs[i], input_embs[i][input_len:]]))
+        cat_atts.append(torch.cat([input_atts[i][:input_len], output_atts[i], input_atts[i][input_len:]]))
+    return torch.stack(cat_embs), torch.stack(cat_atts), input_lens
+
+
+def per_sample_targets(part_targets, input_lens, length):
+    targets = torch.ones([part_targets.shape[0], length], dtype=torch.long).fill_(-100)
+    for i, target in enumerate(part_targets):
+        targets[i, input_lens[i] + 1:input_lens[i] + len(target) + 1] = target  # plus 1 for bos
+    return targets
+
+
+def per_sample_conversation(model, conv_q, conv_a):
+    tokenizer = model.language_tokenizer
+    to_regress_token_ids_list, targets_list = [], []
+    batch_size = len(conv_q)
+    for batch_idx in range(batch_size):
+        questions, answers = conv_q[batch_idx], conv_a[batch_idx]
+        questions = [tokenizer(tokenizer.bos_token + q, return_tensors="pt", add_special_tokens=False)
+                     for q in questions[1:]]
+        answers = [tokenizer(a + model.end_sym, return_tensors="pt", add_special_tokens=False) for a in answers]
+        cur_id, cur_target = [], []
+        for i in range(len(questions)):
+            cur_id.append(answers[i].input_ids)
+            cur_target.append(answers[i].input_ids)
+            cur_id.append(questions[i].input_ids)
+            cur_target.append(torch.ones_like(questions[i].input_ids) * -100)
+        cur_id.append(answers[-1].input_ids)
+        cur_target.append(answers[-1].input_ids)
+        to_regress_token_ids_list.append(torch.cat(cur_id, dim=1))
+        targets_list.append(torch.cat(cur_target, dim=1))
+
+    max_len = min(max([target.shape[1] for target in targets_list]), model.max_txt_len)
+    to_regress_token_ids = torch.ones([batch_size, max_len], dtype=torch.long) * tokenizer.pad_token_id
+    targets = torch.ones([batch_size, max_len], dtype=torch.long) * -100
+    for batch_idx in range(batch_size):
+        cur_len = to_regress_token_ids_list[batch_idx].shape[1]
+        to_regress_token_ids[batch_idx, :cur_len] = to_regress_token_ids_list[batch_idx][0, :max_len]
+        targets[batch_idx, :cur_len] = targets_list[batch_idx][0, :max_len]
+    to_regress_token_attn = (to_regress_token_ids != tokenizer.pad_token_id).to(torch.int)
+    return to_regress_token_ids, to_regress_token_attn, targets
+
+
+@pytest.mark.parametrize("with_audio", [False, True])
+@pytest.mark.parametrize("max_context_len", [3800, 20])
+def test_prompt_wrap_matches_per_sample(tiny_model, with_audio, max_context_len):
+    tiny_model.max_context_len = max_context_len
+    # questions of 40, 12 and 26 frames, prompts of different lengths
+    images, audios, texts = make_inputs(5, num_frames=(40, 12, 26))
+    with torch.no_grad():
+        (img_embeds, img_atts), (audio_embeds, audio_atts) = tiny_model.encode_multimodal(
+            images, audios if with_audio else None)
+        if with_audio:
+            assert len(set(audio_atts.sum(1).tolist())) == 3
+        embs, atts = tiny_model.prompt_wrap(img_embeds, audio_embeds, img_atts, texts, audio_atts=audio_atts)
+        expected_embs, expected_atts = per_sample_wrap(tiny_model, img_embeds, audio_embeds, texts,
+                                                       audio_atts=audio_atts)
+    assert len(set(atts.sum(1).tolist())) > 1
+    assert torch.equal(embs, expected_embs)
+    assert torch.equal(atts, expected_atts)
+    assert atts.dtype == expected_atts.dtype
+
+
+def test_prompt_wrap_matches_per_sample_with_lengths(tiny_model):
+    # up to three images per sample, of which lengths[i] are real
+    images, audios, _ = make_inputs(3, num_frames=(40, 20))
+    texts = ["[INST] <Img><ImageHere></Img> <Img><ImageHere></Img> what is in the image [/INST]",
+             "[INST] <Img><ImageHere></Img> describe this [/INST]",
+             "[INST] <Img><ImageHere></Img> a <Img><ImageHere></Img> and <Img><ImageHere></Img> [/INST]"]
+    lengths = [2, 1, 3]
+    with torch.no_grad():
+        (img_embeds, img_atts), (audio_embeds, audio_atts) = tiny_model.encode_multimodal(
+            images.repeat_interleave(3, dim=0), audios)
+        img_embeds = img_embeds.reshape(3, 3, *img_embeds.shape[1:])
+        embs, atts = tiny_model.prompt_wrap(img_embeds, audio_embeds, img_atts, texts, lengths, audio_atts=audio_atts)
+        expected_embs, expected_atts = per_sample_wrap(tiny_model, img_embeds, audio_embeds, texts, lengths,
+                                                       audio_atts=audio_atts)
+    assert torch.equal(embs, expected_embs)
+    assert torch.equal(atts, expected_atts)
+
+
+def test_concat_and_targets_match_per_sample(tiny_model):
+    generator = torch.Generator().manual_seed(0)
+    input_lens, output_lens = [7, 3, 5, 1], [2, 6, 4, 6]
+    input_atts = (torch.arange(7)[None] < torch.tensor(input_lens)[:, None]).int()
+    output_atts = (torch.arange(6)[None] < torch.tensor(output_lens)[:, None]).int()
+    input_embs = torch.randn(4, 7, 16, generator=generator)
+    output_embs = torch.randn(4, 6, 16, generator=generator)
+    part_targets = torch.randint(4, 60, (4, 6), generator=generator).masked_fill(output_atts == 0, -100)
+
+    cat_embs, cat_atts, lens = tiny_model.concat_emb_input_output(input_embs, input_atts, output_embs, output_atts)
+    expected_embs, expected_atts, expected_lens = per_sample_concat(input_embs, input_atts, output_embs, output_atts)
+    assert torch.equal(cat_embs, expected_embs)
+    assert torch.equal(cat_atts, expected_atts)
+    assert lens.tolist() == [int(length) for length in expected_lens]
+
+    # the labels of forward, with the bos in front
+    length = cat_embs.shape[1] + 1
+    assert torch.equal(tiny_model.build_targets(part_targets, lens, length),
+                       per_sample_targets(part_targets, expected_lens, length))
+
+
+@pytest.mark.parametrize("max_txt_len", [64, 9])
+def test_tokenize_conversation_matches_per_sample(tiny_model, max_txt_len):
+    tiny_model.max_txt_len = max_txt_len
+    tiny_model.end_sym = " </s>"
+    conv_q = [["what is in the image", "how many cat are there", "and the dog"],
+              ["describe this"],
+              ["what is this", "what is on the table"]]
+    conv_a = [["a cat", "w1 w2 w3", "on the table"],
+              ["a dog on a table and a cat on a table"],
+              ["w4", "w5 w6"]]
+    ids, attn, targets = tiny_model.tokenize_conversation(conv_q, conv_a)
+    expected_ids, expected_attn, expected_targets = per_sample_conversation(tiny_model, conv_q, conv_a)
+    assert torch.equal(ids, expected_ids)
+    assert torch.equal(attn, expected_attn)
+    assert torch.equal(targets, expected_targets)
+    # ragged: the rows are padded, or cut to max_txt_len
+    assert len(set(attn.sum(1).tolist())) == 3 or ids.shape[1] == max_txt_len
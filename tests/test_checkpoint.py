@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from conftest import build_tiny_model
+from OmniMod.common.checkpoint import (
+    AsyncCheckpointWriter,
+    checkpoint_metadata,
+    convert_checkpoint,
+    load_weights,
+    snapshot_to_host,
+)
+from OmniMod.models.OmniMod import stage3_key_map
+
+
+def training_checkpoint(model):
+    """What the runner saves: the trained weights (here the projectors) with the optimizer state and epoch."""
+    torch.manual_seed(1)
+    state_dict = {k: torch.randn_like(v) for k, v in model.state_dict().items() if "proj" in k}
+    # a key of another model version
+    state_dict["old_head.weight"] = torch.randn(2, 2)
+    return {"model": state_dict, "optimizer": {"state": {}}, "config": {"run": {"lr": 1}}, "epoch": 3}
+
+
+def assert_same_weights(model, other):
+    state_dict, other_state_dict = model.state_dict(), other.state_dict()
+    assert list(state_dict) == list(other_state_dict)
+    for key, value in state_dict.items():
+        assert torch.equal(value, other_state_dict[key]), key
+
+
+@pytest.fixture
+def pth_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint_3.pth")
+    torch.save(training_checkpoint(build_tiny_model()), path)
+    return path
+
+
+def test_pth_and_safetensors_load_like_load_state_dict(pth_checkpoint):
+    expected = build_tiny_model()
+    expected_msg = expected.load_state_dict(torch.load(pth_checkpoint)["model"], strict=False)
+
+    safetensors_path = convert_checkpoint(pth_checkpoint)
+    assert safetensors_path.endswith("checkpoint_3.safetensors")
+    assert checkpoint_metadata(safetensors_path) == {"epoch": 3, "config": {"run": {"lr": 1}}}
+    for path in [pth_checkpoint, safetensors_path]:
+        model = build_tiny_model()
+        msg = load_weights(model, path)
+        assert msg.missing_keys == expected_msg.missing_keys
+        assert msg.unexpected_keys == expected_msg.unexpected_keys == ["old_head.weight"]
+        assert_same_weights(model, expected)
+
+        # BaseModel.load_checkpoint goes through load_weights too
+        model = build_tiny_model()
+        model.load_checkpoint(path)
+        assert_same_weights(model, expected)
+
+
+def test_size_mismatch_is_an_error(tmp_path):
+    model = build_tiny_model()
+    path = str(tmp_path / "checkpoint.pth")
+    key = next(k for k in model.state_dict() if k.endswith("proj.0.weight"))
+    torch.save({"model": {key: torch.zeros(1, 1)}}, path)
+    with pytest.raises(RuntimeError, match="size mismatch"):
+        load_weights(model, path)
+
+
+@pytest.mark.parametrize("extension", [".pth", ".safetensors"])
+def test_stage3_checkpoint(tmp_path, extension):
+    model = build_tiny_model()
+    # checkpoint_stage3 names the language model llama_model and its image projector llama_proj
+    torch.manual_seed(2)
+    legacy = {}
+    for name, param in model.named_parameters():
+        if name.startswith("language_model.model.layers.0."):
+            legacy[name.replace("language_model", "llama_model")] = torch.randn_like(param)
+    last_proj = model.language_proj[-1]
+    legacy["llama_proj.weight"] = torch.randn_like(last_proj.weight)
+    legacy["llama_proj.bias"] = torch.randn_like(last_proj.bias)
+    path = str(tmp_path / "checkpoint_stage3.pth")
+    torch.save({"model": legacy}, path)
+    if extension == ".safetensors":
+        path = convert_checkpoint(path)
+
+    # the per-parameter renaming load_weights replaces
+    expected = build_tiny_model()
+    ckpt = torch.load(str(tmp_path / "checkpoint_stage3.pth"))
+    with torch.no_grad():
+        for name, param in expected.named_parameters():
+            name = name.replace("language_model", "llama_model").replace("default.", "")
+            if ckpt["model"].get(name, None) is not None:
+                param.copy_(ckpt["model"][name])
+        expected.language_proj[-1].weight.copy_(ckpt["model"]["llama_proj.weight"])
+        expected.language_proj[-1].bias.copy_(ckpt["model"]["llama_proj.bias"])
+    key_map = stage3_key_map(model)
+    renamed = {key_map.get(key, key): value for key, value in ckpt["model"].items()}
+    expected_msg = build_tiny_model().load_state_dict(renamed, strict=False)
+
+    msg = load_weights(model, path, key_map=stage3_key_map(model))
+    assert_same_weights(model, expected)
+    assert msg.missing_keys == expected_msg.missing_keys
+    assert msg.unexpected_keys == expected_msg.unexpected_keys == []
+
+
+def test_async_writer_renames_complete_files_in_order(tmp_path):
+    writer = AsyncCheckpointWriter()
+    events = []
+
+    def slow_save(obj, path):
+        # nothing is in place while the file is being written
+        events.append(("write", os.path.basename(path), sorted(os.listdir(tmp_path))))
+        time.sleep(0.05)
+        torch.save(obj, path)
+
+    files = [({"step": i}, str(tmp_path / "file_{}.pth".format(i)), slow_save) for i in range(2)]
+    writer.save(files, callback=lambda: events.append(("callback", sorted(os.listdir(tmp_path)))))
+    writer.wait()
+    assert events == [
+        ("write", "file_0.pth.tmp", []),
+        ("write", "file_1.pth.tmp", ["file_0.pth"]),
+        ("callback", ["file_0.pth", "file_1.pth"]),
+    ]
+    assert torch.load(str(tmp_path / "file_1.pth")) == {"step": 1}
+
+
+def test_async_writer_reraises_write_errors(tmp_path):
+    writer = AsyncCheckpointWriter()
+    path = str(tmp_path / "checkpoint.pth")
+    callbacks = []
+
+    def failing_save(obj, path):
+        with open(path, "w") as f:
+            f.write("partial")
+        raise OSError("disk full")
+
+    writer.save([({"step": 1}, path, failing_save)], callback=lambda: callbacks.append(True))
+    with pytest.raises(OSError, match="disk full"):
+        writer.wait()
+    # the partial file was removed, not renamed into place, and the retention callback did not run
+    assert os.listdir(tmp_path) == [] and not callbacks
+    # the error is raised once, the writer keeps working
+    writer.wait()
+    writer.save([({"step": 2}, path, torch.save)])
+    writer.wait()
+    assert torch.load(path) == {"step": 2}
+
+
+def test_snapshot_is_isolated_from_later_updates(tmp_path):
+    model = torch.nn.Linear(4, 4)
+    optimizer = torch.optim.AdamW(model.parameters())
+    model(torch.ones(1, 4)).sum().backward()
+    optimizer.step()
+    checkpoint = {"model": model.state_dict(), "optimizer": optimizer.state_dict()}
+    snapshot = snapshot_to_host(checkpoint)
+    expected_weight = model.weight.detach().clone()
+    expected_exp_avg = optimizer.state[model.weight]["exp_avg"].clone()
+
+    writer = AsyncCheckpointWriter()
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocked_save(obj, path):
+        started.set()
+        release.wait(10)
+        torch.save(obj, path)
+
+    path = str(tmp_path / "checkpoint.pth")
+    writer.save([(checkpoint, path, blocked_save)])
+    started.wait(10)
+    # training goes on while the file is written
+    for _ in range(3):
+        model(torch.ones(1, 4)).sum().backward()
+        optimizer.step()
+    release.set()
+    writer.wait()
+
+    saved = torch.load(path)
+    assert torch.equal(saved["model"]["weight"], expected_weight)
+    assert torch.equal(saved["optimizer"]["state"][0]["exp_avg"], expected_exp_avg)
+    assert not torch.equal(model.weight, expected_weight)
+    assert torch.equal(snapshot["model"]["weight"], expected_weight)
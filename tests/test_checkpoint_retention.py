@@ -0,0 +1,108 @@
+import os
+import types
+
+import pytest
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+import OmniMod  # noqa: F401, registers the library root
+from OmniMod.common.registry import registry
+from OmniMod.runners.runner_base import RunnerBase
+
+
+class TinyTrainable(nn.Module):
+    """A frozen layer and a trained one, like the language model and the LoRA adapters."""
+
+    def __init__(self):
+        super().__init__()
+        self.frozen = nn.Linear(4, 4)
+        self.frozen.requires_grad_(False)
+        self.adapter = nn.Linear(4, 4)
+
+    @property
+    def device(self):
+        return self.adapter.weight.device
+
+    def forward(self, x):
+        return self.adapter(self.frozen(x)).sum()
+
+
+def build_runner(output_dir, **run_cfg):
+    run_cfg = OmegaConf.create(dict(dict(
+        device="cpu", distributed=False, output_dir=str(output_dir), init_lr=1e-3, weight_decay=0.0,
+        checkpoint_format="adapter"), **run_cfg))
+    cfg = types.SimpleNamespace(run_cfg=run_cfg, to_dict=lambda: {"run": OmegaConf.to_container(run_cfg)})
+    # a runner registers its output directories, one per job
+    for name in ["result_dir", "output_dir"]:
+        registry.mapping["paths"].pop(name, None)
+    runner = RunnerBase(cfg, task=None, model=TinyTrainable(), datasets=None, job_id="job")
+    # the model is already on the device, the runner only wraps it when moving it there
+    runner._wrapped_model = runner._model
+    return runner
+
+
+def train_step(runner):
+    runner.optimizer.zero_grad()
+    runner.model(torch.ones(2, 4)).backward()
+    runner.optimizer.step()
+
+
+def save_epochs(runner, epochs, best_epochs=()):
+    for epoch in epochs:
+        train_step(runner)
+        runner._save_checkpoint(epoch)
+        if epoch in best_epochs:
+            runner._save_checkpoint(epoch, is_best=True)
+    runner.wait_for_checkpoint()
+
+
+def saved_files(runner):
+    return sorted(name for name in os.listdir(runner.output_dir) if name.endswith((".pth", ".safetensors")))
+
+
+@pytest.mark.parametrize("async_checkpoint", [False, True])
+def test_retention(tmp_path, async_checkpoint):
+    # "optimizer_" in the output directory must not confuse the file names
+    runner = build_runner(tmp_path / "optimizer_runs", keep_last_checkpoints=2, keep_optimizer_states=1,
+                          async_checkpoint=async_checkpoint)
+    save_epochs(runner, range(5), best_epochs=[1, 4])
+    assert saved_files(runner) == [
+        "checkpoint_3.safetensors", "checkpoint_4.safetensors", "checkpoint_best.safetensors",
+        "optimizer_4.pth", "optimizer_best.pth",
+    ]
+    assert torch.load(os.path.join(runner.output_dir, "optimizer_best.pth"))["epoch"] == 4
+
+
+def test_retention_orders_by_epoch(tmp_path):
+    runner = build_runner(tmp_path, keep_optimizer_states=2)
+    save_epochs(runner, range(3))
+    # files copied or restored out of order: the modification times say nothing about the epoch
+    for name in saved_files(runner):
+        epoch = int(name.split("_")[1].split(".")[0])
+        os.utime(os.path.join(runner.output_dir, name), (1e9 - epoch, 1e9 - epoch))
+    save_epochs(runner, [3])
+    assert saved_files(runner) == [
+        "checkpoint_0.safetensors", "checkpoint_1.safetensors", "checkpoint_2.safetensors",
+        "checkpoint_3.safetensors", "optimizer_2.pth", "optimizer_3.pth",
+    ]
+
+
+@pytest.mark.parametrize("with_optimizer_state", [True, False])
+def test_resume_from_safetensors(tmp_path, with_optimizer_state):
+    runner = build_runner(tmp_path, keep_optimizer_states=3)
+    save_epochs(runner, range(3))
+    checkpoint_path = os.path.join(runner.output_dir, "checkpoint_1.safetensors")
+    if not with_optimizer_state:
+        os.remove(os.path.join(runner.output_dir, "optimizer_1.pth"))
+    saved_weights = runner.model.adapter.weight.clone()
+
+    resumed = build_runner(tmp_path, keep_optimizer_states=3)
+    frozen_weight = resumed.model.frozen.weight.clone()
+    resumed._load_checkpoint(checkpoint_path)
+    # the epoch comes from the optimizer state, or from the metadata of the weights
+    assert resumed.start_epoch == 2
+    # only the trained weights are in the checkpoint
+    assert torch.equal(resumed.model.frozen.weight, frozen_weight)
+    assert not torch.equal(resumed.model.adapter.weight, saved_weights)
+    assert (len(resumed.optimizer.state) > 0) == with_optimizer_state
@@ -0,0 +1,73 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from OmniMod.models.compile_utils import bucket_size, compile_bucketed
+
+
+class TinyEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Sequential(nn.Linear(7, 6), nn.GELU(), nn.Linear(6, 3))
+        self.norm = nn.LayerNorm(3)
+
+    def forward(self, x, scale=1.0):
+        hidden = self.proj(x) * scale
+        return self.norm(hidden), hidden.mean(1)
+
+
+class RecordingBackend:
+    """Eager backend that counts the compiles and keeps the batches the graphs run on."""
+
+    def __init__(self):
+        self.compiles = 0
+        self.batches = []
+
+    def __call__(self, gm, example_inputs):
+        self.compiles += 1
+
+        def run(*args):
+            # the input is the only 3-d tensor, the parameters are lifted to 1-d and 2-d inputs
+            self.batches.extend(arg for arg in args if torch.is_tensor(arg) and arg.dim() == 3)
+            return gm(*args)
+        return run
+
+
+@pytest.fixture
+def backend():
+    torch._dynamo.reset()
+    yield RecordingBackend()
+    torch._dynamo.reset()
+
+
+def test_bucket_size():
+    assert [bucket_size(n, [1, 2, 4, 8]) for n in [1, 2, 3, 5, 8, 9]] == [1, 2, 4, 8, 8, None]
+
+
+def test_bucketed_outputs_match_the_module(backend):
+    torch.manual_seed(0)
+    module = TinyEncoder().eval()
+    reference = TinyEncoder().eval()
+    reference.load_state_dict(module.state_dict())
+    keys = list(module.state_dict())
+    compile_bucketed(module, [4, 1, 2, 8], backend=backend)
+    assert module.compile_buckets == [1, 2, 4, 8]
+    # the forward is replaced in place, the parameter names stay those of the module
+    assert list(module.state_dict()) == keys
+    module.load_state_dict(reference.state_dict())
+
+    with torch.no_grad():
+        for batch_size in [3, 5, 7, 1, 2, 20, 4, 6]:
+            x = torch.randn(batch_size, 5, 7)
+            output, pooled = module(x, scale=2.0)
+            expected, expected_pooled = reference(x, scale=2.0)
+            assert output.shape == expected.shape and pooled.shape == expected_pooled.shape
+            assert torch.allclose(output, expected, atol=1e-6)
+            assert torch.allclose(pooled, expected_pooled, atol=1e-6)
+            if batch_size == 3:
+                # padded to the bucket of 4 with the last row
+                assert torch.equal(backend.batches[-1], torch.cat([x, x[-1:]]))
+
+    # one compile per bucket: batches between buckets and above the last one never recompile
+    assert backend.compiles == 4
+    assert sorted({len(batch) for batch in backend.batches}) == [1, 2, 4, 8]
@@ -0,0 +1,39 @@
+import torch
+import torch.nn as nn
+
+from OmniMod.models.concurrent import ConcurrentRunner
+
+
+def test_outputs_in_order():
+    runner = ConcurrentRunner()
+    outputs = runner.run([lambda: torch.ones(2), lambda: torch.zeros(3)], "cpu")
+    assert torch.equal(outputs[0], torch.ones(2))
+    assert torch.equal(outputs[1], torch.zeros(3))
+    assert runner.stats()["calls"] == 1
+
+
+def test_workers_see_the_callers_autocast():
+    torch.manual_seed(0)
+    towers = [nn.Linear(8, 4), nn.Linear(8, 4)]
+    x = torch.randn(2, 8)
+    runner = ConcurrentRunner()
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        expected = [tower(x) for tower in towers]
+        outputs = runner.run([lambda tower=tower: tower(x) for tower in towers], x.device)
+    for output, reference in zip(outputs, expected):
+        assert output.dtype == torch.bfloat16
+        assert torch.equal(output, reference)
+    # and no autocast leaks into the workers once the caller left it
+    outputs = runner.run([lambda tower=tower: tower(x) for tower in towers], x.device)
+    assert all(output.dtype == torch.float32 for output in outputs)
+
+
+def test_workers_see_the_callers_grad_mode():
+    layer = nn.Linear(4, 4)
+    x = torch.randn(1, 4)
+    runner = ConcurrentRunner()
+    with torch.no_grad():
+        output, = runner.run([lambda: layer(x)], "cpu")
+    assert not output.requires_grad
+    output, = runner.run([lambda: layer(x)], "cpu")
+    assert output.requires_grad
@@ -0,0 +1,24 @@
+import torch
+import torch.nn as nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from OmniMod.models.cpu_inference import quantize_linear_layers
+
+
+def test_quantizes_in_place():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(16, 32), nn.GELU(), nn.Linear(32, 8))
+    x = torch.randn(4, 16)
+    expected = model(x)
+    first = model[0]
+    quantized = quantize_linear_layers(model)
+    # the model itself is modified, no copy of its float weights is made
+    assert quantized is model
+    assert isinstance(model[0], DynamicQuantizedLinear) and isinstance(model[2], DynamicQuantizedLinear)
+    assert model[0] is not first
+    assert (quantized(x) - expected).abs().max() < 0.1
+
+
+def test_quantizes_a_linear_module_itself():
+    quantized = quantize_linear_layers(nn.Linear(8, 8))
+    assert isinstance(quantized, DynamicQuantizedLinear)
@@ -0,0 +1,83 @@
+import pytest
+import torch
+
+from conftest import make_inputs, tiny_llama
+from OmniMod.models.decode_engine import DecodeEngine
+
+
+def force_first_token_eos(model, images, audios, texts):
+    """Make the greedy first token of the first request the eos token, so min_length matters."""
+    embs, attn_mask = model.prepare_generation_inputs(images, audios, texts)
+    with torch.no_grad():
+        logits = model.language_model(inputs_embeds=embs, attention_mask=attn_mask).logits[:, -1]
+    model.language_model.generation_config.eos_token_id = int(logits[0].argmax())
+    model._stop_tokens = None
+    return embs.shape[1]
+
+
+def min_lengths(context_len):
+    # the default, and one that keeps eos masked for the first 3 new tokens
+    return [1, context_len + 3]
+
+
+def reference(model, images, audios, texts, **kwargs):
+    """HF generate on the left padded batch."""
+    return model.generate(images, audios, texts, share_prefix=False, speculative=False, **kwargs)
+
+
+@pytest.mark.parametrize("forced_eos", [False, True])
+def test_shared_prefix_matches_generate(tiny_model, forced_eos):
+    images, audios, texts = make_inputs(4, num_frames=(40, 24, 32))
+    # requests 0 and 1 ask different spoken questions about the same image and prompt
+    images[1], texts[1] = images[0], texts[0]
+    context_len = tiny_model.prepare_generation_inputs(images, audios, texts)[0].shape[1]
+    if forced_eos:
+        force_first_token_eos(tiny_model, images, audios, texts)
+    for min_length in min_lengths(context_len):
+        expected = reference(tiny_model, images, audios, texts, max_new_tokens=8, min_length=min_length)
+        answers = tiny_model.generate(images, audios, texts, share_prefix=True, speculative=False,
+                                      max_new_tokens=8, min_length=min_length)
+        assert answers == expected
+
+
+@pytest.mark.parametrize("forced_eos", [False, True])
+def test_speculative_matches_generate(tiny_model, forced_eos):
+    tiny_model.set_draft_model(tiny_llama(len(tiny_model.language_tokenizer), seed=1))
+    images, audios, texts = make_inputs(3, num_frames=(40, 24))
+    context_len = tiny_model.prepare_generation_inputs(images, audios, texts)[0].shape[1]
+    if forced_eos:
+        force_first_token_eos(tiny_model, images, audios, texts)
+    for min_length in min_lengths(context_len):
+        expected = reference(tiny_model, images, audios, texts, max_new_tokens=8, min_length=min_length)
+        answers = tiny_model.generate(images, audios, texts, speculative=True, max_new_tokens=8,
+                                      min_length=min_length)
+        assert answers == expected
+    assert tiny_model.speculative_stats()["speculative"]["sequences"] == 3 * 2
+
+
+@pytest.mark.parametrize("forced_eos", [False, True])
+def test_decode_engine_matches_generate(tiny_model, forced_eos):
+    images, audios, texts = make_inputs(5, num_frames=(40, 24, 32))
+    if forced_eos:
+        force_first_token_eos(tiny_model, images, audios, texts)
+    context_embs = tiny_model.get_generation_context_embs(images, audios, texts)
+    context_len = max(emb.shape[1] for emb in context_embs)
+    for min_length in min_lengths(context_len):
+        # each engine request decodes as if it was given to generate on its own
+        expected = [reference(tiny_model, images[i:i + 1], audios[i:i + 1], texts[i:i + 1],
+                              max_new_tokens=8, min_length=min_length)[0] for i in range(len(texts))]
+        engine = DecodeEngine(tiny_model, max_batch_size=2, max_new_tokens=8, min_length=min_length)
+        assert engine.generate(context_embs) == expected
+
+
+def test_min_length_blocks_eos(tiny_model):
+    images, audios, texts = make_inputs(1)
+    context_len = force_first_token_eos(tiny_model, images, audios, texts)
+    eos_word = tiny_model.language_tokenizer.convert_ids_to_tokens(
+        tiny_model.language_model.generation_config.eos_token_id)
+    # as in HF generate, the default min_length is covered by the context and eos can come first
+    assert reference(tiny_model, images, audios, texts, max_new_tokens=8) == [eos_word]
+    answer = reference(tiny_model, images, audios, texts, max_new_tokens=8, min_length=context_len + 3)[0]
+    assert len(answer.split()) > 3
+    engine = DecodeEngine(tiny_model, max_new_tokens=8, min_length=context_len + 3)
+    assert engine.generate(tiny_model.get_generation_context_embs(images, audios, texts)) == [answer]
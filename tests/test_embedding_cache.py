@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+from conftest import make_inputs
+from OmniMod.models.embedding_cache import EmbeddingCache
+
+
+def row(value, size=4):
+    return torch.full([size], float(value))
+
+
+@pytest.mark.parametrize("eviction", ["lru", "fifo"])
+def test_eviction_order(eviction):
+    cache = EmbeddingCache(max_entries=2, eviction=eviction)
+    cache.put("a", row(0))
+    cache.put("b", row(1))
+    # a read makes "a" the most recently used entry, it does not change the insertion order
+    assert torch.equal(cache.get("a"), row(0))
+    cache.put("c", row(2))
+    evicted = "b" if eviction == "lru" else "a"
+    assert cache.get(evicted) is None
+    assert all(cache.get(key) is not None for key in {"a", "b", "c"} - {evicted})
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_limit():
+    # room for two rows of 4 float32
+    cache = EmbeddingCache(max_bytes=2 * 4 * 4)
+    for i in range(3):
+        cache.put(str(i), row(i))
+    assert cache.get("0") is None and cache.stats()["entries"] == 2
+    assert cache.num_bytes == 2 * 4 * 4
+    # larger than the whole cache: not stored, nothing else evicted
+    cache.put("big", row(9, size=12))
+    assert cache.get("big") is None and cache.stats()["entries"] == 2
+    # a cached row is a copy, it does not keep the batch it was sliced from alive
+    batch = torch.zeros(8, 4)
+    cache.put("3", batch[0])
+    assert cache.get("3").untyped_storage().nbytes() == 4 * 4
+
+
+def test_disk_tier_round_trip(tmp_path):
+    value = torch.randn(3, 4).to(torch.bfloat16)
+    writer = EmbeddingCache(namespace="model-a", disk_dir=str(tmp_path))
+    key = writer.key(torch.ones(2, 2))
+    writer.put(key, value)
+
+    # a new process with the same options reads it from disk, and keeps it in memory afterwards
+    reader = EmbeddingCache(namespace="model-a", disk_dir=str(tmp_path))
+    assert reader.key(torch.ones(2, 2)) == key
+    assert torch.equal(reader.get(key), value)
+    assert reader.get(key).dtype == torch.bfloat16
+    assert reader.stats()["disk_hits"] == 1 and reader.stats()["hits"] == 1
+    # other options give other keys
+    other = EmbeddingCache(namespace="model-b", disk_dir=str(tmp_path))
+    assert other.get(other.key(torch.ones(2, 2))) is None
+    # clear only drops the memory tier
+    reader.clear()
+    assert torch.equal(reader.get(key), value)
+
+
+def test_cached_encode_encodes_duplicate_rows_once(tiny_model):
+    tiny_model.enable_audio_cache("tiny")
+    _, audios, _ = make_inputs(3, num_frames=(40, 12, 26))
+    # rows 0 and 3 are the same question
+    audios = torch.cat([audios, audios[:1]])
+    encoded = []
+    encode_audio = tiny_model._encode_audio
+
+    def recording_encode(audio):
+        encoded.append(len(audio))
+        return encode_audio(audio)
+
+    tiny_model._encode_audio = recording_encode
+    with torch.no_grad():
+        embeds, atts = tiny_model.encode_audio(audios)
+        again, again_atts = tiny_model.encode_audio(audios[[2, 0]])
+        expected, expected_atts = encode_audio(audios)
+    assert encoded == [3]
+    assert torch.equal(atts, expected_atts)
+    # cached rows are stored without their padding and padded again for each batch
+    assert atts.sum(1).tolist() == [20, 6, 13, 20]
+    assert again_atts.sum(1).tolist() == [13, 20]
+    for i, j in [(0, 0), (1, 1), (2, 2), (3, 0)]:
+        assert torch.allclose(embeds[i, :atts[i].sum()], expected[j, :atts[i].sum()])
+    for i, j in [(0, 2), (1, 0)]:
+        assert torch.allclose(again[i, :again_atts[i].sum()], expected[j, :again_atts[i].sum()])
+
+
+def test_cache_is_skipped_while_training(tiny_model):
+    tiny_model.enable_img_cache("tiny")
+    images, _, _ = make_inputs(2)
+    tiny_model.train()
+    embeds, _ = tiny_model.encode_img(images)
+    assert embeds.requires_grad
+    assert tiny_model.img_cache.stats() == EmbeddingCache().stats()
+    tiny_model.eval()
+    with torch.no_grad():
+        tiny_model.encode_img(images)
+    assert tiny_model.img_cache.stats()["misses"] == 2
+
+
+def test_cached_generate_matches_uncached(tiny_model, tmp_path):
+    images, audios, texts = make_inputs(4, num_frames=(40, 12, 26))
+    expected = tiny_model.generate(images, audios, texts, max_new_tokens=8)
+
+    tiny_model.enable_img_cache("tiny", disk_dir=str(tmp_path))
+    tiny_model.enable_audio_cache("tiny", eviction="fifo")
+    assert tiny_model.generate(images, audios, texts, max_new_tokens=8) == expected
+    # all hits, in another order
+    order = [3, 1, 0, 2]
+    answers = tiny_model.generate(images[order], audios[order], [texts[i] for i in order], max_new_tokens=8)
+    assert answers == [expected[i] for i in order]
+    stats = tiny_model.cache_stats()
+    assert stats["img_cache"]["misses"] == 4 and stats["img_cache"]["hits"] == 4
+    assert stats["audio_cache"]["misses"] == 4 and stats["audio_cache"]["hits"] == 4
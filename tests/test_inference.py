@@ -0,0 +1,89 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import inference
+from conftest import make_inputs
+
+
+def vis_processor(image):
+    return torch.from_numpy(np.asarray(image.resize((16, 16)), dtype=np.float32)).permute(2, 0, 1) / 255
+
+
+def audio_processor(features):
+    # the tiny audio encoder takes the features as they are
+    return torch.from_numpy(features)[None]
+
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    """A manifest of 7 records, the audio files hold the features of make_inputs."""
+    images, audios, _ = make_inputs(7, num_frames=(40, 12, 26))
+    questions = ["what is in the image", "describe this", "how many cat are there on the table"]
+    path = tmp_path / "manifest.jsonl"
+    with open(path, "w") as f:
+        for i in range(7):
+            image_path, audio_path = str(tmp_path / "{}.png".format(i)), str(tmp_path / "{}.pt".format(i))
+            pixels = (images[i].permute(1, 2, 0).sigmoid() * 255).to(torch.uint8).numpy()
+            Image.fromarray(pixels).save(image_path)
+            torch.save(audios[i], audio_path)
+            record = {"image": image_path, "audio": audio_path,
+                      "text": "<Img><ImageHere></Img> " + questions[i % len(questions)]}
+            if i != 4:
+                # without an id the line number is used
+                record["id"] = "q{}".format(i)
+            f.write(json.dumps(record) + "\n")
+    # the test does not need an audio decoding backend
+    monkeypatch.setattr(inference.torchaudio, "load", lambda path: (torch.load(path), 16000))
+    return str(path)
+
+
+def run(model, manifest, output_path, engine):
+    return inference.generate_from_manifest(model, vis_processor, audio_processor, manifest, output_path,
+                                            batch_size=3, num_workers=0, max_new_tokens=6, engine=engine)
+
+
+def read_predictions(output_path):
+    with open(output_path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("engine", ["hf", "continuous"])
+def test_resume_answers_every_id_once(tiny_model, manifest, tmp_path, engine):
+    output_path = str(tmp_path / "predictions.jsonl")
+    assert run(tiny_model, manifest, output_path, engine)["samples"] == 7
+    expected = {prediction["id"]: prediction for prediction in read_predictions(output_path)}
+    assert sorted(expected) == ["4", "q0", "q1", "q2", "q3", "q5", "q6"]
+
+    # the run crashed while writing its fourth prediction
+    with open(output_path) as f:
+        lines = f.readlines()
+    with open(output_path, "w") as f:
+        f.writelines(lines[:3] + [lines[3][:len(lines[3]) // 2]])
+    assert len(inference.load_finished_ids(output_path)) == 3
+
+    assert run(tiny_model, manifest, output_path, engine)["samples"] == 4
+    predictions = read_predictions(output_path)
+    assert sorted(prediction["id"] for prediction in predictions) == sorted(expected)
+    for prediction in predictions:
+        assert prediction == expected[prediction["id"]]
+
+    # nothing left to do
+    assert run(tiny_model, manifest, output_path, engine)["samples"] == 0
+    assert len(read_predictions(output_path)) == 7
+
+
+def test_drop_partial_line(tmp_path):
+    path = str(tmp_path / "predictions.jsonl")
+    inference.drop_partial_line(path)
+    for content, expected in [(b"", b""), (b'{"id": "a"}\n', b'{"id": "a"}\n'), (b'{"id": "a"}\n{"id', b'{"id": "a"}\n'),
+                              # a partial line longer than the chunks the file is read back in
+                              (b'{"id": "a"}\n' + b"x" * 200000, b'{"id": "a"}\n'), (b"x" * 200000, b"")]:
+        with open(path, "wb") as f:
+            f.write(content)
+        inference.drop_partial_line(path)
+        with open(path, "rb") as f:
+            assert f.read() == expected
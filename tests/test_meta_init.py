@@ -0,0 +1,100 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import build_tiny_model
+from OmniMod.common.checkpoint import load_weights
+from OmniMod.models.meta_init import assign_state_dict, init_empty, materialize
+from OmniMod.models.vision_model import eva_vit
+
+
+def no_meta_tensors(model):
+    return not any(tensor.is_meta for tensor in list(model.parameters()) + list(model.buffers()))
+
+
+def assert_same_state(model, other):
+    state_dict, other_state_dict = model.state_dict(), other.state_dict()
+    assert list(state_dict) == list(other_state_dict)
+    for key, value in state_dict.items():
+        assert value.dtype == other_state_dict[key].dtype, key
+        assert torch.equal(value, other_state_dict[key]), key
+
+
+@pytest.fixture
+def small_eva_vit(monkeypatch, tmp_path):
+    """create_eva_vit_g with a 2 block, 176 wide ViT and its checkpoint saved locally."""
+    vision_transformer = eva_vit.VisionTransformer
+
+    def small_vit(**kwargs):
+        return vision_transformer(**dict(kwargs, depth=2, embed_dim=176))
+
+    monkeypatch.setattr(eva_vit, "VisionTransformer", small_vit)
+    torch.manual_seed(0)
+    checkpoint = small_vit(img_size=224, patch_size=14, use_mean_pooling=False, num_heads=16, mlp_ratio=4.3637,
+                           qkv_bias=True).state_dict()
+    path = str(tmp_path / "eva_vit_g.pth")
+    torch.save(checkpoint, path)
+    monkeypatch.setattr(eva_vit, "download_cached_file", lambda url, **kwargs: path)
+    return eva_vit.create_eva_vit_g
+
+
+@pytest.mark.parametrize("img_size", [224, 112])
+@pytest.mark.parametrize("precision", ["fp32", "fp16"])
+def test_meta_init_eva_vit_equals_eager(small_eva_vit, img_size, precision):
+    # 112 interpolates the position embedding of the checkpoint
+    torch.manual_seed(1)
+    eager = small_eva_vit(img_size=img_size, drop_path_rate=0.0, precision=precision)
+    meta = small_eva_vit(img_size=img_size, drop_path_rate=0.0, precision=precision, meta_init=True, device="cpu")
+    assert no_meta_tensors(meta)
+    assert_same_state(meta, eager)
+    images = torch.randn(2, 3, img_size, img_size)
+    if precision == "fp32":
+        with torch.no_grad():
+            assert torch.equal(meta.eval()(images), eager.eval()(images))
+
+
+def test_assign_state_dict_and_materialize():
+    torch.manual_seed(0)
+    source = nn.Sequential(nn.Linear(4, 8), nn.LayerNorm(8), nn.Linear(8, 2))
+    with init_empty():
+        model = nn.Sequential(nn.Linear(4, 8), nn.LayerNorm(8), nn.Linear(8, 2))
+    assert not no_meta_tensors(model)
+
+    # the last layer is not in the checkpoint
+    state_dict = {k: v for k, v in source.state_dict().items() if not k.startswith("2.")}
+    state_dict["extra.weight"] = torch.zeros(1)
+    assert assign_state_dict(model, state_dict, device="cpu") == ["extra.weight"]
+    # the checkpoint tensors become the model's, no copy
+    assert model[0].weight.data_ptr() == state_dict["0.weight"].data_ptr()
+    materialize(model, "cpu")
+    assert no_meta_tensors(model)
+    assert torch.equal(model[1].weight, source[1].weight)
+    assert model[2].weight.abs().sum() > 0 and model[2].weight.requires_grad
+
+    # a module only partly loaded cannot be initialized by its reset_parameters
+    with init_empty():
+        partial = nn.Linear(4, 8)
+    assign_state_dict(partial, {"weight": torch.zeros(8, 4)})
+    with pytest.raises(RuntimeError, match="cannot be initialized"):
+        materialize(partial, "cpu")
+
+
+def test_meta_init_projectors(tmp_path):
+    eager = build_tiny_model()
+    path = str(tmp_path / "checkpoint.pth")
+    projectors = {k: torch.randn_like(v) for k, v in eager.state_dict().items() if "proj" in k}
+    torch.save({"model": projectors}, path)
+    load_weights(eager, path)
+
+    meta = build_tiny_model(meta_init=True)
+    assert meta.language_proj[0].weight.is_meta and meta.audio_language_proj[0].weight.is_meta
+    load_weights(meta, path, device="cpu")
+    materialize(meta, "cpu")
+    assert no_meta_tensors(meta)
+    assert_same_state(meta, eager)
+
+    # no checkpoint: the projectors are initialized on the device
+    meta = build_tiny_model(meta_init=True)
+    materialize(meta, "cpu")
+    assert no_meta_tensors(meta)
+    assert meta.language_proj[0].weight.std() > 0
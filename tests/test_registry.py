@@ -0,0 +1,92 @@
+import ast
+import importlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+import OmniMod
+from OmniMod.common.registry import registry
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(OmniMod.__file__))
+PACKAGES = ["OmniMod.datasets.builders", "OmniMod.models", "OmniMod.processors", "OmniMod.runners", "OmniMod.tasks"]
+
+
+def registered_classes():
+    """(mapping name, registered name, module, class name) of every @registry.register_* decorator in the package."""
+    found = []
+    for root, _, files in os.walk(PACKAGE_DIR):
+        for file in sorted(files):
+            if not file.endswith(".py"):
+                continue
+            path = os.path.join(root, file)
+            with open(path) as f:
+                source = f.read()
+            # the vqa tools are python 2, and register nothing
+            if "@registry.register_" not in source:
+                continue
+            module = os.path.relpath(path[:-3], os.path.dirname(PACKAGE_DIR)).replace(os.sep, ".")
+            for node in ast.walk(ast.parse(source)):
+                if not isinstance(node, ast.ClassDef):
+                    continue
+                for decorator in node.decorator_list:
+                    if (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Attribute)
+                            and getattr(decorator.func.value, "id", None) == "registry"
+                            and decorator.func.attr.startswith("register_")):
+                        mapping_name = decorator.func.attr[len("register_"):] + "_name_mapping"
+                        found.append((mapping_name, decorator.args[0].value, module, node.name))
+    return found
+
+
+REGISTERED = registered_classes()
+
+
+def test_registered_classes_are_found():
+    mapping_names = {mapping_name for mapping_name, _, _, _ in REGISTERED}
+    assert mapping_names == set(registry.lazy_mapping)
+    assert ("model_name_mapping", "OmniMod", "OmniMod.models.OmniMod", "OmniMod") in REGISTERED
+
+
+@pytest.mark.parametrize("mapping_name,name,module,class_name", REGISTERED,
+                         ids=["{}:{}".format(mapping_name, name) for mapping_name, name, _, _ in REGISTERED])
+def test_every_registered_name_has_a_lazy_entry(mapping_name, name, module, class_name):
+    assert registry.lazy_mapping[mapping_name].get(name) == module
+    assert name in registry._list(mapping_name)
+    registered_cls = registry._get_class(mapping_name, name)
+    # not getattr(module, class_name): some builders of the same module share a class name
+    assert (registered_cls.__module__, registered_cls.__name__) == (module, class_name)
+
+
+def test_lazy_entries_are_all_registered():
+    registered = {(mapping_name, name) for mapping_name, name, _, _ in REGISTERED}
+    lazy = {(mapping_name, name) for mapping_name, names in registry.lazy_mapping.items() for name in names}
+    assert lazy == registered
+
+
+@pytest.mark.parametrize("package", PACKAGES)
+def test_package_attributes(package):
+    module = importlib.import_module(package)
+    for name in module.__all__:
+        assert getattr(module, name) is not None
+    with pytest.raises(AttributeError):
+        getattr(module, "NotAClass")
+
+
+def test_import_is_lazy():
+    # a fresh interpreter: importing the package imports none of the registered modules
+    code = "\n".join([
+        "import sys",
+        "import OmniMod",
+        "from OmniMod.common.registry import registry",
+        "modules = {}".format(sorted({module for _, _, module, _ in REGISTERED})),
+        "assert not [m for m in modules if m in sys.modules], [m for m in modules if m in sys.modules]",
+        "assert 'OmniMod' in registry.list_models()",
+        "model_cls = registry.get_model_class('OmniMod')",
+        "assert model_cls.__module__ == 'OmniMod.models.OmniMod' in sys.modules",
+        "assert 'OmniMod.datasets.builders.image_text_pair_builder' not in sys.modules",
+    ])
+    root = os.path.dirname(PACKAGE_DIR)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
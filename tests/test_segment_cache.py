@@ -0,0 +1,80 @@
+import torch
+
+from conftest import make_inputs
+from OmniMod.models.embedding_cache import SegmentCache
+
+
+def wrap(model, batch_size=4):
+    images, audios, texts = make_inputs(batch_size, num_frames=(40, 24))
+    (img_embeds, _), (audio_embeds, audio_atts) = model.encode_multimodal(images, audios)
+    return model.prompt_wrap(img_embeds, audio_embeds, None, texts, audio_atts=audio_atts)
+
+
+def test_prompt_segments_are_embedded_from_the_cache(tiny_model):
+    with torch.no_grad():
+        uncached = wrap(tiny_model)
+        tiny_model.enable_segment_cache()
+        cache = tiny_model.segment_cache
+        first = wrap(tiny_model)
+        hits, misses = cache.embed_hits, cache.embed_misses
+        second = wrap(tiny_model)
+    # every distinct segment, and the pad token, is embedded once and served from the cache afterwards
+    texts = make_inputs(4)[2]
+    num_segments = len({seg for text in texts for seg in text.split("<ImageHere>")}) + 1
+    assert cache.stats()["embed_entries"] == num_segments
+    assert cache.embed_misses == misses and cache.embed_hits == hits + num_segments
+    for embs, atts in [first, second]:
+        assert torch.equal(embs, uncached[0])
+        assert torch.equal(atts, uncached[1])
+
+
+def test_misses_are_embedded_together(tiny_model):
+    tiny_model.enable_segment_cache()
+    calls = []
+    embed_tokens = tiny_model.embed_tokens
+    tiny_model.embed_tokens = lambda token_ids: calls.append(token_ids.shape) or embed_tokens(token_ids)
+    with torch.no_grad():
+        embeds = tiny_model.embed_segments([[5, 6], [7], [5, 6], [8, 9, 10]], "cpu")
+    # one call for the three distinct segments
+    assert calls == [torch.Size([6])]
+    assert torch.equal(embeds, embed_tokens(torch.tensor([5, 6, 7, 5, 6, 8, 9, 10])))
+
+
+def test_no_embeddings_are_cached_while_training(tiny_model):
+    tiny_model.enable_segment_cache()
+    # a frozen embedding table, as with LoRA
+    tiny_model.train()
+    wrap(tiny_model)
+    assert tiny_model.segment_cache.stats()["embed_entries"] == 0
+    assert tiny_model.segment_cache.stats()["token_entries"] > 0
+
+    weight = tiny_model.language_model.get_input_embeddings().weight
+    weight.requires_grad = True
+    embs, atts = wrap(tiny_model)
+    (embs * atts[..., None]).sum().backward()
+    # every distinct prompt token receives a gradient
+    assert weight.grad is not None and int((weight.grad.abs().sum(1) > 0).sum()) > 10
+    assert tiny_model.segment_cache.embed_hits == 0
+
+
+def test_embeddings_are_bounded_in_bytes():
+    weight = torch.randn(100, 16)
+    embed_fn = lambda missing: weight[torch.tensor([t for ids in missing for t in ids], dtype=torch.long)]
+    # room for 10 rows of 16 float32
+    cache = SegmentCache(max_entries=100, max_bytes=10 * 16 * 4)
+    first = cache.embeddings([(1, 2, 3, 4), (5, 6, 7, 8)], weight, embed_fn)
+    assert torch.equal(first[1], weight[5:9])
+    cache.embeddings([(9, 10, 11)], weight, embed_fn)
+    # the least recently used segment went out to make room
+    assert cache.stats()["embed_entries"] == 2 and cache.embed_bytes == 7 * 16 * 4
+    assert cache.stats()["embed_evictions"] == 1
+    cache.embeddings([(5, 6, 7, 8), (9, 10, 11)], weight, embed_fn)
+    assert cache.embed_hits == 2
+    # larger than the whole cache: served, not stored
+    too_long = tuple(range(20, 40))
+    assert torch.equal(cache.embeddings([too_long], weight, embed_fn)[0], weight[20:40])
+    assert too_long not in cache._embeds
+    # an in-place update of the weights drops the cached embeddings
+    weight.add_(1)
+    assert torch.equal(cache.embeddings([(5, 6, 7, 8)], weight, embed_fn)[0], weight[5:9])
+    assert cache.invalidations == 1 and cache.embed_bytes == 4 * 16 * 4
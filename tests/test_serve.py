@@ -0,0 +1,105 @@
+import asyncio
+
+from conftest import make_inputs
+from serve import GenerateRequest, MicroBatcher, build_app, make_generate_fn
+
+
+def endpoint(app, path):
+    return next(route.endpoint for route in app.routes if route.path == path)
+
+
+def make_items(batch_size):
+    images, audios, _ = make_inputs(batch_size)
+    texts = ["<Img><ImageHere></Img> what is in the image", "<Img><ImageHere></Img> describe this",
+             "<Img><ImageHere></Img> how many cat are there"]
+    return [{"image": images[i], "audio": audios[i], "text": texts[i % len(texts)]} for i in range(batch_size)]
+
+
+def serve(batcher, items, num_rounds=1):
+    """Post items concurrently to /generate, num_rounds times, and return the responses and /metrics."""
+    app = build_app(batcher, preprocess_fn=lambda request: items[int(request.text)])
+    stops = []
+    stop = batcher.stop
+
+    async def recording_stop():
+        stops.append(True)
+        await stop()
+
+    batcher.stop = recording_stop
+
+    async def run():
+        # the server's startup and shutdown
+        async with app.router.lifespan_context(app):
+            responses = []
+            for _ in range(num_rounds):
+                requests = [GenerateRequest(text=str(i), image="", audio="") for i in range(len(items))]
+                posts = asyncio.gather(*[endpoint(app, "/generate")(request) for request in requests],
+                                       return_exceptions=True)
+                # a request left pending would otherwise hang the test
+                responses.append(await asyncio.wait_for(posts, timeout=60))
+            metrics = await endpoint(app, "/metrics")()
+        # stopped on shutdown
+        assert stops == [True]
+        return responses, metrics
+
+    return asyncio.run(run())
+
+
+def test_requests_are_batched_and_answered_in_order(tiny_model):
+    items = make_items(6)
+    generate_fn = make_generate_fn(tiny_model, max_new_tokens=6)
+    batch_sizes = []
+
+    def recording_generate_fn(batch):
+        batch_sizes.append(len(batch))
+        return generate_fn(batch)
+
+    batcher = MicroBatcher(recording_generate_fn, max_batch_size=4, max_wait_ms=200)
+    (responses,), metrics = serve(batcher, items)
+
+    # requests arriving together are coalesced, up to max_batch_size
+    assert sum(batch_sizes) == 6 and max(batch_sizes) == 4 and len(batch_sizes) == 2
+    # every request gets the answer of its own item
+    expected = [generate_fn([item])[0] for item in items]
+    assert [response["prediction"] for response in responses] == expected
+    assert metrics["num_requests"] == 6
+    assert metrics["num_batches"] == 2
+    assert metrics["batch_size_histogram"] == {2: 1, 4: 1}
+    assert metrics["queue_depth"] == 0
+    assert metrics["latency_ms"]["p50"] is not None
+
+
+def test_missing_answers_fail_the_batch():
+    items = [{"text": str(i)} for i in range(3)]
+    calls = []
+
+    def generate_fn(batch):
+        calls.append(len(batch))
+        # one answer short on the first call, correct afterwards
+        return ["answer"] * (len(batch) - (len(calls) == 1))
+
+    batcher = MicroBatcher(generate_fn, max_batch_size=8, max_wait_ms=100)
+    (failed, served), metrics = serve(batcher, items, num_rounds=2)
+    assert all(isinstance(response, RuntimeError) for response in failed)
+    assert [response["prediction"] for response in served] == ["answer"] * 3
+    assert metrics["num_requests"] == 3
+
+
+def test_worker_survives_errors_outside_generate():
+    items = [{"text": str(i)} for i in range(2)]
+    batcher = MicroBatcher(lambda batch: ["answer"] * len(batch), max_batch_size=8, max_wait_ms=100)
+    update = batcher.stats.update
+    failures = []
+
+    def failing_update(*args, **kwargs):
+        if not failures:
+            failures.append(True)
+            raise ValueError("stats failed")
+        update(*args, **kwargs)
+
+    batcher.stats.update = failing_update
+    (first, second), metrics = serve(batcher, items, num_rounds=2)
+    # the answers were already delivered when the stats failed, and the next batch is still served
+    assert [response["prediction"] for response in first] == ["answer"] * 2
+    assert [response["prediction"] for response in second] == ["answer"] * 2
+    assert metrics["num_batches"] == 1
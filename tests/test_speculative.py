@@ -0,0 +1,16 @@
+import torch
+
+from conftest import tiny_llama
+
+
+def test_draft_model_is_not_a_submodule(tiny_model):
+    keys = set(tiny_model.state_dict().keys())
+    draft = tiny_llama(len(tiny_model.language_tokenizer), seed=1)
+    tiny_model.set_draft_model(draft)
+    assert tiny_model.draft_model is draft
+    # no draft weights in checkpoints, nor among the parameters the optimizer or load_weights see
+    assert set(tiny_model.state_dict().keys()) == keys
+    assert all(param is not draft_param for param in tiny_model.parameters() for draft_param in draft.parameters())
+    # model-wide dtype changes leave it alone
+    tiny_model.half()
+    assert next(draft.parameters()).dtype == torch.float32
@@ -0,0 +1,83 @@
+import torch
+
+from conftest import build_tiny_model, make_inputs, tiny_tokenizer
+from OmniMod.conversation.conversation import StopSequenceCriteria, stop_string_token_ids
+from OmniMod.models.decoding import decode_from_past, past_to_tuple
+
+
+def test_stop_string_token_ids():
+    # "</s>" is the eos token of the Llama tokenizer, and four pieces of text for Llama-3
+    assert stop_string_token_ids(tiny_tokenizer(), "</s>") == [[2]]
+    tokenizer = tiny_tokenizer("<|eot_id|>")
+    assert stop_string_token_ids(tokenizer, "</s>") == [tokenizer.convert_tokens_to_ids(["<", "##/", "##s", "##>"])]
+    # "a" + "cat" merges into an unknown word, that context gives no variant
+    assert stop_string_token_ids(tokenizer, "cat") == [tokenizer.convert_tokens_to_ids(["cat"])]
+    assert stop_string_token_ids(tokenizer, "\n") == []
+
+
+def test_get_stop_tokens(tiny_model):
+    assert tiny_model.get_stop_tokens() == ([2], [])
+
+    model = build_tiny_model(eos_token="<|eot_id|>", end_sym="</s>")
+    tokenizer = model.language_tokenizer
+    stop_ids, stop_sequences = model.get_stop_tokens()
+    assert stop_ids == [tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+    assert stop_sequences == [tokenizer.convert_tokens_to_ids(["<", "##/", "##s", "##>"])]
+
+
+def test_stop_sequence_criteria_finishes_rows_independently():
+    criteria = StopSequenceCriteria([2], [[65, 66, 67]])
+    steps = [[5, 65, 9],
+             [2, 66, 9],
+             [3, 67, 9],
+             [3, 3, 9]]
+    expected = [[False, False, False],
+                [True, False, False],
+                [True, True, False],
+                [True, True, False]]
+    input_ids = torch.zeros([3, 0], dtype=torch.long)
+    for tokens, finished in zip(steps, expected):
+        input_ids = torch.cat([input_ids, torch.tensor(tokens)[:, None]], dim=1)
+        assert criteria(input_ids, None).tolist() == finished
+    # a row finishes at its first stop, later matches do not move it
+    assert criteria.finished_at.tolist() == [2, 3, -1]
+    assert criteria.stats() == {"sequences": 3, "generated": 2 + 3 + 4, "wasted": 3 * 4 - 9, "truncated": 1}
+
+
+def test_generate_counts_stop_stats(tiny_model):
+    images, audios, texts = make_inputs(3)
+    tiny_model.generate(images, audios, texts, max_new_tokens=5)
+    stats = tiny_model.stop_stats()["stop"]
+    assert stats["sequences"] == 3
+    # a random model rarely stops, so the batch runs to max_new_tokens; generated and padding fill it
+    assert stats["generated"] + stats["wasted"] == 3 * 5
+    assert 1 <= stats["truncated"] <= 3
+
+
+def test_decode_from_past_checks_for_the_end_every_few_steps(tiny_model):
+    images, audios, texts = make_inputs(3)
+    embs, attention_mask = tiny_model.prepare_generation_inputs(images, audios, texts)
+    language_model = tiny_model.language_model
+    with torch.no_grad():
+        outputs = language_model(inputs_embeds=embs, attention_mask=attention_mask, use_cache=True)
+    forwards = []
+
+    def counting_model(**kwargs):
+        forwards.append(1)
+        return language_model(**kwargs)
+
+    def decode(check_every):
+        forwards.clear()
+        # every row is finished after two tokens
+        stop_after_two = lambda generated, scores: torch.full([generated.shape[0]], generated.shape[1] >= 2)
+        with torch.no_grad():
+            return decode_from_past(counting_model, past_to_tuple(outputs.past_key_values), attention_mask,
+                                    outputs.logits[:, -1], eos_token_ids=[2], pad_token_id=3, max_new_tokens=20,
+                                    autocast=tiny_model.maybe_autocast, stopping_criteria=stop_after_two,
+                                    check_every=check_every)
+
+    expected = decode(check_every=1)
+    assert expected.shape == (3, 2) and len(forwards) == 1
+    # the loop runs on to the next check, the extra columns are dropped
+    assert torch.equal(decode(check_every=8), expected)
+    assert len(forwards) == 7
@@ -0,0 +1,35 @@
+import pytest
+
+from conftest import make_inputs
+
+
+def test_stream_joins_to_the_answer(tiny_model):
+    images, audios, texts = make_inputs(2, num_frames=(40, 24))
+    expected = tiny_model.generate(images, audios, texts, max_new_tokens=10)
+    pieces = ["", ""]
+    for deltas in tiny_model.stream_generate(images, audios, texts, max_new_tokens=10, timeout=30):
+        pieces = [piece + delta for piece, delta in zip(pieces, deltas)]
+    assert [piece.strip() for piece in pieces] == expected
+
+
+def test_generation_error_reaches_the_consumer(tiny_model, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("generation failed")
+
+    monkeypatch.setattr(tiny_model.language_model, "generate", fail)
+    images, audios, texts = make_inputs(1)
+    streamer = tiny_model.stream_generate(images, audios, texts, max_new_tokens=10, timeout=30)
+    with pytest.raises(RuntimeError, match="generation failed"):
+        list(streamer)
+
+
+def test_cancel_stops_the_generation(tiny_model):
+    images, audios, texts = make_inputs(1)
+    # no eos, the generation would only stop at max_new_tokens
+    tiny_model.language_model.generation_config.eos_token_id = 3
+    tiny_model._stop_tokens = None
+    streamer = tiny_model.stream_generate(images, audios, texts, max_new_tokens=150, timeout=30)
+    next(streamer)
+    streamer.cancel()
+    list(streamer)  # ends once the generation noticed
+    assert len(streamer.token_ids[0]) < 150
@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from conftest import make_inputs
+from OmniMod.models.token_merging import bipartite_merge, merge_tokens
+
+
+@pytest.mark.parametrize("length,num_tokens", [(16, 8), (16, 5), (257, 64), (256, 1), (10, 10), (6, 9)])
+def test_output_token_count(length, num_tokens):
+    x = torch.randn(2, length, 8)
+    merged = merge_tokens(x, num_tokens)
+    assert merged.shape == (2, min(length, num_tokens), 8)
+    if length <= num_tokens:
+        assert merged is x
+
+
+def test_spatial_order_is_kept():
+    # distinct tokens, except 4 and 5 which are the same: only they are merged
+    x = torch.eye(8)[None]
+    x[0, 5] = x[0, 4]
+    merged, size, positions = bipartite_merge(x, torch.ones(1, 8, 1), torch.arange(8)[None], r=1)
+    assert positions.tolist() == [[0, 1, 2, 3, 5, 6, 7]]
+    assert size[0, :, 0].tolist() == [1, 1, 1, 1, 2, 1, 1]
+    assert torch.equal(merged, x[:, [0, 1, 2, 3, 5, 6, 7]])
+    assert torch.equal(merge_tokens(x, 7), merged)
+
+    # several rounds: every merged token holds patches from its neighbourhood, in order
+    x = torch.randn(1, 64, 16).cumsum(1)
+    size, positions = torch.ones(1, 64, 1), torch.arange(64)[None]
+    while x.shape[1] > 10:
+        x, size, positions = bipartite_merge(x, size, positions, min(x.shape[1] - 10, x.shape[1] // 2))
+        assert (positions[:, 1:] > positions[:, :-1]).all()
+
+
+def test_size_weighted_average():
+    # token 0 already holds 3 patches, token 1 one patch: the merge weights them 3 to 1
+    x = torch.tensor([[[1.0, 0.0], [1.0, 1.0]]])
+    size = torch.tensor([[[3.0], [1.0]]])
+    merged, merged_size, _ = bipartite_merge(x, size, torch.arange(2)[None], r=1)
+    assert merged_size.tolist() == [[[4.0]]]
+    assert torch.allclose(merged, torch.tensor([[[1.0, 0.25]]]))
+
+    # the sum of the patches is kept over several rounds
+    x = torch.randn(2, 50, 8)
+    merged, size, positions = x, torch.ones(2, 50, 1), torch.arange(50).expand(2, 50)
+    while merged.shape[1] > 7:
+        merged, size, positions = bipartite_merge(merged, size, positions, min(merged.shape[1] - 7, merged.shape[1] // 2))
+    assert torch.equal(size.sum(1), torch.full([2, 1], 50.0))
+    assert torch.allclose((merged * size).sum(1), x.sum(1), atol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+def test_merging_identical_tokens_keeps_their_values(dtype):
+    x = torch.randn(3, 1, 8).expand(3, 40, 8).to(dtype)
+    merged = merge_tokens(x, 3)
+    assert merged.dtype == dtype
+    assert torch.allclose(merged.float(), x[:, :3].float(), atol=1e-6)
+
+
+def test_img_token_budget(tiny_model):
+    images, _, _ = make_inputs(2)
+    with torch.no_grad():
+        embeds, _ = tiny_model.encode_img(images)
+        # 16 patches, num_concat 4: 4 tokens per image
+        assert embeds.shape[1] == 4
+        tiny_model.enable_token_merging(2)
+        merged, atts = tiny_model.encode_img(images)
+        tiny_model.enable_token_merging(8)
+        unmerged, _ = tiny_model.encode_img(images)
+    assert merged.shape[1] == atts.shape[1] == 2
+    # a budget above the number of tokens changes nothing
+    assert torch.equal(unmerged, embeds)
+    assert tiny_model.token_merge_stats()["token_merge"]["tokens_per_image_after"] == 4
@@ -0,0 +1,91 @@
+from functools import partial
+
+import pytest
+import torch
+import torch.nn as nn
+
+from OmniMod.models.vision_model.eva_vit import VisionTransformer
+
+
+def small_vit(**kwargs):
+    """The EVA ViT-g architecture at 3x3 patches, 2 blocks of width 32, with random relative position biases."""
+    torch.manual_seed(0)
+    model = VisionTransformer(img_size=42, patch_size=14, use_mean_pooling=False, embed_dim=32, depth=2,
+                              num_heads=4, mlp_ratio=4.3637, qkv_bias=True,
+                              norm_layer=partial(nn.LayerNorm, eps=1e-6), **kwargs)
+    tables = [blk.attn.relative_position_bias_table for blk in model.blocks]
+    if model.rel_pos_bias is not None:
+        tables.append(model.rel_pos_bias.relative_position_bias_table)
+    for table in tables:
+        if table is not None:
+            nn.init.normal_(table, std=0.5)
+    return model.eval()
+
+
+def sdpa_and_eager(model, images):
+    model.set_sdpa(True)
+    output = model(images)
+    model.set_sdpa(False)
+    return output, model(images)
+
+
+RELATIVE_POSITION_BIASES = [{}, {"use_rel_pos_bias": True}, {"use_shared_rel_pos_bias": True}]
+
+
+@pytest.mark.parametrize("kwargs", RELATIVE_POSITION_BIASES)
+def test_sdpa_matches_explicit_attention(kwargs):
+    model = small_vit(**kwargs)
+    images = torch.randn(2, 3, 42, 42)
+    with torch.no_grad():
+        output, expected = sdpa_and_eager(model, images)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("kwargs", RELATIVE_POSITION_BIASES)
+def test_sdpa_gradients_match(kwargs):
+    model = small_vit(**kwargs)
+    images = torch.randn(2, 3, 42, 42)
+    gradients = []
+    for enabled in [True, False]:
+        model.zero_grad()
+        model.set_sdpa(enabled)
+        model(images).square().sum().backward()
+        gradients.append({name: param.grad.clone() for name, param in model.named_parameters()
+                          if param.grad is not None})
+    assert list(gradients[0]) == list(gradients[1])
+    for name, grad in gradients[0].items():
+        assert torch.allclose(grad, gradients[1][name], atol=1e-4), name
+    # with gradients the mask is built on every forward, nothing is cached
+    assert all(blk.attn.attn_mask_cache is None for blk in model.blocks)
+
+
+def test_cached_mask_follows_the_bias_table():
+    model = small_vit(use_rel_pos_bias=True)
+    # set_sdpa drops the cached masks, so the explicit attention runs in a copy
+    reference = small_vit(use_rel_pos_bias=True)
+    model.set_sdpa(True)
+    images = torch.randn(2, 3, 42, 42)
+    attn = model.blocks[0].attn
+    with torch.no_grad():
+        assert torch.allclose(model(images), reference(images), atol=1e-5)
+        mask = attn.attn_mask_cache[1]
+        # another forward reuses the mask
+        model(images)
+        assert attn.attn_mask_cache[1] is mask
+
+        # changed in place, for example by loading a checkpoint: the mask is rebuilt
+        state_dict = {k: v + 1 if "relative_position_bias_table" in k else v
+                      for k, v in reference.state_dict().items()}
+        model.load_state_dict(state_dict)
+        reference.load_state_dict(state_dict)
+        assert torch.allclose(model(images), reference(images), atol=1e-5)
+        assert attn.attn_mask_cache[1] is not mask
+        assert torch.allclose(attn.attn_mask_cache[1], mask + 1)
+
+        for module in [model, reference]:
+            module.blocks[1].attn.relative_position_bias_table.mul_(2)
+        assert torch.allclose(model(images), reference(images), atol=1e-5)
+
+        # one mask per dtype
+        assert attn.get_attn_mask(None, torch.float64).dtype == torch.float64
+        assert attn.get_attn_mask(None, torch.float32).dtype == torch.float32
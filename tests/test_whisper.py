@@ -0,0 +1,85 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from OmniMod.models.text2speech.whisper import WhisperForLiteGPT
+
+WINDOW = 3000  # mel frames of 30 s
+FLOOR = -0.7  # log-mel value of the zero padding
+
+
+@pytest.fixture
+def whisper():
+    from transformers import WhisperConfig
+    from transformers.models.whisper.modeling_whisper import WhisperEncoder
+
+    torch.manual_seed(0)
+    config = WhisperConfig(d_model=16, encoder_layers=2, encoder_attention_heads=2, encoder_ffn_dim=32,
+                           num_mel_bins=80, max_source_positions=WINDOW // 2)
+    return WhisperForLiteGPT(WhisperEncoder(config)).eval()
+
+
+def log_mel(num_frames, total_frames=WINDOW, seed=0):
+    """Log-mel features of questions of num_frames frames, padded to total_frames at the floor."""
+    generator = torch.Generator().manual_seed(seed)
+    features = torch.full([len(num_frames), 80, total_frames], FLOOR)
+    for i, frames in enumerate(num_frames):
+        features[i, :, :frames] = FLOOR + 0.1 + torch.rand(80, frames, generator=generator)
+    return features
+
+
+def test_mel_lengths():
+    assert WhisperForLiteGPT.mel_lengths(log_mel([3000, 417, 1])).tolist() == [3000, 417, 1]
+
+
+def test_variable_length_matches_fixed_for_full_windows(whisper):
+    features = log_mel([WINDOW, WINDOW])
+    whisper.set_variable_length(True)
+    with torch.no_grad():
+        output, token_lens = whisper.encode(features)
+        expected = whisper(features)
+    assert token_lens.tolist() == [whisper.num_tokens] * 2
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_variable_length_rows_do_not_depend_on_the_batch(whisper):
+    num_frames = [700, 2890, 64, 1500]
+    features = log_mel(num_frames)
+    whisper.set_variable_length(True, bucket_frames=200)
+    with torch.no_grad():
+        output, token_lens = whisper.encode(features)
+        alone = [whisper.encode(features[i:i + 1]) for i in range(len(num_frames))]
+    # 256 tokens per 30 s, rounded up
+    enc_lens = [(frames + 1) // 2 for frames in num_frames]
+    assert token_lens.tolist() == [-(-enc_len * 256 // 1500) for enc_len in enc_lens]
+    for i, (row, row_lens) in enumerate(alone):
+        assert row_lens.tolist() == [token_lens[i]]
+        assert torch.allclose(output[i, :token_lens[i]], row[0, :token_lens[i]], atol=1e-5)
+        # zero after the question
+        assert not output[i, token_lens[i]:].any()
+
+
+@pytest.mark.parametrize("variable_length", [False, True])
+def test_chunked_skips_padding_windows_and_caps_tokens(whisper, variable_length):
+    whisper.set_variable_length(variable_length)
+    whisper.set_chunking(overlap_frames=200, max_tokens=10000, window_batch_size=4)
+    # a long question and a shorter one, padded to the length of the long one
+    features = log_mel([7000, 4000], total_frames=8500)
+    windows = []
+    whisper.asr_encoder.conv1.register_forward_hook(lambda module, inputs, output: windows.append(len(output)))
+    with torch.no_grad():
+        output, token_lens = whisper.encode(features)
+    # windows start every 2800 frames: 3 hold the long question, 2 the short one, none only padding
+    assert sum(windows) == 5 and max(windows) <= 4
+    assert token_lens[0] > token_lens[1] > whisper.num_tokens
+
+    whisper.set_chunking(overlap_frames=200, max_tokens=300, window_batch_size=4)
+    with torch.no_grad():
+        capped, capped_lens = whisper.encode(features)
+    assert capped_lens.tolist() == [min(n, 300) for n in token_lens.tolist()]
+    for i, n in enumerate(token_lens.tolist()):
+        expected = output[i, :n]
+        if n > 300:
+            expected = nn.functional.adaptive_avg_pool1d(expected.t()[None], 300)[0].t()
+        assert torch.allclose(capped[i, :capped_lens[i]], expected, atol=1e-5)